@@ -0,0 +1,29 @@
+"""
+CommentPdfFromExcel engine package.
+
+`import commentpdf` is cheap: the engine (and PyMuPDF) is imported on first attribute access,
+e.g. `from commentpdf import process_files`. The Tk GUI lives in pdf_comment_from_excel.py.
+"""
+
+__all__ = [
+    "PDF_FONT_MAP",
+    "annotate_pdf_bytes",
+    "build_annotations_for_preview",
+    "compute_text_size_points",
+    "is_marked_output",
+    "load_tag_sheet",
+    "marked_output_path",
+    "parse_color",
+    "prepare_tag_plan",
+    "process_files",
+    "row_annotation_settings",
+    "update_pdf_with_comments",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from commentpdf import core
+
+        return getattr(core, name)
+    raise AttributeError(f"module 'commentpdf' has no attribute {name!r}")
@@ -0,0 +1,638 @@
+"""
+The batch pipeline behind process_files (commentpdf.core). A BatchRun admits each input (resume,
+quarantine, pre-scan, deduplication of identical inputs, cost estimate) into a queue ordered by
+priority and cost and records the outcome of every file; a dispatcher runs the queued files in
+this process, on a process pool or on supervised workers; run_batch drives the two until the
+inputs are exhausted or the batch is cancelled.
+
+Usage:
+    from commentpdf.batch import BatchRun, PathFeed, SerialDispatcher, run_batch
+
+    run = BatchRun(tag_df, options, "out")
+    run_batch(run, PathFeed(pdf_paths), SerialDispatcher(run))
+    print(run.summary)
+"""
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from commentpdf.core import (
+    ProcessingCancelled,
+    file_sha256,
+    link_or_copy_output,
+    marked_output_path,
+    update_pdf_with_comments,
+)
+from commentpdf.metrics import new_file_stats
+from commentpdf.schedule import MIN_FILE_COST, CostProgress, file_size_cost, priority_rank
+
+# ---------- Batch worker processes ----------
+# Each worker process receives the tag sheet once (via the pool initializer) instead of per file.
+_BATCH_TAG_DF = None
+_BATCH_OPTIONS = {}
+_BATCH_OUTPUT_MODE = "pdf"
+
+
+def init_batch_worker(tag_df, options, output_mode):
+    """Pool initializer: keep the batch's tag plan and options for process_in_worker."""
+    global _BATCH_TAG_DF, _BATCH_OPTIONS, _BATCH_OUTPUT_MODE
+    _BATCH_TAG_DF = tag_df
+    _BATCH_OPTIONS = dict(options)
+    _BATCH_OUTPUT_MODE = output_mode
+
+
+def annotate_file(pdf_path, tag_plan, out_path, output_mode, options, log_func=None, cancel_event=None, stats=None):
+    """
+    Annotate one file of a batch. tag_plan is a tag sheet or a commentpdf.profiles.ProfileSet
+    (whose out_path is then its output path or list of paths). Returns the annotation count or None.
+    """
+    if hasattr(tag_plan, "annotate"):
+        return tag_plan.annotate(pdf_path, out_path, log_func=log_func, cancel_event=cancel_event, stats=stats)
+    if output_mode == "pdf":
+        return update_pdf_with_comments(
+            pdf_path, tag_plan, out_path, log_func=log_func, cancel_event=cancel_event, stats=stats, **options
+        )
+    from commentpdf.sidecar import write_annotation_sidecar
+
+    return write_annotation_sidecar(
+        pdf_path, tag_plan, out_path, fmt=output_mode, log_func=log_func, cancel_event=cancel_event, stats=stats,
+        **options
+    )
+
+
+def process_in_worker(pdf_path, out_path, stats=None):
+    """Process one file with the worker's preloaded tag sheet; return (count, log lines, seconds, stats)."""
+    lines = []
+    if stats is None:
+        stats = new_file_stats()
+    start = time.perf_counter()
+    count = annotate_file(
+        pdf_path, _BATCH_TAG_DF, out_path, _BATCH_OUTPUT_MODE, _BATCH_OPTIONS, log_func=lines.append, stats=stats
+    )
+    return count, lines, time.perf_counter() - start, stats
+
+
+# ---------- Admission ----------
+class PathFeed:
+    """
+    Source of input paths for a batch. A list or tuple is available at once; any other
+    iterable (e.g. commentpdf.discover.iter_pdf_files) is consumed on a background thread so
+    files can be processed while the rest are still being enumerated. With cost_func (e.g.
+    commentpdf.schedule.estimate_pdf_cost) every path is costed on that thread as well, and
+    costs maps each taken path to its estimate.
+    """
+
+    _DONE = object()
+
+    def __init__(self, paths, cost_func=None):
+        self.exhausted = False
+        self.error = None
+        self.costs = {}
+        self._stop = threading.Event()
+        self._known = len(paths) if isinstance(paths, (list, tuple)) else None
+        self._taken = 0
+        if self._known is not None and cost_func is None:
+            self._items = list(paths)
+            self._queue = None
+            return
+        self._items = None
+        self._queue = queue.Queue()
+        threading.Thread(target=self._enumerate, args=(paths, cost_func), daemon=True).start()
+
+    @property
+    def streamed(self):
+        return self._queue is not None
+
+    def _enumerate(self, paths, cost_func):
+        try:
+            for path in paths:
+                if self._stop.is_set():
+                    break
+                self._queue.put((path, cost_func(path) if cost_func else None))
+        except Exception as e:
+            self.error = e
+        finally:
+            self._queue.put(self._DONE)
+
+    def take(self, limit=None, block=False):
+        """Return up to limit newly found paths; block=True waits for at least one (or the end)."""
+        if self._queue is None:
+            items, self._items = self._items or [], []
+            self.exhausted = True
+            self._taken += len(items)
+            return items
+        items = []
+        while not self.exhausted and (limit is None or len(items) < limit):
+            try:
+                item = self._queue.get(block=block and not items, timeout=0.25 if block else None)
+            except queue.Empty:
+                break
+            if item is self._DONE:
+                self.exhausted = True
+                continue
+            path, cost = item
+            items.append(path)
+            if cost is not None:
+                self.costs[path] = cost
+        self._taken += len(items)
+        return items
+
+    def discard(self):
+        """Stop the feed and return how many of its paths were never taken."""
+        self.close()
+        left = len(self.take())
+        # paths of a list that were not even costed yet still belong to the batch
+        return self._known - self._taken + left if self._known is not None else left
+
+    def close(self):
+        self._stop.set()
+
+
+class BatchRun:
+    """
+    State and bookkeeping of one batch: the queue of admitted files (a heap of (priority rank,
+    -cost, arrival, path, cost): urgent first, then largest first), the summary counts, the cost
+    progress, the journal and quarantine list, and deduplication of identical inputs.
+
+    tag_plan is a tag sheet or a commentpdf.profiles.ProfileSet; journal a core.BatchJournal (with
+    settings, the digest its records are made with) and quarantine a commentpdf.watchdog.Quarantine,
+    each optional. prescan runs commentpdf.watchdog.prescan_pdf on every admitted file (needs
+    quarantine). dedupe is None, "link" or "copy" (see process_files). Files admitted without a
+    cost estimate are costed with cost_func (default: commentpdf.schedule.file_size_cost).
+    """
+
+    def __init__(
+        self,
+        tag_plan,
+        options,
+        output_folder,
+        output_mode="pdf",
+        input_root=None,
+        journal=None,
+        settings=None,
+        resume=False,
+        quarantine=None,
+        prescan=False,
+        dedupe=None,
+        priority=None,
+        cost_func=None,
+        run_metrics=None,
+        log_func=None,
+        progress_callback=None,
+        eta_callback=None,
+        cancel_event=None,
+    ):
+        self.tag_plan = tag_plan
+        self.options = options
+        self.output_folder = output_folder
+        self.output_mode = output_mode
+        self.input_root = input_root
+        self.journal = journal
+        self.settings = settings
+        self.resume = resume
+        self.quarantine_list = quarantine
+        self.prescan = prescan
+        self.dedupe = dedupe
+        self.priority = list(priority or [])
+        self.cost_func = cost_func or file_size_cost
+        self.run_metrics = run_metrics
+        self.log_func = log_func
+        self.progress_callback = progress_callback
+        self.eta_callback = eta_callback
+        self.cancel_event = cancel_event
+
+        self.summary = {
+            "total": 0,
+            "processed": 0,
+            "skipped": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "quarantined": 0,
+            "deduplicated": 0,
+            "seconds_saved": 0.0,
+        }
+        self.progress = CostProgress(0)
+        # the ETA is only reported once every input is known
+        self.inputs_complete = False
+        self.ready = []
+        self._last_pct = 0
+        self._arrival = itertools.count()
+        # Deduplication by input content: content_of maps a hashed input to its SHA-256, primaries
+        # the content to the input being processed for it, waiting a primary to the identical inputs
+        # that get its output, and done_outputs the content to (output, annotations, seconds,
+        # output SHA-256) once an output exists. Waiting inputs are costed at MIN_FILE_COST.
+        self.content_of = {}
+        self.primaries = {}
+        self.waiting = {}
+        self.done_outputs = {}
+        if output_mode != "pdf":
+            from commentpdf.sidecar import sidecar_output_path
+
+            self._sidecar_output_path = sidecar_output_path
+
+    def log(self, msg):
+        if self.log_func:
+            self.log_func(msg)
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    # ----- outputs -----
+    def output_targets(self, pdf_path):
+        """Every output of pdf_path: a path, or for separate profile outputs a list of paths."""
+        if hasattr(self.tag_plan, "output_paths"):
+            return self.tag_plan.output_paths(pdf_path, self.output_folder, self.input_root)
+        if self.output_mode == "pdf":
+            return marked_output_path(pdf_path, self.output_folder, self.input_root)
+        return self._sidecar_output_path(pdf_path, self.output_folder, self.output_mode, self.input_root)
+
+    def output_path(self, pdf_path):
+        """The output deduplication tracks (the first one of several)."""
+        targets = self.output_targets(pdf_path)
+        return targets if isinstance(targets, str) else targets[0]
+
+    def prepare_outputs(self, pdf_path):
+        """Create the output folders of pdf_path and return its output_targets."""
+        targets = self.output_targets(pdf_path)
+        for target in [targets] if isinstance(targets, str) else targets:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        return targets
+
+    # ----- queue -----
+    def enqueue(self, pdf_path, cost=None):
+        cost = max(MIN_FILE_COST, self.cost_func(pdf_path) if cost is None else cost)
+        self.progress.total_cost += cost
+        heapq.heappush(self.ready, (priority_rank(pdf_path, self.priority), -cost, next(self._arrival), pdf_path, cost))
+
+    def pop_ready(self):
+        """Return (pdf_path, cost) of the next file to process."""
+        _, _, _, pdf_path, cost = heapq.heappop(self.ready)
+        return pdf_path, cost
+
+    def admit_from(self, feed, window=None, block=False):
+        """Admit up to window paths newly found by feed (see PathFeed.take) with their estimates."""
+        for pdf_path in feed.take(window, block):
+            self.admit(pdf_path, feed.costs.pop(pdf_path, None))
+        self.inputs_complete = feed.exhausted
+
+    def admit(self, pdf_path, cost=None):
+        """Count pdf_path into the batch and skip, quarantine, deduplicate or queue it (at cost, if known)."""
+        self.summary["total"] += 1
+        journal = self.journal if self.resume else None
+        if journal and journal.is_done(pdf_path, self.output_targets(pdf_path), self.settings):
+            # resumed files never enter the cost model, so they do not distort the ETA
+            self.summary["skipped"] += 1
+            self.log(f"Skipping (already done): {os.path.basename(pdf_path)}")
+            return
+        if self.quarantine_list is not None:
+            entry = self.quarantine_list.get(pdf_path) if self.resume else None
+            if entry:
+                self.summary["skipped"] += 1
+                self.log(f"Skipping (quarantined: {entry['reason']}): {os.path.basename(pdf_path)}")
+                return
+            if self.prescan:
+                from commentpdf.watchdog import prescan_pdf
+
+                reason = prescan_pdf(pdf_path, self.log_func)
+                if reason:
+                    self.quarantine(pdf_path, 0.0, reason, "prescan")
+                    return
+        if self.dedupe and self._admit_duplicate(pdf_path):
+            return
+        self.enqueue(pdf_path, cost)
+
+    def cancel_queued(self, unadmitted=0):
+        """Count the queued files (and unadmitted found ones) as cancelled when the batch is cancelled."""
+        not_started = len(self.ready) + unadmitted
+        not_started += sum(len(self.waiting.pop(entry[3], ())) for entry in self.ready)
+        self.ready = []
+        self.summary["cancelled"] += not_started
+        if not_started:
+            self.log(f"Cancelled: {not_started} file(s) not processed")
+
+    # ----- deduplication -----
+    def _reuse(self, pdf_path, source, count, seconds, source_sha256=None, verify=False):
+        """Give pdf_path the output source made for identical content; False when that fails."""
+        out_path = self.output_path(pdf_path)
+        started = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            if not link_or_copy_output(
+                source, out_path, link=self.dedupe == "link", expected_sha256=source_sha256 if verify else None
+            ):
+                return False
+        except OSError as e:
+            self.log(f"  Could not reuse {os.path.basename(source)} for {os.path.basename(pdf_path)}: {e}")
+            return False
+        self.summary["deduplicated"] += 1
+        self.summary["seconds_saved"] += seconds or 0.0
+        self.log(f"Identical to an earlier input: {os.path.basename(pdf_path)} reuses {os.path.basename(source)}")
+        self.finish(
+            pdf_path, MIN_FILE_COST, "done", count, seconds=time.perf_counter() - started,
+            reused_from=source, output_sha256=source_sha256, seconds_saved=seconds,
+        )
+        return True
+
+    def _admit_duplicate(self, pdf_path):
+        """Hash pdf_path; True when it was handled as (or queued behind) identical content."""
+        try:
+            sha = file_sha256(pdf_path)
+        except OSError:
+            # processing reports the error
+            return False
+        self.content_of[pdf_path] = sha
+        self.progress.total_cost += MIN_FILE_COST
+        if sha in self.done_outputs and self._reuse(pdf_path, *self.done_outputs[sha]):
+            return True
+        if sha not in self.done_outputs and sha in self.primaries:
+            self.waiting.setdefault(self.primaries[sha], []).append(pdf_path)
+            return True
+        record = self.journal.reusable_output(sha, self.settings) if self.journal else None
+        if record:
+            # a record that itself reused an output carries the original processing time
+            seconds = record.get("seconds_saved", record.get("seconds"))
+            if self._reuse(
+                pdf_path, record["output"], record.get("annotations"), seconds, record["output_sha256"], verify=True
+            ):
+                self.done_outputs[sha] = (
+                    self.output_path(pdf_path), record.get("annotations"), seconds, record["output_sha256"]
+                )
+                return True
+        self.progress.total_cost -= MIN_FILE_COST
+        self.primaries[sha] = pdf_path
+        return False
+
+    def _release(self, pdf_path, status, count, seconds, error=None):
+        """Hand a finished primary's result to the identical inputs waiting for it."""
+        sha = self.content_of[pdf_path]
+        followers = self.waiting.pop(pdf_path, [])
+        if status == "done":
+            record = self.journal.entries.get(os.path.abspath(pdf_path)) if self.journal else None
+            self.done_outputs[sha] = (self.output_path(pdf_path), count, seconds, record and record.get("output_sha256"))
+            for follower in followers:
+                if not self._reuse(follower, *self.done_outputs[sha]):
+                    self.progress.total_cost -= MIN_FILE_COST
+                    self.enqueue(follower)
+            return
+        del self.primaries[sha]
+        if not followers:
+            return
+        if status == "quarantined":
+            # identical content would hit the same limit again
+            for follower in followers:
+                self.quarantine(follower, MIN_FILE_COST, f"identical to {os.path.basename(pdf_path)}: {error}", "limits")
+            return
+        if status == "cancelled" or self.cancelled():
+            self.summary["cancelled"] += len(followers)
+            return
+        # the same content may still succeed under another name (e.g. another output folder)
+        self.primaries[sha] = followers[0]
+        if followers[1:]:
+            self.waiting[followers[0]] = followers[1:]
+        self.progress.total_cost -= MIN_FILE_COST
+        self.enqueue(followers[0])
+
+    # ----- outcomes -----
+    def quarantine(self, pdf_path, cost, reason, stage, seconds=0.0):
+        self.log(f"Quarantined {os.path.basename(pdf_path)}: {reason}")
+        try:
+            self.quarantine_list.add(pdf_path, reason, stage)
+        except OSError as e:
+            self.log(f"  Error writing quarantine list: {e}")
+        self.finish(pdf_path, cost, "quarantined", error=reason, seconds=seconds)
+
+    def file_result(self, pdf_path, cost, count, lines, seconds, stats):
+        """Record a file processed elsewhere (a worker), logging the lines it produced."""
+        for line in lines:
+            self.log(line)
+        self.finish(pdf_path, cost, "done" if count is not None else "failed", count, seconds=seconds, stats=stats)
+
+    def file_error(self, pdf_path, cost, error, seconds=0.0):
+        """Record a file whose processing raised error."""
+        self.log(f"Error processing {os.path.basename(pdf_path)}: {error}")
+        self.finish(pdf_path, cost, "failed", error=error, seconds=seconds)
+
+    def finish(
+        self, pdf_path, cost, status, count=None, error=None, seconds=0.0, reused_from=None, output_sha256=None,
+        seconds_saved=None, stats=None,
+    ):
+        """Record the outcome of pdf_path: summary, metrics, journal, progress, identical inputs."""
+        if stats is not None and self.run_metrics is not None:
+            self.run_metrics.add_file(pdf_path, seconds, stats)
+        if status == "done":
+            self.summary["processed"] += 1
+        elif status == "failed":
+            self.summary["failed"] += 1
+        elif status == "quarantined":
+            self.summary["quarantined"] += 1
+        if self.journal:
+            try:
+                self.journal.record(
+                    pdf_path, self.output_targets(pdf_path), status, seconds, self.settings, count, error,
+                    input_sha256=self.content_of.get(pdf_path), output_sha256=output_sha256, reused_from=reused_from,
+                    seconds_saved=seconds_saved,
+                )
+            except Exception as e:
+                self.log(f"  Error writing journal: {e}")
+        self.progress.add(cost)
+        # update progress after each file; never move backwards while the total is still growing
+        self._last_pct = max(self._last_pct, int(self.progress.fraction() * 100))
+        try:
+            if self.progress_callback:
+                self.progress_callback(self._last_pct)
+            if self.eta_callback:
+                self.eta_callback(self.progress.eta() if self.inputs_complete else None)
+        except Exception:
+            pass
+        if pdf_path in self.content_of and self.primaries.get(self.content_of[pdf_path]) == pdf_path:
+            self._release(pdf_path, status, count, seconds, error)
+
+
+# ---------- Dispatch ----------
+def run_file(run, pdf_path, cost):
+    """Process pdf_path in this process and record its outcome; return its status."""
+    base = os.path.basename(pdf_path)
+    status, count, error = "failed", None, None
+    stats = new_file_stats()
+    started = time.perf_counter()
+    try:
+        out_path = run.prepare_outputs(pdf_path)
+        count = annotate_file(
+            pdf_path, run.tag_plan, out_path, run.output_mode, run.options, run.log_func, run.cancel_event, stats
+        )
+        status = "done" if count is not None else "failed"
+    except ProcessingCancelled:
+        status = "cancelled"
+        run.log(f"Cancelled while processing {base}")
+    except Exception as e:
+        error = e
+        run.log(f"Error processing {base}: {e}")
+        # continue to next file
+    finally:
+        run.finish(pdf_path, cost, status, count, error, time.perf_counter() - started, stats=stats)
+    return status
+
+
+class SerialDispatcher:
+    """Processes the queued files one at a time in this process (see run_file)."""
+
+    capacity = 1
+
+    def __init__(self, run):
+        self.run = run
+        self.in_flight = {}
+
+    def step(self):
+        pdf_path, cost = self.run.pop_ready()
+        if run_file(self.run, pdf_path, cost) == "cancelled":
+            self.run.summary["cancelled"] += 1
+
+    def wind_down(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PoolDispatcher:
+    """
+    Processes the queued files on a pool of `workers` processes that receive the tag plan once.
+    Only as many files as there are workers are handed out, so the order is decided as late as
+    possible. Files already running when the batch is cancelled are finished.
+    """
+
+    def __init__(self, run, workers):
+        self.run = run
+        self.capacity = workers
+        self.in_flight = {}
+        self._pool = None
+
+    def step(self):
+        run = self.run
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.capacity, initializer=init_batch_worker,
+                initargs=(run.tag_plan, run.options, run.output_mode),
+            )
+        while run.ready and len(self.in_flight) < self.capacity:
+            pdf_path, cost = run.pop_ready()
+            out_path = run.prepare_outputs(pdf_path)
+            self.in_flight[self._pool.submit(process_in_worker, pdf_path, out_path)] = (pdf_path, cost)
+        done, _ = wait(self.in_flight, timeout=0.25, return_when=FIRST_COMPLETED)
+        self._reap(done)
+
+    def _reap(self, done):
+        for future in done:
+            pdf_path, cost = self.in_flight.pop(future)
+            try:
+                count, lines, seconds, stats = future.result()
+            except Exception as e:
+                self.run.file_error(pdf_path, cost, e)
+                continue
+            self.run.file_result(pdf_path, cost, count, lines, seconds, stats)
+
+    def wind_down(self):
+        if self.in_flight:
+            self.run.log(f"Finishing {len(self.in_flight)} running file(s)...")
+            self._reap(wait(self.in_flight)[0])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+
+class SupervisedDispatcher:
+    """
+    Processes the queued files under limits (a commentpdf.watchdog.FileLimits) on up to `workers`
+    supervised worker processes; files exceeding a limit are quarantined. Files still running
+    when the batch is cancelled are abandoned like the file in progress of a serial batch.
+    """
+
+    def __init__(self, run, workers, limits):
+        self.run = run
+        self.capacity = workers
+        self.limits = limits
+        self.in_flight = {}
+        self._workers = None
+
+    def step(self):
+        from commentpdf.watchdog import POLL_INTERVAL, SupervisedFile, WorkerPool
+
+        run = self.run
+        if self._workers is None:
+            # each worker receives the tag sheet once and is reused until it is killed
+            self._workers = WorkerPool(
+                self.capacity, init_batch_worker, (run.tag_plan, run.options, run.output_mode), self.limits.memory_mb
+            )
+        while run.ready and len(self.in_flight) < self.capacity:
+            pdf_path, cost = run.pop_ready()
+            out_path = run.prepare_outputs(pdf_path)
+            job = SupervisedFile(self._workers.acquire(), pdf_path, out_path, self.limits)
+            self.in_flight[job] = (pdf_path, cost)
+        time.sleep(POLL_INTERVAL)
+        self._reap()
+
+    def _reap(self):
+        for job, (pdf_path, cost) in list(self.in_flight.items()):
+            result = job.poll()
+            if result is None:
+                continue
+            del self.in_flight[job]
+            self._workers.release(job.worker)
+            kind, value = result
+            seconds = time.monotonic() - job.started
+            if kind == "limit":
+                self.run.quarantine(pdf_path, cost, value, "limits", seconds)
+            elif kind == "error":
+                self.run.file_error(pdf_path, cost, value, seconds)
+            else:
+                count, lines, seconds, stats = value
+                self.run.file_result(pdf_path, cost, count, lines, seconds, stats)
+
+    def wind_down(self):
+        for job, (pdf_path, cost) in list(self.in_flight.items()):
+            job.kill()
+            self._workers.release(job.worker)
+            del self.in_flight[job]
+            self.run.log(f"Cancelled while processing {os.path.basename(pdf_path)}")
+            self.run.finish(pdf_path, cost, "cancelled")
+            self.run.summary["cancelled"] += 1
+
+    def close(self):
+        for job in self.in_flight:
+            job.kill()
+        if self._workers is not None:
+            self._workers.close()
+
+
+def run_batch(run, feed, dispatcher):
+    """
+    Admit the paths of feed (a PathFeed) into run and process them with dispatcher until both
+    are exhausted or run is cancelled. A streamed feed is admitted in small windows so work
+    starts before enumeration ends.
+    """
+    window = max(16, 4 * dispatcher.capacity) if feed.streamed else None
+    try:
+        while True:
+            if not feed.exhausted:
+                run.admit_from(feed, window, block=not run.ready and not dispatcher.in_flight)
+            if run.cancelled():
+                run.cancel_queued(feed.discard())
+                break
+            if not run.ready and not dispatcher.in_flight:
+                if feed.exhausted:
+                    break
+                continue
+            dispatcher.step()
+        dispatcher.wind_down()
+        if feed.error is not None:
+            run.log(f"Error listing input files: {feed.error}")
+    finally:
+        feed.close()
+        dispatcher.close()
@@ -0,0 +1,96 @@
+"""
+Start-up and throughput benchmark for CommentPdfFromExcel.
+
+Usage:
+    python -m commentpdf.bench [--repeat 5] [--excel tags.xlsx --pdf drawing.pdf [--pdf ...]]
+
+Import times are measured in fresh interpreters (a warm interpreter would hide the cost) and
+reported as the median of --repeat runs, together with which heavy modules each import pulled in.
+With --excel and --pdf the tag sheet load and per-file annotation are timed as well.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules whose import cost we care about, in the order they are reported
+IMPORT_TARGETS = [
+    ("commentpdf", "package (lazy)"),
+    ("commentpdf.core", "engine"),
+    ("pdf_comment_from_excel", "GUI module"),
+    ("fitz", "PyMuPDF"),
+    ("pandas", "pandas"),
+]
+HEAVY_MODULES = ("fitz", "pandas", "numpy", "PIL", "tkinter")
+
+_IMPORT_PROBE = """
+import sys, time
+t = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t
+print(dt, ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def measure_import(module, repeat=5):
+    """Return (median seconds, heavy modules loaded) for importing module in a fresh interpreter."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    code = _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    times = []
+    loaded = ""
+    for _ in range(max(1, repeat)):
+        out = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", code],
+            capture_output=True, text=True, env=env, cwd=root,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(f"import {module} failed: {out.stderr.strip().splitlines()[-1:]}")
+        dt, _, loaded = out.stdout.strip().rpartition("\n")[2].partition(" ")
+        times.append(float(dt))
+    return statistics.median(times), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CommentPdfFromExcel start-up and annotation.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh-interpreter runs per import (median)")
+    parser.add_argument("--excel", default=None, help="Tag sheet to time loading/annotation with")
+    parser.add_argument("--pdf", action="append", default=[], help="PDF to annotate (repeatable)")
+    args = parser.parse_args(argv)
+
+    print("Import times (fresh interpreter, median of %d):" % args.repeat)
+    for module, label in IMPORT_TARGETS:
+        try:
+            seconds, loaded = measure_import(module, args.repeat)
+        except RuntimeError as e:
+            print(f"  {module:<24} {label:<16} unavailable ({e})")
+            continue
+        print(f"  {module:<24} {label:<16} {seconds * 1000:8.1f} ms   loads: {loaded or '-'}")
+
+    if not (args.excel and args.pdf):
+        return
+
+    from commentpdf.core import load_tag_sheet, update_pdf_with_comments
+
+    t = time.perf_counter()
+    df = load_tag_sheet(args.excel)
+    print(f"Tag sheet load: {(time.perf_counter() - t) * 1000:.1f} ms ({len(df)} tags)")
+
+    with tempfile.TemporaryDirectory(prefix="commentpdf_bench_") as tmp:
+        total = 0.0
+        for pdf in args.pdf:
+            out = os.path.join(tmp, os.path.basename(pdf))
+            t = time.perf_counter()
+            count = update_pdf_with_comments(pdf, df, out)
+            dt = time.perf_counter() - t
+            total += dt
+            print(f"Annotate {os.path.basename(pdf)}: {dt * 1000:.1f} ms ({count} annotations)")
+        print(f"Annotate total: {total * 1000:.1f} ms for {len(args.pdf)} file(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1900 @@
+"""
+Annotation engine for CommentPdfFromExcel: tag sheet loading, tag matching and freetext annotation.
+
+Only PyMuPDF is imported with this module. pandas is imported when a tag sheet is read, and Pillow
+only when a text measurement has to fall back to a TrueType font, so scripts and the service modes
+that just annotate start quickly and never load Tk.
+"""
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+_PIL_MODULES = None
+
+
+def load_pil():
+    """Import Pillow on first use; return (Image, ImageDraw, ImageFont), or None if it is not installed."""
+    global _PIL_MODULES
+    if _PIL_MODULES is None:
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+            _PIL_MODULES = (Image, ImageDraw, ImageFont)
+        except Exception:
+            _PIL_MODULES = False
+    return _PIL_MODULES or None
+
+
+def is_missing(value):
+    """pandas-free isna() for a tag sheet cell: None, NaN, NaT and pd.NA are missing."""
+    if value is None:
+        return True
+    try:
+        # NaN/NaT compare unequal to themselves; bool(pd.NA) raises
+        return bool(value != value)
+    except Exception:
+        return True
+
+
+# Map friendly font names to PDF "standard" font resource names and TTF candidates for preview/measurement
+PDF_FONT_MAP = {
+    "DejaVuSans": ("helv", ["DejaVuSans.ttf", "DejaVuSans.otf"]),
+    "Arial": ("helv", ["arial.ttf", "Arial.ttf"]),
+    "Times New Roman": ("times", ["Times New Roman.ttf", "Times_New_Roman.ttf", "Times.ttf"]),
+    "Courier": ("cour", ["Courier.ttf", "cour.ttf"]),
+}
+
+
+def compute_text_size_points(text, fontsize, ttf_candidates=None, pdf_fontname="helv"):
+    """
+    Return (width_pts, height_pts, ascent_pts, descent_pts) for the given text and font size.
+
+    Strategy:
+    1) Try fitz.get_text_length(text, fontsize, pdf_fontname) to get a width in points that
+       matches PyMuPDF annotation font metrics (best for annotation sizing).
+    2) If that's not available or fails, fall back to Pillow/TTF measurement (pixel==point at 72dpi).
+    3) Last resort: heuristic.
+
+    Adds a small safety multiplier to the measured width to avoid clipping in viewers that may slightly
+    vary metrics.
+    """
+    import fitz  # PyMuPDF
+
+    # 3) heuristic defaults (conservative estimates to avoid clipping)
+    approx_w = max(10.0, len(text) * (fontsize * 0.6))
+    approx_h = max(12.0, fontsize * 1.2)
+    # Typography conventions: ascent ≈ 0.8 of font size, descent ≈ 0.2
+    approx_ascent = fontsize * 0.8
+    approx_descent = fontsize * 0.2
+
+    # 1) try fitz.get_text_length with pdf_fontname (preferred)
+    try:
+        # fitz.get_text_length returns width in points for given fontsize and font name
+        # Correct parameter order: get_text_length(text, fontname, fontsize, encoding)
+        w = fitz.get_text_length(text, fontname=pdf_fontname, fontsize=fontsize)
+        if w and w > 0:
+            # add a safety margin (5%) to avoid clipping when viewer metrics differ slightly
+            w = float(w) * 1.05
+            h = float(max(12.0, fontsize * 1.2))
+            # Typography conventions: ascent ≈ 0.8 of font size, descent ≈ 0.2
+            ascent = fontsize * 0.8
+            descent = fontsize * 0.2
+            return float(w), h, ascent, descent
+    except Exception:
+        # not available or failed -> continue to Pillow fallback
+        pass
+
+    # 2) Pillow measurement (best-effort; assumes TTF available)
+    pil = load_pil()
+    if pil:
+        Image, ImageDraw, ImageFont = pil
+        font = None
+        if ttf_candidates:
+            for fn in ttf_candidates:
+                try:
+                    font = ImageFont.truetype(fn, size=int(fontsize))
+                    break
+                except Exception:
+                    font = None
+        if font is None:
+            try:
+                font = ImageFont.truetype("arial.ttf", size=int(fontsize))
+            except Exception:
+                try:
+                    font = ImageFont.truetype("Arial.ttf", size=int(fontsize))
+                except Exception:
+                    try:
+                        font = ImageFont.truetype("DejaVuSans.ttf", size=int(fontsize))
+                    except Exception:
+                        font = ImageFont.load_default()
+
+        try:
+            # create a temp image large enough to measure
+            img = Image.new("RGB", (4000, 800), (255, 255, 255))
+            draw = ImageDraw.Draw(img)
+            # use textbbox for accurate metrics
+            bbox = draw.textbbox((0, 0), text, font=font)
+            w_px = bbox[2] - bbox[0]
+            h_px = bbox[3] - bbox[1]
+            try:
+                ascent, descent = font.getmetrics()
+                ascent = float(ascent)
+                descent = float(descent)
+            except Exception:
+                ascent = h_px * 0.75
+                descent = h_px * 0.25
+            # safety margin
+            return float(w_px) * 1.05, float(h_px), ascent, descent
+        except Exception:
+            pass
+
+    # fallback heuristic
+    return approx_w, approx_h, approx_ascent, approx_descent
+
+
+# Optional per-row columns in the tag sheet that override the run-wide annotation settings
+OVERRIDE_COLUMNS = ("subject", "color", "distance", "font", "font_size")
+COLUMN_ALIASES = {"colour": "color", "fontsize": "font_size", "size": "font_size", "font_family": "font"}
+
+DEFAULT_FILL_COLOR = (1, 1, 0)
+NAMED_COLORS = {
+    "yellow": (1, 1, 0),
+    "red": (1, 0, 0),
+    "green": (0, 1, 0),
+    "blue": (0, 0, 1),
+    "cyan": (0, 1, 1),
+    "magenta": (1, 0, 1),
+    "orange": (1, 0.65, 0),
+    "pink": (1, 0.75, 0.8),
+    "white": (1, 1, 1),
+    "lightgreen": (0.56, 0.93, 0.56),
+    "lightblue": (0.68, 0.85, 0.9),
+    "grey": (0.75, 0.75, 0.75),
+    "gray": (0.75, 0.75, 0.75),
+}
+
+
+def parse_color(value):
+    """
+    Return an (r, g, b) tuple with components in 0..1, or None if value is not a colour.
+
+    Accepts a name from NAMED_COLORS, '#RRGGBB', or 'r,g,b' with components either in 0..1 or 0..255.
+    """
+    text = str(value).strip().lower()
+    if text in NAMED_COLORS:
+        return NAMED_COLORS[text]
+    if re.fullmatch(r"#[0-9a-f]{6}", text):
+        return tuple(int(text[i: i + 2], 16) / 255.0 for i in (1, 3, 5))
+    parts = [p.strip() for p in text.split(",")]
+    if len(parts) == 3:
+        try:
+            nums = [float(p) for p in parts]
+        except ValueError:
+            return None
+        if any(n < 0 for n in nums):
+            return None
+        if all(n <= 1 for n in nums):
+            return tuple(nums)
+        if all(n <= 255 for n in nums):
+            return tuple(n / 255.0 for n in nums)
+    return None
+
+
+def row_annotation_settings(row, subject, distance, font_family, font_size):
+    """
+    Return (subject, distance, font_family, font_size, fill_color) for one tag row: the run-wide
+    values with any non-empty override columns from the row applied (see load_tag_sheet).
+    """
+    def override(col, default):
+        value = row.get(col)
+        if is_missing(value):
+            return default
+        return value
+
+    return (
+        override("subject", subject),
+        override("distance", distance),
+        override("font", font_family),
+        override("font_size", font_size),
+        override("color", DEFAULT_FILL_COLOR),
+    )
+
+
+# /NM (annotation name) prefix marking annotations created by this tool
+ANNOT_NAME_PREFIX = "commentpdf:"
+
+
+def annotation_id(page_num, tag, comment, tag_rect, occurrence=0, scope=None):
+    """
+    Stable ID of the annotation for one tag hit: a hash of tag, comment and position. scope
+    (e.g. a profile name) keeps the IDs of several tag sheets in one document apart.
+    """
+    import fitz  # PyMuPDF
+
+    r = fitz.Rect(tag_rect)
+    key = f"{tag}\x1f{comment}\x1f{page_num}\x1f{r.x0:.1f},{r.y0:.1f},{r.x1:.1f},{r.y1:.1f}\x1f{occurrence}"
+    if scope:
+        key = f"{scope}\x1e{key}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def annotation_fingerprint(spec):
+    """Short hash of the parts of an annotation not covered by its ID (box, style, subject)."""
+    import fitz  # PyMuPDF
+
+    r = fitz.Rect(spec["rect"])
+    parts = [
+        f"{r.x0:.2f},{r.y0:.2f},{r.x1:.2f},{r.y1:.2f}",
+        spec["content"],
+        spec["subject"],
+        spec["pdf_fontname"],
+        f"{float(spec['font_size']):g}",
+    ]
+    parts += [",".join(f"{float(c):.3f}" for c in spec[k]) for k in ("text_color", "fill_color", "border_color")]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def annotation_name(spec):
+    """The /NM value stored on a tool annotation: '<prefix><id>:<fingerprint>'."""
+    return f"{ANNOT_NAME_PREFIX}{spec['annot_id']}:{annotation_fingerprint(spec)}"
+
+
+def parse_annotation_name(name):
+    """Return (annot_id, fingerprint) from a tool annotation's /NM value, or None for other annotations."""
+    if not name or not name.startswith(ANNOT_NAME_PREFIX):
+        return None
+    annot_id, sep, fingerprint = name[len(ANNOT_NAME_PREFIX):].partition(":")
+    if not sep or not annot_id:
+        return None
+    return annot_id, fingerprint
+
+
+# ---------- Tag matching and annotation placement ----------
+# search_for's default flags; a TextPage shared between searches must be built with the same ones.
+# TEXT_DEHYPHENATE | TEXT_PRESERVE_WHITESPACE | TEXT_PRESERVE_LIGATURES | TEXT_MEDIABOX_CLIP, spelled
+# out so importing this module does not load PyMuPDF.
+SEARCH_FLAGS = 16 | 2 | 1 | 64
+
+
+class PageText:
+    """
+    The text of one page, extracted once and shared by every tag matched against it (and by
+    every profile, see commentpdf.profiles): the plain text, its lower-case form, and one TextPage
+    for all searches, whose results are remembered per search string.
+
+    Text extraction includes the appearance text of annotations, so this tool's own annotations
+    (from an earlier run on a '_marked' PDF) are hidden while the text and the TextPage are
+    built; otherwise a comment that mentions its tag would be annotated again on every run.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self._textpage = None
+        hidden = _hide_tool_annotations(page)
+        try:
+            self.text = page.get_text("text")
+            if hidden:
+                # searches go through this TextPage, so they do not see the annotations either
+                self._textpage = page.get_textpage(flags=SEARCH_FLAGS)
+        finally:
+            for xref, flags in hidden:
+                page.parent.xref_set_key(xref, "F", str(flags))
+        self._lower = None
+        self._found = {}
+
+    @property
+    def lower(self):
+        if self._lower is None:
+            self._lower = self.text.lower()
+        return self._lower
+
+    def search_for(self, needle):
+        """page.search_for(needle), searched at most once per page."""
+        found = self._found.get(needle)
+        if found is None:
+            if self._textpage is None:
+                self._textpage = self.page.get_textpage(flags=SEARCH_FLAGS)
+            found = self._found[needle] = self.page.search_for(needle, textpage=self._textpage)
+        return list(found)
+
+
+def _hide_tool_annotations(page):
+    """
+    Set the Hidden flag on the annotations this tool created on page; return [(xref, old flags)].
+    The /F key is written directly: Annot.set_flags would make MuPDF regenerate the appearance.
+    """
+    import fitz  # PyMuPDF
+
+    if page.first_annot is None:
+        return []
+    hidden = []
+    for annot in page.annots(types=[fitz.PDF_ANNOT_FREE_TEXT]):
+        if parse_annotation_name(annot.info.get("id", "")):
+            hidden.append((annot.xref, annot.flags))
+            page.parent.xref_set_key(annot.xref, "F", str(annot.flags | fitz.PDF_ANNOT_IS_HIDDEN))
+    return hidden
+
+
+def find_tag_rects(
+    page,
+    page_text,
+    tag,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    log_func=None,
+    stats=None,
+    text_index=None,
+):
+    """
+    Return the rects of every match of tag on page (best-effort: regex and whole-word matches are
+    found in page_text and then located with search_for). Invalid regexes are logged and yield none.
+    Matches that cannot be located are logged and counted in stats["unmapped"] (see
+    commentpdf.metrics.new_file_stats).
+    text_index: a PageText of page whose lower-case text and searches are reused.
+    """
+    rects = []
+    search_for = text_index.search_for if text_index is not None else page.search_for
+
+    if use_regex:
+        try:
+            flags = 0 if case_sensitive else re.IGNORECASE
+            pattern = re.compile(tag, flags)
+        except re.error as rex:
+            if log_func:
+                log_func(f"  Invalid regex for tag '{tag}': {rex}")
+            # skip this tag
+            return rects
+
+        for m in pattern.finditer(page_text):
+            match_text = m.group(0)
+            found = search_for(match_text)
+            if not found and not case_sensitive:
+                # Try common case variants as best-effort
+                for cand in {match_text.lower(), match_text.upper(), match_text.title()}:
+                    found = search_for(cand)
+                    if found:
+                        break
+            if not found:
+                if stats is not None:
+                    stats["unmapped"] += 1
+                if log_func:
+                    log_func(f"  Warning: regex match '{match_text}' could not be mapped to page coordinates.")
+                continue
+            rects.extend(found)
+
+    elif whole_word:
+        flags = 0 if case_sensitive else re.IGNORECASE
+        pattern = re.compile(r"\b" + re.escape(tag) + r"\b", flags)
+        for m in pattern.finditer(page_text):
+            matched_text = page_text[m.start(): m.end()]
+            found = search_for(matched_text)
+            if not found and not case_sensitive:
+                for cand in {matched_text.lower(), matched_text.upper(), matched_text.title()}:
+                    found = search_for(cand)
+                    if found:
+                        break
+            if not found:
+                if stats is not None:
+                    stats["unmapped"] += 1
+                if log_func:
+                    log_func(f"  Warning: whole-word match '{matched_text}' could not be mapped to page coordinates.")
+                continue
+            rects.extend(found)
+
+    else:
+        # simple containment (respect case option for detection)
+        if case_sensitive:
+            if tag not in page_text:
+                return rects
+        else:
+            if tag.lower() not in (text_index.lower if text_index is not None else page_text.lower()):
+                return rects
+
+        # Try direct search_for using the literal tag first
+        found = search_for(tag)
+        if not found and not case_sensitive:
+            # Try some common variants as a best-effort
+            for cand in {tag.lower(), tag.upper(), tag.title()}:
+                found = search_for(cand)
+                if found:
+                    break
+        if not found:
+            if stats is not None:
+                stats["unmapped"] += 1
+            if log_func:
+                log_func(f"  Warning: tag '{tag}' found in page text but could not find coordinates (search_for returned empty).")
+            return rects
+        rects.extend(found)
+
+    return rects
+
+
+# Baseline-to-baseline distance of wrapped lines, as PyMuPDF lays out freetext appearances
+LINE_SPACING = 1.2
+# Safety margin on measured widths (the same 5% compute_text_size_points adds)
+WIDTH_SAFETY = 1.05
+
+
+@functools.lru_cache(maxsize=None)
+def _glyph_advance(pdf_fontname, char):
+    """Advance width of char at font size 1 (cached: a tag sheet uses a small alphabet)."""
+    import fitz  # PyMuPDF
+
+    try:
+        return float(fitz.get_text_length(char, fontname=pdf_fontname, fontsize=1))
+    except Exception:
+        return 0.6
+
+
+def text_width_points(text, fontsize, pdf_fontname="helv"):
+    """Width of text in points from cached glyph advances, with the usual safety margin."""
+    return sum(_glyph_advance(pdf_fontname, c) for c in text) * fontsize * WIDTH_SAFETY
+
+
+@functools.lru_cache(maxsize=8192)
+def wrap_comment(comment, pdf_fontname, font_size, max_width):
+    """
+    Break comment into lines no wider than max_width points (greedy first-fit on words; a word
+    longer than a line is split between characters, explicit newlines are kept).
+
+    Returns (lines, widest line width). Memoized per (comment, font, size, width), so a comment
+    repeated on thousands of hits is laid out once.
+    """
+    space = text_width_points(" ", font_size, pdf_fontname)
+    lines = []
+    widest = 0.0
+    for paragraph in comment.split("\n"):
+        line, line_w = "", 0.0
+        for word in paragraph.split():
+            word_w = text_width_points(word, font_size, pdf_fontname)
+            if line and line_w + space + word_w <= max_width:
+                line, line_w = f"{line} {word}", line_w + space + word_w
+                continue
+            if line:
+                lines.append(line)
+                widest = max(widest, line_w)
+            line, line_w = word, word_w
+            # hard-break words that do not fit on a line of their own
+            while line_w > max_width and len(line) > 1:
+                cut, cut_w = 1, _glyph_advance(pdf_fontname, line[0]) * font_size * WIDTH_SAFETY
+                while cut < len(line):
+                    char_w = _glyph_advance(pdf_fontname, line[cut]) * font_size * WIDTH_SAFETY
+                    if cut_w + char_w > max_width:
+                        break
+                    cut, cut_w = cut + 1, cut_w + char_w
+                lines.append(line[:cut])
+                widest = max(widest, cut_w)
+                line = line[cut:]
+                line_w = text_width_points(line, font_size, pdf_fontname)
+        lines.append(line)
+        widest = max(widest, line_w)
+    return tuple(lines), widest
+
+
+def annotation_box_size(
+    comment, font_size, ttf_candidates=None, pdf_fontname="helv", wrap_width=None, text_width=None
+):
+    """
+    Return (width, height, lines) in points of the freetext box for comment, padding included.
+
+    By default the box fits the comment on one line. With wrap_width, a comment whose box would
+    be wider is wrapped (see wrap_comment) so the box is at most wrap_width wide and tall enough
+    for every line. lines is the text layout drawn by previews.
+    text_width: the comment's width at font_size, margin included, when already known (e.g.
+    from a compiled tag index); it replaces the measurement by compute_text_size_points.
+    """
+    if text_width:
+        text_w_pts, text_h_pts = text_width, max(12.0, font_size * 1.2)
+        ascent_pts, descent_pts = font_size * 0.8, font_size * 0.2
+    else:
+        text_w_pts, text_h_pts, ascent_pts, descent_pts = compute_text_size_points(
+            comment, font_size, ttf_candidates, pdf_fontname
+        )
+    padding_x = max(8.0, font_size * 0.5)
+    padding_y = max(4.0, font_size * 0.25)
+
+    width = text_w_pts + 2.0 * padding_x
+    measured_text_height = ascent_pts + descent_pts if (ascent_pts and descent_pts) else text_h_pts
+    lines = (comment,)
+    if wrap_width and (width > wrap_width or "\n" in comment):
+        lines, widest = wrap_comment(comment, pdf_fontname, font_size, max(1.0, wrap_width - 2.0 * padding_x))
+        if len(lines) > 1:
+            width = widest + 2.0 * padding_x
+            measured_text_height += (len(lines) - 1) * font_size * LINE_SPACING
+        else:
+            lines = (comment,)
+    height = max(12.0, measured_text_height + 2.0 * padding_y)
+    return width, height, lines
+
+
+def place_annotation_boxes(hit_rects, widths, heights, distances, page_rect):
+    """
+    Compute the annotation box for every hit on a page in one vectorized pass and return a list of
+    (x0, y0, x1, y1) tuples.
+
+    Each box goes distance points right of its hit, or left of it when it would cross the right
+    margin (clamped to the left margin), vertically centred on the hit and kept 5 points inside
+    the page. hit_rects is a sequence of rects; widths, heights and distances are per hit.
+    The arithmetic is the same sequence of float64 operations as the scalar formulation, so
+    the results are bit-for-bit identical to placing each box on its own.
+    """
+    import numpy as np
+
+    inst = np.asarray([tuple(r) for r in hit_rects], dtype=np.float64).reshape(-1, 4)
+    if not len(inst):
+        return []
+    width = np.asarray(widths, dtype=np.float64)
+    height = np.asarray(heights, dtype=np.float64)
+    dist = np.asarray(distances, dtype=np.float64)
+    left_margin = float(page_rect.x0) + 5
+    right_margin = float(page_rect.x1) - 5
+    top_margin = float(page_rect.y0) + 5
+    bottom_margin = float(page_rect.y1) - 5
+
+    # horizontal: prefer the right side, else the left side clamped to the left margin
+    pref_x0 = inst[:, 2] + dist
+    pref_x1 = pref_x0 + width
+    fits_right = pref_x1 <= right_margin
+    alt_x1 = inst[:, 0] - dist
+    alt_x0 = alt_x1 - width
+    clamp_left = alt_x0 < left_margin
+    alt_x1 = np.where(clamp_left, np.minimum(right_margin, left_margin + width), alt_x1)
+    alt_x0 = np.where(clamp_left, left_margin, alt_x0)
+    x0 = np.where(fits_right, pref_x0, alt_x0)
+    x1 = np.where(fits_right, pref_x1, alt_x1)
+
+    # vertical: centred on the hit, pushed inside the top margin, then the bottom one
+    inst_mid = (inst[:, 1] + inst[:, 3]) / 2.0
+    y0 = inst_mid - (height / 2.0)
+    y1 = y0 + height
+    above = y0 < top_margin
+    y0 = np.where(above, top_margin, y0)
+    y1 = np.where(above, y0 + height, y1)
+    below = y1 > bottom_margin
+    y1 = np.where(below, bottom_margin, y1)
+    y0 = np.where(below, y1 - height, y0)
+    y0 = np.where(below & (y0 < top_margin), top_margin, y0)
+
+    return list(zip(x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist()))
+
+
+def match_page_rows(
+    page, df, case_sensitive=False, whole_word=False, use_regex=False, log_func=None, stats=None, text_index=None
+):
+    """
+    Match every tag row against page. Returns [(row, tag, comment, rects), ...] in sheet-row
+    order for the rows that matched. This is the expensive half of collect_page_hits and does not
+    depend on any placement option, so callers may cache it per page.
+    text_index: the page's PageText, to share its extraction with other tag sheets; by default
+    one is made for this call.
+    """
+    if text_index is None:
+        text_index = PageText(page)
+    page_text = text_index.text
+    matches = []
+
+    if not use_regex and hasattr(df, "iter_candidate_rows"):
+        # a compiled tag index (commentpdf.tagindex) skips the tags that cannot occur on this page
+        rows = df.iter_candidate_rows(page_text)
+    else:
+        rows = df.iterrows()
+    for index, row in rows:
+        tag = str(row["tag"]) if not is_missing(row["tag"]) else ""
+        comment = str(row["comment"]) if not is_missing(row["comment"]) else ""
+
+        if not tag or tag.strip() == "":
+            continue
+
+        rects = find_tag_rects(
+            page, page_text, tag, case_sensitive, whole_word, use_regex, log_func, stats, text_index
+        )
+        if rects:
+            matches.append((row, tag, comment, rects))
+    return matches
+
+
+def layout_page_hits(
+    matches,
+    page_rect,
+    subject="Comment",
+    distance=10,
+    font_family="Arial",
+    font_size=12,
+    measure_fontname=None,
+    wrap_width=None,
+):
+    """
+    Place the annotation boxes for a page's matches (see match_page_rows) in one batch.
+    Returns (hits, boxes) as described for collect_page_hits.
+    """
+    hits = []
+    widths = []
+    heights = []
+    distances = []
+
+    for row, tag, comment, rects in matches:
+        # Per-row overrides from the tag sheet (subject, colour, distance, font, size)
+        row_subject, row_distance, row_font_family, row_font_size, row_fill = row_annotation_settings(
+            row, subject, distance, font_family, font_size
+        )
+        # Map to PDF font resource and ttf candidates for measurement/preview
+        pdf_fontname, ttf_candidates = PDF_FONT_MAP.get(
+            row_font_family, ("helv", ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf"])
+        )
+
+        # one comment per row, so it is measured once however many times the tag occurs
+        # (rows of a compiled tag index carry the width already)
+        fontname = measure_fontname or pdf_fontname
+        text_width = row.text_width(fontname, row_font_size) if hasattr(row, "text_width") else None
+        width, height, lines = annotation_box_size(
+            comment, row_font_size, ttf_candidates, fontname, wrap_width, text_width
+        )
+        info = {
+            "tag": tag,
+            "comment": comment,
+            "subject": row_subject,
+            "font_family": row_font_family,
+            "pdf_fontname": pdf_fontname,
+            "font_size": row_font_size,
+            "fill_color": row_fill,
+            "lines": lines,
+        }
+        for inst in rects:
+            hits.append((inst, info))
+            widths.append(width)
+            heights.append(height)
+            distances.append(row_distance)
+
+    if not hits:
+        return hits, []
+    boxes = place_annotation_boxes([inst for inst, _ in hits], widths, heights, distances, page_rect)
+    return hits, boxes
+
+
+def collect_page_hits(
+    page,
+    df,
+    subject="Comment",
+    distance=10,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    log_func=None,
+    measure_fontname=None,
+    wrap_width=None,
+    stats=None,
+    text_index=None,
+):
+    """
+    Match every tag row against page and place all annotation boxes for the page in one batch.
+
+    Returns (hits, boxes): hits is a list of (tag rect, info) in sheet-row then match order, where
+    info holds tag, comment, subject, font_family, pdf_fontname, font_size and fill_color after
+    the row's overrides plus the comment's line layout ('lines'); boxes holds the matching
+    (x0, y0, x1, y1) annotation boxes.
+    measure_fontname: measure comments with this PDF font instead of the row's font.
+    wrap_width: wrap comments into boxes at most this wide (see annotation_box_size).
+    stats: per-file counters (see commentpdf.metrics.new_file_stats).
+    text_index: the page's PageText (see match_page_rows).
+    """
+    matches = match_page_rows(page, df, case_sensitive, whole_word, use_regex, log_func, stats, text_index)
+    return layout_page_hits(
+        matches, page.rect, subject, distance, font_family, font_size, measure_fontname, wrap_width
+    )
+
+
+def iter_freetext_annotations(
+    doc,
+    df,
+    subject="Comment",
+    distance=10,
+    log_func=None,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    cancel_event=None,
+    wrap_width=None,
+    stats=None,
+):
+    """
+    Match the tag sheet against every page of an open document and yield (page, spec) for each
+    freetext annotation that update_pdf_with_comments would add, without modifying the document.
+
+    spec keys: page (0-based), annot_id (see annotation_id), rect (fitz.Rect, page coordinates),
+    content, tag, subject, font_family, pdf_fontname, font_size, text_color, fill_color, border_color,
+    lines (the wrapped layout of content; see annotation_box_size).
+    Matching options are the same as for update_pdf_with_comments. When cancel_event (a
+    threading.Event) is set, ProcessingCancelled is raised before the next page.
+    stats: per-file counters (see commentpdf.metrics.new_file_stats) updated with the pages
+    scanned, the hits per tag and the matches that could not be located.
+    """
+    for page_num in range(len(doc)):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ProcessingCancelled()
+        page = doc[page_num]
+        hits, boxes = collect_page_hits(
+            page, df, subject, distance, font_family, font_size, case_sensitive, whole_word, use_regex, log_func,
+            wrap_width=wrap_width, stats=stats,
+        )
+        if stats is not None:
+            stats["pages"] += 1
+            stats["hits"].update(hit["tag"] for _, hit in hits)
+        for spec in page_annotation_specs(page_num, hits, boxes):
+            yield page, spec
+
+
+def page_annotation_specs(page_num, hits, boxes, scope=None):
+    """
+    Turn a page's (hits, boxes) from collect_page_hits into annotation specs (see
+    iter_freetext_annotations); scope is passed on to annotation_id.
+    """
+    import fitz  # PyMuPDF
+
+    specs = []
+    # identical (tag, comment, position) hits on a page get distinct IDs by occurrence
+    hit_counts = {}
+    for (inst, hit), box in zip(hits, boxes):
+        tag, comment = hit["tag"], hit["comment"]
+        hit_key = (tag, comment, round(inst.x0, 1), round(inst.y0, 1), round(inst.x1, 1), round(inst.y1, 1))
+        occurrence = hit_counts.get(hit_key, 0)
+        hit_counts[hit_key] = occurrence + 1
+
+        specs.append({
+            "page": page_num,
+            "annot_id": annotation_id(page_num, tag, comment, inst, occurrence, scope),
+            "rect": fitz.Rect(box),
+            "content": comment,
+            "tag": tag,
+            "subject": hit["subject"],
+            "font_family": hit["font_family"],
+            "pdf_fontname": hit["pdf_fontname"],
+            "font_size": hit["font_size"],
+            "text_color": (0, 0, 0),
+            "fill_color": hit["fill_color"],
+            "border_color": (0, 0, 0),
+            "lines": hit["lines"],
+        })
+    return specs
+
+
+def add_freetext_annotation(page, spec):
+    """Create the freetext annotation described by spec (see iter_freetext_annotations) on page."""
+    import fitz  # PyMuPDF
+
+    options = {
+        "fontsize": spec["font_size"],
+        "text_color": spec["text_color"],
+        "fill_color": spec["fill_color"],
+        "rotate": 0,
+        "align": fitz.TEXT_ALIGN_LEFT,
+    }
+    try:
+        annot = page.add_freetext_annot(spec["rect"], spec["content"], fontname=spec["pdf_fontname"], **options)
+    except Exception:
+        # not a Base-14 font name PyMuPDF knows
+        annot = page.add_freetext_annot(spec["rect"], spec["content"], fontname="helv", **options)
+
+    try:
+        annot.set_border(width=0.5, dashes=[2])
+    except Exception:
+        pass
+    try:
+        annot.set_colors(stroke=spec["border_color"], fill=spec["fill_color"])
+    except Exception:
+        pass
+    try:
+        annot.set_info({"subject": spec["subject"]})
+    except Exception:
+        pass
+
+    annot.update()
+
+    if spec.get("annot_id"):
+        # /NM carries the stable ID so a later run can recognise (and keep/replace) this annotation
+        page.parent.xref_set_key(annot.xref, "NM", fitz.get_pdf_str(annotation_name(spec)))
+    return annot
+
+
+class AnnotationReconciler:
+    """
+    Add annotation specs to a document, reusing what an earlier run of this tool left there.
+
+    Annotations created by add_freetext_annotation carry '/NM commentpdf:<id>:<fingerprint>'. For a
+    spec whose ID already exists on the page the old annotation is kept when the fingerprint matches
+    and replaced otherwise; after the last spec, finish() deletes tool annotations that no longer
+    correspond to a hit. Annotations from other tools or people are never touched, so re-running on
+    a '_marked' PDF costs O(changes) instead of duplicating every annotation.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        # fresh inputs have no annotations at all: skip indexing entirely
+        self.check_existing = bool(doc.has_annots())
+        self._existing = {}  # page number -> {annot_id: (name, fingerprint)}
+        self.added = 0
+        self.updated = 0
+        self.kept = 0
+        self.deleted = 0
+
+    @property
+    def total(self):
+        return self.added + self.updated + self.kept
+
+    def _index(self, page):
+        import fitz  # PyMuPDF
+
+        idx = self._existing.get(page.number)
+        if idx is None:
+            idx = {}
+            if self.check_existing:
+                for annot in page.annots(types=[fitz.PDF_ANNOT_FREE_TEXT]):
+                    name = annot.info.get("id", "")
+                    parsed = parse_annotation_name(name)
+                    if parsed:
+                        idx[parsed[0]] = (name, parsed[1])
+            self._existing[page.number] = idx
+        return idx
+
+    def apply(self, page, spec):
+        """Add, keep or replace the annotation for spec; return "added", "kept" or "updated"."""
+        old = self._index(page).pop(spec.get("annot_id"), None)
+        if old is None:
+            add_freetext_annotation(page, spec)
+            self.added += 1
+            return "added"
+        if old[1] == annotation_fingerprint(spec):
+            self.kept += 1
+            return "kept"
+        annot = page.load_annot(old[0])
+        if annot is not None:
+            page.delete_annot(annot)
+        add_freetext_annotation(page, spec)
+        self.updated += 1
+        return "updated"
+
+    def save_options(self):
+        """doc.save options: drop the objects of replaced/deleted annotations so re-runs do not grow the file."""
+        return {"garbage": 1 if (self.updated or self.deleted) else 0}
+
+    def finish(self):
+        """Delete tool annotations whose tag hit no longer exists; return how many were deleted."""
+        if not self.check_existing:
+            return 0
+        for page_num in range(len(self.doc)):
+            idx = self._existing.get(page_num)
+            page = None
+            if idx is None:
+                page = self.doc[page_num]
+                idx = self._index(page)
+            if not idx:
+                continue
+            page = page or self.doc[page_num]
+            for name, _ in idx.values():
+                annot = page.load_annot(name)
+                if annot is not None:
+                    page.delete_annot(annot)
+                    self.deleted += 1
+            idx.clear()
+        return self.deleted
+
+
+class ProcessingCancelled(Exception):
+    """Raised when a batch's cancel_event is set while a file is being processed."""
+
+
+def save_pdf_atomic(doc, output_pdf_path, part_suffix=".part", **save_options):
+    """
+    Save doc to output_pdf_path via a '.part' file in the same folder and an atomic rename, so
+    readers never see a half-written PDF (this also allows overwriting the input file itself).
+    Writers that may save the same output concurrently pass their own part_suffix.
+    """
+    tmp_path = output_pdf_path + part_suffix
+    try:
+        doc.save(tmp_path, **save_options)
+        os.replace(tmp_path, output_pdf_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def link_or_copy_output(source_path, output_path, link=True, expected_sha256=None):
+    """
+    Make output_path an identical copy of source_path: a hard link when link is True and the
+    filesystem allows it, else a copy, via a '.part' file and an atomic rename. With
+    expected_sha256 the new file is checked before it is renamed into place; on a mismatch
+    nothing is written and False is returned.
+    """
+    if os.path.exists(output_path) and os.path.samefile(source_path, output_path):
+        return expected_sha256 is None or file_sha256(output_path) == expected_sha256
+    tmp_path = output_path + ".part"
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        linked = False
+        if link:
+            try:
+                os.link(source_path, tmp_path)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copyfile(source_path, tmp_path)
+        if expected_sha256 is not None and file_sha256(tmp_path) != expected_sha256:
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, output_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def update_pdf_with_comments(
+    pdf_path,
+    df,
+    output_pdf_path,
+    subject="Comment",
+    distance=10,
+    log_func=None,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    cancel_event=None,
+    wrap_width=None,
+    stats=None,
+    part_suffix=".part",
+):
+    """
+    Create freetext annotations (editable) and size them to the measured text metrics
+    so the box fits the entire comment horizontally. With wrap_width (points), comments that
+    would need a wider box are wrapped onto several lines instead (see annotation_box_size).
+
+    Matching options:
+      - case_sensitive: when False (default) matching is case-insensitive
+      - whole_word: when True use word-boundary matching
+      - use_regex: when True interpret tag as a regular expression
+
+    Re-running on an already annotated PDF (e.g. a '_marked' output) does not duplicate anything:
+    annotations created by an earlier run are kept, replaced or deleted (see AnnotationReconciler).
+
+    The output is written to a temporary '.part' file (output_pdf_path + part_suffix) and renamed
+    into place, so an interrupted run never leaves a partial PDF. Setting cancel_event (threading.Event) stops at the next page
+    and raises ProcessingCancelled without writing anything.
+    stats: per-file counters for run metrics (see commentpdf.metrics.new_file_stats).
+
+    Returns the number of tool annotations in the output, or None when the PDF could not be
+    opened or saved.
+    """
+    import fitz  # PyMuPDF
+
+    if log_func:
+        log_func(f"Processing: {os.path.basename(pdf_path)}")
+
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        if log_func:
+            log_func(f"  Error opening PDF: {e}")
+        return
+
+    try:
+        return annotate_and_save(
+            doc,
+            iter_freetext_annotations(
+                doc,
+                df,
+                subject=subject,
+                distance=distance,
+                log_func=log_func,
+                font_family=font_family,
+                font_size=font_size,
+                case_sensitive=case_sensitive,
+                whole_word=whole_word,
+                use_regex=use_regex,
+                cancel_event=cancel_event,
+                wrap_width=wrap_width,
+                stats=stats,
+            ),
+            output_pdf_path,
+            log_func,
+            part_suffix,
+        )
+    finally:
+        doc.close()
+
+
+def apply_annotation_specs(doc, page_specs, log_func=None):
+    """
+    Add (page, spec) pairs from page_specs to doc, reconciling them with annotations of an earlier
+    run, and delete the tool annotations that no longer match. ProcessingCancelled raised by
+    page_specs is passed on. Returns the AnnotationReconciler with the counts.
+    """
+    reconciler = AnnotationReconciler(doc)
+    for page, spec in page_specs:
+        rect = spec["rect"]
+        try:
+            action = reconciler.apply(page, spec)
+            if log_func and action != "kept":
+                log_func(
+                    f"  {action.capitalize()} freetext annot on page {spec['page']+1} at {rect} "
+                    f"(font={spec['font_family']}, size={spec['font_size']})"
+                )
+        except Exception as e:
+            if log_func:
+                log_func(f"  Error creating freetext annot at {rect}: {e}")
+
+    try:
+        reconciler.finish()
+    except Exception as e:
+        if log_func:
+            log_func(f"  Error removing outdated annotations: {e}")
+    if log_func and reconciler.check_existing:
+        log_func(
+            f"  Existing annotations: kept {reconciler.kept}, updated {reconciler.updated}, "
+            f"deleted {reconciler.deleted}"
+        )
+    return reconciler
+
+
+def annotate_and_save(doc, page_specs, output_pdf_path, log_func=None, part_suffix=".part"):
+    """
+    Add (page, spec) pairs from page_specs to doc (see apply_annotation_specs) and save doc
+    atomically to output_pdf_path (see save_pdf_atomic). doc is left open. ProcessingCancelled raised by page_specs is
+    passed on before anything is written.
+    Returns the number of tool annotations in the output, or None when it could not be saved.
+    """
+    reconciler = apply_annotation_specs(doc, page_specs, log_func)
+    try:
+        save_pdf_atomic(doc, output_pdf_path, part_suffix, **reconciler.save_options())
+    except Exception as e:
+        if log_func:
+            log_func(f"  Error saving PDF: {e}")
+        return
+
+    if log_func:
+        log_func(f"Saved: {os.path.basename(output_pdf_path)} (Total annotations: {reconciler.total})")
+    return reconciler.total
+
+
+# PyMuPDF is not thread-safe; annotate_pdf_bytes holds this while it uses it
+_MUPDF_LOCK = threading.RLock()
+
+
+def _pdf_stream(pdf):
+    """
+    Return (stream for fitz.open, memoryview to release afterwards or None). bytes and readable
+    buffers are used in place; other file-like objects are read.
+    """
+    if isinstance(pdf, bytes):
+        return pdf, None
+    if hasattr(pdf, "getbuffer"):
+        # io.BytesIO: its buffer, without the copy getvalue() would make
+        pdf = pdf.getbuffer()
+    elif hasattr(pdf, "read"):
+        return pdf.read(), None
+    view = memoryview(pdf)
+    if not view.c_contiguous:
+        data = view.tobytes()
+        view.release()
+        return data, None
+    if view.format != "B" or view.ndim != 1:
+        flat = view.cast("B")
+        view.release()
+        view = flat
+    return view, view
+
+
+def annotate_pdf_bytes(
+    pdf,
+    tag_plan,
+    subject="Comment",
+    distance=10,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    wrap_width=None,
+    log_func=None,
+    cancel_event=None,
+    output=None,
+):
+    """
+    Annotate a PDF held in memory, without temporary files: the in-memory counterpart of
+    update_pdf_with_comments, with the same options.
+
+    pdf: bytes, any buffer (bytearray, memoryview, mmap, ...) or a binary file-like object.
+    Bytes, buffers and io.BytesIO are opened in place (they must not change during the call);
+    other file-like objects are read once.
+    tag_plan: a tag sheet from load_tag_sheet, preferably passed through prepare_tag_plan once
+    and reused for every document.
+    output: a writable binary file object to save into instead of returning the bytes.
+
+    Returns (pdf_bytes, result); pdf_bytes is None when output is given. result holds
+    annotations (tool annotations in the output), added/kept/updated/deleted (when the input was
+    already annotated), pages, hits (page (1-based), tag, comment and annotation rect of each
+    hit), hits_per_tag, unmapped (matches that could not be located on the page) and timings
+    (seconds for open, match, annotate, save and total).
+    Raises ValueError when the PDF cannot be opened or saved, and ProcessingCancelled when
+    cancel_event is set.
+
+    Safe to call from several threads: the PyMuPDF work is serialized (PyMuPDF is not
+    thread-safe), so use worker processes to annotate documents in parallel.
+    """
+    import fitz  # PyMuPDF
+
+    from commentpdf.metrics import new_file_stats
+
+    started = time.perf_counter()
+    timings = {}
+    stats = new_file_stats()
+    stream, view = _pdf_stream(pdf)
+    try:
+        with _MUPDF_LOCK:
+            mark = time.perf_counter()
+            try:
+                doc = fitz.open(stream=stream, filetype="pdf")
+            except Exception as e:
+                raise ValueError(f"Could not open PDF: {e}")
+            timings["open"] = time.perf_counter() - mark
+            try:
+                mark = time.perf_counter()
+                page_specs = list(iter_freetext_annotations(
+                    doc,
+                    tag_plan,
+                    subject=subject,
+                    distance=distance,
+                    log_func=log_func,
+                    font_family=font_family,
+                    font_size=font_size,
+                    case_sensitive=case_sensitive,
+                    whole_word=whole_word,
+                    use_regex=use_regex,
+                    cancel_event=cancel_event,
+                    wrap_width=wrap_width,
+                    stats=stats,
+                ))
+                timings["match"] = time.perf_counter() - mark
+
+                mark = time.perf_counter()
+                reconciler = apply_annotation_specs(doc, page_specs, log_func)
+                timings["annotate"] = time.perf_counter() - mark
+
+                mark = time.perf_counter()
+                try:
+                    if output is not None:
+                        doc.save(output, **reconciler.save_options())
+                        data = None
+                    else:
+                        data = doc.tobytes(**reconciler.save_options())
+                except Exception as e:
+                    raise ValueError(f"Could not save PDF: {e}")
+                timings["save"] = time.perf_counter() - mark
+            finally:
+                doc.close()
+    finally:
+        if view is not None:
+            view.release()
+    timings["total"] = time.perf_counter() - started
+
+    result = {
+        "annotations": reconciler.total,
+        "added": reconciler.added,
+        "kept": reconciler.kept,
+        "updated": reconciler.updated,
+        "deleted": reconciler.deleted,
+        "pages": stats["pages"],
+        "hits": [
+            {"page": spec["page"] + 1, "tag": spec["tag"], "comment": spec["content"], "rect": list(spec["rect"])}
+            for _, spec in page_specs
+        ],
+        "hits_per_tag": dict(stats["hits"].most_common()),
+        "unmapped": stats["unmapped"],
+        "timings": {k: round(v, 6) for k, v in timings.items()},
+    }
+    return data, result
+
+
+def _normalize_column(name):
+    key = str(name).strip().lower().replace(" ", "_")
+    return COLUMN_ALIASES.get(key, key)
+
+
+def _clean_override_columns(df, source, log_func=None):
+    """Validate/convert the optional override columns in place; invalid cells are blanked and logged."""
+    import pandas as pd
+
+    def warn(msg):
+        if log_func:
+            log_func(f"  {source}: {msg}")
+
+    if "subject" in df.columns:
+        df["subject"] = df["subject"].map(lambda v: None if pd.isna(v) or not str(v).strip() else str(v).strip())
+
+    if "color" in df.columns:
+        def to_color(v):
+            if pd.isna(v) or not str(v).strip():
+                return None
+            rgb = parse_color(v)
+            if rgb is None:
+                warn(f"ignoring unknown colour '{v}'")
+            return rgb
+        df["color"] = df["color"].map(to_color)
+
+    for col, minimum in (("distance", 0), ("font_size", 1)):
+        if col not in df.columns:
+            continue
+
+        def to_number(v, col=col, minimum=minimum):
+            if pd.isna(v) or not str(v).strip():
+                return None
+            try:
+                num = float(v)
+            except (TypeError, ValueError):
+                num = None
+            if num is None or num < minimum:
+                warn(f"ignoring invalid {col} '{v}'")
+                return None
+            return num
+        df[col] = df[col].map(to_number)
+
+    if "font" in df.columns:
+        def to_font(v):
+            if pd.isna(v) or not str(v).strip():
+                return None
+            name = str(v).strip()
+            if name not in PDF_FONT_MAP:
+                warn(f"ignoring unknown font '{name}' (choose from {', '.join(sorted(PDF_FONT_MAP))})")
+                return None
+            return name
+        df["font"] = df["font"].map(to_font)
+
+
+# Extension of compiled tag index files (see commentpdf.tagindex)
+TAG_INDEX_SUFFIX = ".cpidx"
+
+
+class PreparedTagSheet:
+    """
+    A loaded tag sheet whose rows are built once, for matching many pages and documents against
+    it (DataFrame.iterrows builds a new Series per row on every call). It is read-only, so one
+    instance can be shared between threads.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.attrs = df.attrs
+        self._rows = list(df.iterrows())
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, column):
+        return self.df[column]
+
+    def __reduce__(self):
+        # other processes rebuild the rows rather than receive them
+        return PreparedTagSheet, (self.df,)
+
+    def iterrows(self):
+        return iter(self._rows)
+
+
+def prepare_tag_plan(tag_sheet, sheet_names=None, log_func=None):
+    """
+    Return a tag sheet ready to be matched against many documents (see PreparedTagSheet).
+    tag_sheet: a DataFrame from load_tag_sheet, a compiled tag index (already prepared) or
+    the workbook path(s) accepted by load_tag_sheet.
+    """
+    if isinstance(tag_sheet, PreparedTagSheet) or hasattr(tag_sheet, "iter_candidate_rows"):
+        return tag_sheet
+    if not hasattr(tag_sheet, "iterrows"):
+        tag_sheet = load_tag_sheet(tag_sheet, sheet_names, log_func)
+        if hasattr(tag_sheet, "iter_candidate_rows"):
+            return tag_sheet
+    return PreparedTagSheet(tag_sheet)
+
+
+def load_tag_sheet(excel_path, sheet_names=None, log_func=None):
+    """
+    Read one or more Excel tag sheets and return a single deduplicated tag index DataFrame.
+
+    excel_path: a workbook path, or a list of paths merged in order.
+    sheet_names: None reads the first sheet of each workbook, "*" reads every sheet, or a list of
+        sheet names. With "*" sheets lacking 'tag'/'comment' are skipped; named sheets must have them.
+
+    Besides 'tag' and 'comment', the optional columns subject, color (or colour), distance, font and
+    font_size override the run-wide settings for that row (see row_annotation_settings). A 'source'
+    column ('<workbook>:<sheet>') records where each row came from.
+
+    Repeats of a tag with the same comment and overrides are dropped. A tag repeated with a different
+    comment or overrides is a conflict: the first row wins, and the conflict is logged and listed in
+    df.attrs["conflicts"] so it does not produce stacked duplicate annotations.
+
+    A compiled tag index ('.cpidx', see commentpdf.tagindex) is opened instead of read: it is
+    recompiled first if its workbooks changed, and sheet_names is taken from the index.
+
+    Raises RuntimeError when a workbook cannot be read or lacks the required columns.
+    """
+    import pandas as pd
+
+    paths = [excel_path] if isinstance(excel_path, (str, os.PathLike)) else list(excel_path)
+    if len(paths) == 1 and os.fspath(paths[0]).lower().endswith(TAG_INDEX_SUFFIX):
+        from commentpdf.tagindex import open_tag_index
+
+        return open_tag_index(paths[0], log_func=log_func)
+    if sheet_names is None:
+        which = 0
+    elif sheet_names == "*":
+        which = None
+    else:
+        which = list(sheet_names)
+
+    frames = []
+    for path in paths:
+        try:
+            book = pd.read_excel(path, sheet_name=which)
+        except Exception as e:
+            raise RuntimeError(f"Failed to read Excel file: {e}")
+        if not isinstance(book, dict):
+            book = {0: book}
+
+        for sheet, df in book.items():
+            source = os.path.basename(path) if sheet == 0 else f"{os.path.basename(path)}:{sheet}"
+            df = df.rename(columns=_normalize_column)
+            if "tag" not in df.columns or "comment" not in df.columns:
+                if which is None:
+                    if log_func:
+                        log_func(f"Skipping sheet {source}: no 'tag'/'comment' columns.")
+                    continue
+                raise RuntimeError("Excel must contain 'tag' and 'comment' columns.")
+
+            df = df.loc[:, ~df.columns.duplicated()]
+            df = df[df["tag"].notna()].copy()
+            df["tag"] = df["tag"].astype(str).str.strip()
+            df = df[df["tag"] != ""]
+            df["comment"] = df["comment"].map(lambda v: "" if pd.isna(v) else str(v))
+            _clean_override_columns(df, source, log_func)
+            df["source"] = source
+            frames.append(df)
+
+    if not frames:
+        raise RuntimeError("Excel must contain 'tag' and 'comment' columns.")
+
+    df = pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0].reset_index(drop=True)
+    payload = ["tag", "comment"] + [c for c in OVERRIDE_COLUMNS if c in df.columns]
+
+    # Exact repeats (same tag, comment and overrides) are dropped silently
+    df = df.drop_duplicates(subset=payload, keep="first")
+
+    # Anything still sharing a tag disagrees with the first definition
+    conflicts = []
+    dup_mask = df.duplicated(subset=["tag"], keep="first")
+    if dup_mask.any():
+        dup_tags = set(df.loc[dup_mask, "tag"])
+        for tag, group in df[df["tag"].isin(dup_tags)].groupby("tag", sort=False):
+            first = group.iloc[0]
+            conflicts.append(
+                {
+                    "tag": tag,
+                    "kept": {"comment": first["comment"], "source": first["source"]},
+                    "ignored": [
+                        {"comment": r["comment"], "source": r["source"]} for _, r in group.iloc[1:].iterrows()
+                    ],
+                }
+            )
+            if log_func:
+                others = ", ".join(f"'{r['comment']}' ({r['source']})" for _, r in group.iloc[1:].iterrows())
+                log_func(
+                    f"Conflicting duplicate tag '{tag}': using '{first['comment']}' ({first['source']}), "
+                    f"ignoring {others}"
+                )
+        df = df[~dup_mask]
+
+    df = df.reset_index(drop=True)
+    df.attrs["conflicts"] = conflicts
+    return df
+
+
+# "pdf" rewrites the PDFs; the others write annotation sidecars (see commentpdf.sidecar)
+OUTPUT_MODES = ("pdf", "xfdf", "json")
+# How process_files materialises the output of an input identical to one already processed
+DEDUPE_MODES = ("link", "copy")
+
+
+def mirrored_output_folder(pdf_path, output_folder, input_root=None):
+    """
+    Return the folder an output for pdf_path belongs in: output_folder itself, or with input_root
+    given, the sub-folder of output_folder matching pdf_path's folder relative to input_root.
+    Files outside input_root go to output_folder.
+    """
+    if not input_root:
+        return output_folder
+    rel_dir = os.path.relpath(os.path.dirname(os.path.abspath(pdf_path)), os.path.abspath(input_root))
+    if rel_dir == os.curdir or rel_dir == os.pardir or rel_dir.startswith(os.pardir + os.sep):
+        return output_folder
+    return os.path.join(output_folder, rel_dir)
+
+
+def marked_output_path(pdf_path, output_folder, input_root=None):
+    """Return the '<name>_marked.pdf' output path for pdf_path (see mirrored_output_folder)."""
+    name, ext = os.path.splitext(os.path.basename(pdf_path))
+    return os.path.join(mirrored_output_folder(pdf_path, output_folder, input_root), f"{name}_marked{ext}")
+
+
+def is_marked_output(path):
+    """True when path looks like an output produced by this tool (e.g. 'drawing_marked.pdf')."""
+    name, _ = os.path.splitext(os.path.basename(path))
+    return name.lower().endswith("_marked")
+
+
+# ---------- Batch journal (resume / audit) ----------
+# Written into the output folder; one JSON record per finished file
+JOURNAL_NAME = ".commentpdf_journal.jsonl"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the hex SHA-256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def settings_digest(df, options, output_mode):
+    """Digest of the tag sheet and options, so a resume never reuses output made with other settings."""
+    h = hashlib.sha256()
+    settings = {k: v for k, v in options.items() if k != "log_func"}
+    settings["output_mode"] = output_mode
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    if isinstance(df, PreparedTagSheet):
+        df = df.df
+    if getattr(df, "source_digest", None):
+        # a compiled tag index already carries a digest of its workbooks
+        h.update(df.source_digest.encode("ascii"))
+    else:
+        h.update(df.astype(str).to_csv(index=False).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+class BatchJournal:
+    """
+    Append-only JSON Lines journal of a batch run. Each record is flushed and fsynced before the
+    next file starts, so a crash loses at most the file that was in progress; a torn last line
+    is ignored when the journal is read back. The newest record for an input wins.
+
+    Records carrying an input_sha256 are also indexed by content. That index is kept even
+    without resume, so a later run can reuse an earlier output for an identical input
+    (see reusable_output): a new journal starts with the indexed records whose output still
+    exists, marked "carried" so that resume does not treat them as files of the last run.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        self.by_content = {}
+        self._load()
+        if not resume:
+            self.entries = {}
+            self._carry_content_index()
+        self._f = open(path, "a", encoding="utf-8")
+
+    def _carry_content_index(self):
+        """Replace the journal with the content-indexed records of earlier runs."""
+        carried = [r for r in self.by_content.values() if os.path.isfile(r.get("output", ""))]
+        self.by_content = {}
+        if not carried and not os.path.exists(self.path):
+            return
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in carried:
+                record = dict(record, carried=True)
+                f.write(json.dumps(record) + "\n")
+                self._index(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _index(self, record):
+        if record.get("status") == "done" and record.get("input_sha256"):
+            self.by_content[(record["input_sha256"], record.get("settings"))] = record
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and "input" in record:
+                        if not record.get("carried"):
+                            self.entries[record["input"]] = record
+                        self._index(record)
+        except FileNotFoundError:
+            pass
+
+    def is_done(self, pdf_path, output_path, settings):
+        """
+        True when pdf_path was completed with the same settings and its output (or every one of
+        a list of outputs) is still intact.
+        """
+        record = self.entries.get(os.path.abspath(pdf_path))
+        if not record or record.get("status") != "done" or record.get("settings") != settings:
+            return False
+        outputs = [output_path] if isinstance(output_path, (str, os.PathLike)) else list(output_path)
+        expected = record.get("outputs") or [{"output": record.get("output"), "output_size": record.get("output_size")}]
+        if len(outputs) != len(expected):
+            return False
+        try:
+            size, mtime_ns = _file_signature(pdf_path)
+            out_sizes = [os.path.getsize(path) for path in outputs]
+        except OSError:
+            return False
+        return [size, mtime_ns] == record.get("input_signature") and all(
+            os.path.abspath(path) == e.get("output") and out_size == e.get("output_size")
+            for path, out_size, e in zip(outputs, out_sizes, expected)
+        )
+
+    def reusable_output(self, input_sha256, settings):
+        """
+        The newest 'done' record for an input with this content and settings whose output still
+        exists at its recorded size, or None. Callers verify the output against its output_sha256.
+        """
+        record = self.by_content.get((input_sha256, settings))
+        if not record or not record.get("output_sha256"):
+            return None
+        try:
+            out_size = os.path.getsize(record["output"])
+        except OSError:
+            return None
+        return record if out_size == record.get("output_size") else None
+
+    def record(
+        self,
+        pdf_path,
+        output_path,
+        status,
+        seconds,
+        settings,
+        annotations=None,
+        error=None,
+        input_sha256=None,
+        output_sha256=None,
+        reused_from=None,
+        seconds_saved=None,
+    ):
+        """
+        Append a record for pdf_path. output_path may be a list of outputs (one per profile):
+        output and its size and hash then describe the first, and outputs lists every one with
+        its size. output_sha256 skips re-hashing an output whose hash is already known;
+        reused_from names the output an identical input's result was taken from and
+        seconds_saved the processing time that avoided.
+        """
+        outputs = [output_path] if isinstance(output_path, (str, os.PathLike)) else list(output_path)
+        output_path = outputs[0]
+        entry = {
+            "input": os.path.abspath(pdf_path),
+            "output": os.path.abspath(output_path),
+            "status": status,
+            "seconds": round(seconds, 3),
+            "annotations": annotations,
+            "settings": settings,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        try:
+            entry["input_signature"] = list(_file_signature(pdf_path))
+        except OSError:
+            pass
+        if input_sha256:
+            entry["input_sha256"] = input_sha256
+        if status == "done":
+            entry["output_size"] = os.path.getsize(output_path)
+            entry["output_sha256"] = output_sha256 or file_sha256(output_path)
+            if len(outputs) > 1:
+                entry["outputs"] = [
+                    {"output": os.path.abspath(path), "output_size": os.path.getsize(path)} for path in outputs
+                ]
+        if reused_from:
+            entry["reused_from"] = os.path.abspath(reused_from)
+            entry["seconds_saved"] = seconds_saved
+        if error:
+            entry["error"] = str(error)
+        self._f.write(json.dumps(entry) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.entries[entry["input"]] = entry
+        self._index(entry)
+
+    def close(self):
+        self._f.close()
+
+
+def process_files(
+    pdf_paths,
+    excel_path,
+    output_folder,
+    subject="Comment",
+    distance=10,
+    log_func=None,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    progress_callback=None,
+    tag_df=None,
+    sheet_names=None,
+    output_mode="pdf",
+    cancel_event=None,
+    journal=False,
+    resume=False,
+    priority=None,
+    workers=1,
+    eta_callback=None,
+    input_root=None,
+    wrap_width=None,
+    dedupe=None,
+    metrics=False,
+    prometheus_path=None,
+    prescan=False,
+    limits=None,
+    profiles=None,
+    combine=False,
+):
+    """
+    Annotate each PDF in pdf_paths and save '<name>_marked.pdf' into output_folder.
+
+    pdf_paths: a list of paths, or any iterable of paths (such as
+    commentpdf.discover.iter_pdf_files), which is enumerated in the background while the
+    files found so far are already being processed.
+    excel_path: one workbook or a list of workbooks; sheet_names selects their sheets
+    (see load_tag_sheet).
+    tag_df: an already loaded tag sheet (see load_tag_sheet). When given, excel_path is not
+    re-read, which lets long-running callers keep the tag plan in memory between batches.
+    output_mode: "pdf" writes annotated PDFs; "xfdf" or "json" instead writes a
+    '<name>_marked.xfdf/.json' annotation sidecar per input and never rewrites the PDF
+    (see commentpdf.sidecar).
+    input_root: when given, outputs mirror each input's folder relative to input_root
+    inside output_folder instead of all going into output_folder itself.
+    cancel_event: a threading.Event; once set, the file in progress is abandoned (no partial
+    output is left behind) and the remaining files are not started. With workers > 1, files
+    already running in a worker process are finished.
+    journal: record each file's status, output hash and timing in JOURNAL_NAME inside
+    output_folder. With resume=True (which keeps the journal too), files the journal lists as
+    done with the same settings and an unchanged input/output are skipped.
+    priority: file names, glob patterns or paths to process first, in that order. The other
+    files are processed largest estimated cost first (see commentpdf.schedule); for a
+    streamed pdf_paths this applies among the files found so far.
+    workers: number of worker processes; 1 processes the files in this process.
+    progress_callback(percent) and eta_callback(seconds or None) report progress weighted by
+    each file's estimated cost rather than by file count. While a streamed pdf_paths is still
+    being enumerated the total is not known yet and the ETA is reported as None.
+    dedupe: "copy" (or True) or "link" processes byte-identical inputs (by SHA-256) only once
+    and copies or hard links (falling back to a copy) the result to the other inputs' outputs;
+    with the journal, outputs of earlier runs made with the same settings are reused the same
+    way after their hash is verified. None (the default) processes every file. Sidecars name
+    their source PDF, so only output_mode "pdf" is deduplicated.
+    metrics: write the run metrics (see commentpdf.metrics) to METRICS_NAME in output_folder.
+    prometheus_path: also write the run totals to this Prometheus textfile.
+    prescan: before processing, quarantine files that cannot be opened, are encrypted or contain
+    no text (see commentpdf.watchdog.prescan_pdf).
+    limits: a commentpdf.watchdog.FileLimits; files then run in supervised worker processes (up
+    to workers at a time) and are killed and quarantined when they exceed a limit or crash.
+    Quarantined files and the reasons are listed in QUARANTINE_NAME in output_folder; with
+    resume=True, files quarantined by the previous run are skipped unless they changed.
+    profiles: apply several tag sheets with their own options in one pass per PDF instead of
+    excel_path (see commentpdf.profiles); the arguments above are the defaults of each profile.
+    Each profile's outputs go into its own subfolder of output_folder, or with combine=True all
+    annotations go into one '<name>_marked.pdf'. Only output_mode "pdf" is supported, and
+    separate outputs per profile are not deduplicated (the journal tracks every profile's output).
+
+    Returns a summary dict with total, processed, skipped, failed, cancelled and quarantined counts, plus
+    deduplicated (outputs reused for identical inputs, also counted as processed),
+    seconds_saved (the processing time those inputs took the first time) and metrics (hits per
+    tag, unmatched tags, failed coordinate mappings, throughput and the slowest files of the
+    files processed in this run).
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode '{output_mode}' (expected one of {', '.join(OUTPUT_MODES)})")
+    if dedupe is True:
+        dedupe = "copy"
+    if dedupe and dedupe not in DEDUPE_MODES:
+        raise ValueError(f"Unknown dedupe mode '{dedupe}' (expected one of {', '.join(DEDUPE_MODES)})")
+    if profiles is not None and output_mode != "pdf":
+        raise ValueError("Profiles can only be used with output mode 'pdf'")
+    if output_mode != "pdf" or (profiles is not None and not combine):
+        dedupe = None
+
+    from commentpdf.batch import BatchRun, PathFeed, PoolDispatcher, SerialDispatcher, SupervisedDispatcher, run_batch
+    from commentpdf.metrics import METRICS_NAME, RunMetrics, write_metrics_json, write_prometheus_textfile
+    from commentpdf.schedule import estimate_pdf_cost
+
+    options = {
+        "subject": subject,
+        "distance": distance,
+        "font_family": font_family,
+        "font_size": font_size,
+        "case_sensitive": case_sensitive,
+        "whole_word": whole_word,
+        "use_regex": use_regex,
+        "wrap_width": wrap_width,
+    }
+    if profiles is not None:
+        from commentpdf.profiles import ProfileSet, load_profiles
+
+        # the tag plan: one tag sheet, or the profiles (each with its own tag sheet and options)
+        df = ProfileSet(load_profiles(profiles, options, sheet_names, log_func), combine)
+        tags = df.tags()
+    else:
+        df = tag_df if tag_df is not None else load_tag_sheet(excel_path, sheet_names, log_func)
+        tags = (str(tag) for tag in df["tag"] if not is_missing(tag) and str(tag).strip())
+
+    os.makedirs(output_folder, exist_ok=True)
+    quarantine_list = None
+    if prescan or limits is not None:
+        from commentpdf.watchdog import QUARANTINE_NAME, Quarantine, memory_limit_supported
+
+        if limits is not None and limits.memory_mb and not memory_limit_supported() and log_func:
+            log_func(f"Warning: the {limits.memory_mb:g} MB memory limit cannot be enforced on this platform")
+        quarantine_list = Quarantine(os.path.join(output_folder, QUARANTINE_NAME), resume)
+    journal = journal or resume
+    run_journal = BatchJournal(os.path.join(output_folder, JOURNAL_NAME), resume) if journal else None
+    if journal:
+        settings = df.settings_digest(output_mode) if profiles is not None else settings_digest(df, options, output_mode)
+    else:
+        settings = None
+
+    run = BatchRun(
+        df, options, output_folder, output_mode, input_root,
+        journal=run_journal, settings=settings, resume=resume, quarantine=quarantine_list, prescan=prescan,
+        dedupe=dedupe, priority=priority, run_metrics=RunMetrics(tags), log_func=log_func,
+        progress_callback=progress_callback, eta_callback=eta_callback, cancel_event=cancel_event,
+    )
+    parallel = workers > 1 and (not isinstance(pdf_paths, (list, tuple)) or len(pdf_paths) > 1)
+    # one process gains nothing from running large files first, so the file size is enough to
+    # weigh the progress; otherwise each file is opened for its page count off the dispatch thread
+    feed = PathFeed(pdf_paths, estimate_pdf_cost if parallel else None)
+    if limits is not None:
+        dispatcher = SupervisedDispatcher(run, workers, limits)
+    elif parallel:
+        dispatcher = PoolDispatcher(run, workers)
+    else:
+        dispatcher = SerialDispatcher(run)
+    summary = run.summary
+    try:
+        run_batch(run, feed, dispatcher)
+        if summary["deduplicated"] and log_func:
+            log_func(
+                f"Reused outputs for {summary['deduplicated']} identical input(s), "
+                f"saving about {summary['seconds_saved']:.1f} s of processing"
+            )
+        summary["metrics"] = run.run_metrics.to_dict()
+        try:
+            if metrics:
+                write_metrics_json(os.path.join(output_folder, METRICS_NAME), summary["metrics"], summary)
+            if prometheus_path:
+                write_prometheus_textfile(prometheus_path, summary["metrics"], summary)
+        except OSError as e:
+            if log_func:
+                log_func(f"Error writing run metrics: {e}")
+    finally:
+        if run_journal:
+            run_journal.close()
+    return summary
+
+
+# ---------- Command-line helpers (shared by the service modes) ----------
+def add_annotation_arguments(parser):
+    """Add the annotation/matching options accepted by update_pdf_with_comments to an argparse parser."""
+    parser.add_argument("--subject", default="Comment", help="Annotation subject (default: Comment)")
+    parser.add_argument("--distance", type=int, default=10, help="Distance in points between tag and comment")
+    parser.add_argument("--font", dest="font_family", default="Arial", choices=sorted(PDF_FONT_MAP))
+    parser.add_argument("--font-size", type=int, default=12)
+    parser.add_argument("--case-sensitive", action="store_true")
+    parser.add_argument("--whole-word", action="store_true")
+    parser.add_argument("--regex", dest="use_regex", action="store_true")
+    parser.add_argument("--wrap-width", type=float, default=None,
+                        help="Wrap long comments into boxes at most this many points wide")
+
+
+def add_tag_sheet_arguments(parser, excel_required=True):
+    """Add --excel (repeatable), --sheet (repeatable) and --all-sheets to an argparse parser."""
+    parser.add_argument("--excel", action="append", required=excel_required,
+                        help="Excel file with 'tag' and 'comment' columns (repeat to merge several workbooks)")
+    parser.add_argument("--sheet", dest="sheets", action="append", default=None,
+                        help="Sheet to read from each workbook (repeatable; default: the first sheet)")
+    parser.add_argument("--all-sheets", action="store_true", help="Merge every sheet that has tag/comment columns")
+
+
+def sheet_names_from_args(args):
+    """Return the sheet_names argument for load_tag_sheet from parsed arguments."""
+    if args.all_sheets:
+        return "*"
+    return args.sheets
+
+
+def annotation_options_from_args(args):
+    """Return the keyword arguments for update_pdf_with_comments from parsed arguments."""
+    if args.distance < 0:
+        raise ValueError("Distance must be >= 0")
+    if args.font_size <= 0:
+        raise ValueError("Font size must be a positive integer")
+    if args.wrap_width is not None and args.wrap_width <= 0:
+        raise ValueError("Wrap width must be positive")
+    return {
+        "subject": args.subject or "Comment",
+        "distance": args.distance,
+        "font_family": args.font_family,
+        "font_size": args.font_size,
+        "case_sensitive": args.case_sensitive,
+        "whole_word": args.whole_word,
+        "use_regex": args.use_regex,
+        "wrap_width": args.wrap_width,
+    }
+
+
+# ---------- Preview geometry (GUI preview and match reports) ----------
+def build_annotations_for_preview(
+    page,
+    df,
+    distance,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    subject="Comment",
+    wrap_width=None,
+):
+    hits, boxes = collect_page_hits(
+        page, df, subject, distance, font_family, font_size, case_sensitive, whole_word, use_regex,
+        measure_fontname="helv", wrap_width=wrap_width,
+    )
+    return preview_annotations(hits, boxes)
+
+
+def preview_annotations(hits, boxes):
+    """Turn collect_page_hits/layout_page_hits output into build_annotations_for_preview dicts."""
+    import fitz  # PyMuPDF
+
+    annotations = []
+    for (inst, hit), box in zip(hits, boxes):
+        annotations.append(
+            {
+                "annot_rect": fitz.Rect(box),
+                "comment": hit["comment"],
+                "inst_rect": inst,
+                "tag": hit["tag"],
+                "subject": hit["subject"],
+                "font_family": hit["font_family"],
+                "font_size": hit["font_size"],
+                "fill_color": hit["fill_color"],
+                "lines": hit["lines"],
+            }
+        )
+
+    return annotations
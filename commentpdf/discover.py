@@ -0,0 +1,71 @@
+"""
+PDF discovery for folder mode: walk a folder tree with os.scandir and yield matching PDFs as they
+are found, so processing can start while a large tree is still being enumerated.
+
+Patterns are shell globs matched case-insensitively against both the file name and the path
+relative to the root folder ('/'-separated, so 'drawings/*/rev?.pdf' works on every platform).
+"""
+import fnmatch
+import os
+
+from commentpdf.core import is_marked_output
+
+DEFAULT_INCLUDE = ("*.pdf",)
+
+
+def _matches(rel_path, patterns):
+    name = rel_path.rsplit("/", 1)[-1]
+    for pattern in patterns:
+        pattern = pattern.lower()
+        if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(rel_path, pattern):
+            return True
+    return False
+
+
+def split_patterns(text):
+    """Split a ';' or ','-separated pattern string (as typed in the GUI) into a list of globs."""
+    return [p.strip() for p in text.replace(",", ";").split(";") if p.strip()]
+
+
+def iter_pdf_files(root, include=None, exclude=None, recursive=True, skip_marked=True, log_func=None):
+    """
+    Yield the paths of PDFs under root as they are found.
+
+    include: globs a file must match (default: '*.pdf').
+    exclude: globs for files to skip; a sub-folder matching one is not entered at all.
+    recursive: descend into sub-folders (symlinked folders are not followed, so links cannot loop).
+    skip_marked: skip '<name>_marked.pdf' outputs of earlier runs.
+    Folders that cannot be read are reported through log_func and skipped.
+    """
+    include = [p.lower() for p in (include or DEFAULT_INCLUDE)]
+    exclude = [p.lower() for p in (exclude or [])]
+    # depth-first with an explicit stack; only one directory handle is open at a time
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        folder = os.path.join(root, rel_dir) if rel_dir else root
+        subdirs = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    rel_lower = rel_path.lower()
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and not _matches(rel_lower, exclude):
+                                subdirs.append(rel_path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    if not _matches(rel_lower, include) or _matches(rel_lower, exclude):
+                        continue
+                    if skip_marked and is_marked_output(entry.name):
+                        continue
+                    yield entry.path
+        except OSError as e:
+            if log_func:
+                log_func(f"Cannot scan {folder}: {e}")
+        # visit sub-folders in name order so runs over the same tree are reproducible
+        stack.extend(sorted(subdirs, reverse=True))
@@ -0,0 +1,553 @@
+"""
+Distributed batch mode: a coordinator queues a batch in a SQLite file on a shared filesystem and
+workers on any number of hosts lease files from it, annotate them with update_pdf_with_comments
+and report the result back into the same file.
+
+Usage:
+    python -m commentpdf.distributed enqueue --queue /mnt/share/job.db --excel tags.xlsx \\
+        --input /mnt/share/drawings --output /mnt/share/marked
+    python -m commentpdf.distributed worker --queue /mnt/share/job.db --processes 8   (on every host)
+    python -m commentpdf.distributed status --queue /mnt/share/job.db --wait
+
+A worker holds a lease on the file it is processing and renews it while it works. When a worker
+dies or loses the share, its lease expires and the file is queued again for another worker (a
+file whose lease expired max_attempts times is marked failed, so one PDF that kills its worker
+cannot stall the batch). Workers check the tag sheet against the digest recorded when the batch
+was queued and refuse to run when the workbook has changed since.
+
+All hosts must see the queue, the workbooks, the inputs and the output folder under the same
+paths, and their clocks must roughly agree (leases are wall-clock timestamps). The queue uses
+SQLite's default rollback journal rather than WAL, which does not work on network filesystems.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from commentpdf.core import (
+    ProcessingCancelled,
+    add_annotation_arguments,
+    add_tag_sheet_arguments,
+    annotation_options_from_args,
+    load_tag_sheet,
+    marked_output_path,
+    settings_digest,
+    sheet_names_from_args,
+    update_pdf_with_comments,
+)
+from commentpdf.schedule import priority_rank
+
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+STATES = (QUEUED, LEASED, DONE, FAILED)
+DEFAULT_LEASE_SECONDS = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+# rows inserted per transaction while a batch is being queued
+ENQUEUE_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    input TEXT NOT NULL UNIQUE,
+    output TEXT NOT NULL,
+    rank INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    annotations INTEGER,
+    seconds REAL,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS items_by_state ON items (state, rank);
+"""
+
+
+class WorkQueue:
+    """
+    Leased work items in a SQLite file. Every state change runs in an immediate (write-locked)
+    transaction, so several processes on several hosts can share one queue file. A connection
+    belongs to the thread that opened the queue.
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self):
+        self._conn.close()
+
+    # ----- job configuration -----
+    def set_job(self, config):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO job (key, value) VALUES ('config', ?)", (json.dumps(config),))
+
+    def job(self):
+        """The job configuration stored by enqueue_batch, or None."""
+        row = self._conn.execute("SELECT value FROM job WHERE key = 'config'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    # ----- items -----
+    def add(self, items):
+        """Queue (input, output, rank, size) items; inputs already in the queue are ignored. Returns the number added."""
+        added = 0
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= ENQUEUE_CHUNK:
+                added += self._add_chunk(chunk)
+                chunk = []
+        if chunk:
+            added += self._add_chunk(chunk)
+        return added
+
+    def _add_chunk(self, chunk):
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (input, output, rank, size, updated) VALUES (?, ?, ?, ?, ?)",
+                [(i, o, r, s, now) for i, o, r, s in chunk],
+            )
+            return conn.total_changes - before
+
+    def _expire(self, conn, now, max_attempts):
+        conn.execute(
+            "UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, updated = ?, "
+            "error = 'lease expired ' || attempts || ' time(s); the worker stopped or crashed' "
+            "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+            (FAILED, now, LEASED, now, max_attempts),
+        )
+        return conn.execute(
+            "UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, updated = ? "
+            "WHERE state = ? AND lease_expires < ?",
+            (QUEUED, now, LEASED, now),
+        ).rowcount
+
+    def expire_leases(self, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Queue again the items whose lease has expired; returns how many were re-queued."""
+        with self._transaction() as conn:
+            return self._expire(conn, time.time(), max_attempts)
+
+    def lease(self, worker, lease_seconds=DEFAULT_LEASE_SECONDS, limit=1, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Lease up to limit queued items to worker, priority files first and then largest first.
+        Expired leases are re-queued first. Returns [(item id, input, output), ...].
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire(conn, now, max_attempts)
+            rows = conn.execute(
+                "SELECT id, input, output FROM items WHERE state = ? ORDER BY rank, size DESC, id LIMIT ?",
+                (QUEUED, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE items SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated = ? WHERE id = ?",
+                [(LEASED, worker, now + lease_seconds, now, row[0]) for row in rows],
+            )
+        return rows
+
+    def renew(self, item_ids, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend worker's leases on item_ids; returns how many are still held."""
+        if not item_ids:
+            return 0
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.executemany(
+                "UPDATE items SET lease_expires = ?, updated = ? WHERE id = ? AND state = ? AND worker = ?",
+                [(now + lease_seconds, now, item_id, LEASED, worker) for item_id in item_ids],
+            ).rowcount
+
+    def complete(self, item_id, worker, status, annotations=None, seconds=None, error=None):
+        """Record the result of a leased item. False when worker no longer holds the lease."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, annotations = ?, "
+                "seconds = ?, error = ?, updated = ? WHERE id = ? AND state = ? AND worker = ?",
+                (status, annotations, seconds, error, time.time(), item_id, LEASED, worker),
+            ).rowcount == 1
+
+    def release(self, item_id, worker):
+        """Hand a leased item back unprocessed (e.g. on shutdown) without counting the attempt."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, attempts = attempts - 1, "
+                "updated = ? WHERE id = ? AND state = ? AND worker = ?",
+                (QUEUED, time.time(), item_id, LEASED, worker),
+            )
+
+    def retry_failed(self):
+        """Queue the failed items again; returns how many."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE items SET state = ?, attempts = 0, error = NULL, updated = ? WHERE state = ?",
+                (QUEUED, time.time(), FAILED),
+            ).rowcount
+
+    def counts(self):
+        """Number of items per state."""
+        counts = dict.fromkeys(STATES, 0)
+        for state, n in self._conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state"):
+            counts[state] = n
+        return counts
+
+    def failures(self, limit=20):
+        """[(input, error), ...] of failed items."""
+        return self._conn.execute(
+            "SELECT input, error FROM items WHERE state = ? ORDER BY updated LIMIT ?", (FAILED, limit)
+        ).fetchall()
+
+
+# ---------- Coordinator ----------
+def enqueue_batch(
+    queue_path,
+    pdf_paths,
+    excel_path,
+    output_folder,
+    sheet_names=None,
+    options=None,
+    input_root=None,
+    priority=None,
+    lease_seconds=DEFAULT_LEASE_SECONDS,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    log_func=None,
+):
+    """
+    Queue pdf_paths in the queue file at queue_path for run_worker. Outputs are named as in
+    process_files ('<name>_marked.pdf' in output_folder, mirrored below input_root when given);
+    pdf_paths may also yield (path, input_root) pairs to mirror each file below its own root.
+    The tag sheet is loaded once to validate it and record its digest. Queueing more files into
+    an existing queue is allowed with the same tag sheet and settings; inputs already queued are
+    skipped. Returns the number of newly queued files.
+    """
+    options = dict(options or {})
+    excel_paths = [excel_path] if isinstance(excel_path, (str, os.PathLike)) else list(excel_path)
+    df = load_tag_sheet(excel_paths, sheet_names, log_func)
+    config = {
+        "excel": [os.path.abspath(p) for p in excel_paths],
+        "sheet_names": sheet_names,
+        "options": options,
+        "settings": settings_digest(df, options, "pdf"),
+        "lease_seconds": float(lease_seconds),
+        "max_attempts": int(max_attempts),
+    }
+    priority = list(priority or [])
+    os.makedirs(output_folder, exist_ok=True)
+
+    def items():
+        for entry in pdf_paths:
+            pdf_path, root = entry if isinstance(entry, tuple) else (entry, input_root)
+            try:
+                size = os.path.getsize(pdf_path)
+            except OSError:
+                size = 0
+            yield (
+                os.path.abspath(pdf_path),
+                os.path.abspath(marked_output_path(pdf_path, output_folder, root)),
+                priority_rank(pdf_path, priority),
+                size,
+            )
+
+    queue = WorkQueue(queue_path)
+    try:
+        existing = queue.job()
+        if existing is not None and existing.get("settings") != config["settings"]:
+            raise RuntimeError(
+                "The queue already holds a batch with another tag sheet or other settings; use a new queue file"
+            )
+        queue.set_job(config)
+        added = queue.add(items())
+        if log_func:
+            log_func(f"Queued {added} file(s) in {queue_path}")
+        return added
+    finally:
+        queue.close()
+
+
+def wait_for_queue(queue_path, poll_interval=5.0, log_func=None, stop_event=None):
+    """
+    Wait until no item is queued or leased, re-queueing expired leases meanwhile and logging
+    progress whenever it changes. Returns the final counts per state.
+    """
+    queue = WorkQueue(queue_path)
+    try:
+        config = queue.job() or {}
+        max_attempts = config.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        last = None
+        while True:
+            requeued = queue.expire_leases(max_attempts)
+            if requeued and log_func:
+                log_func(f"Re-queued {requeued} file(s) with expired leases")
+            counts = queue.counts()
+            if counts != last and log_func:
+                log_func(format_counts(counts))
+            last = counts
+            if not counts[QUEUED] and not counts[LEASED]:
+                return counts
+            if stop_event is not None:
+                if stop_event.wait(poll_interval):
+                    return counts
+            else:
+                time.sleep(poll_interval)
+    finally:
+        queue.close()
+
+
+def format_counts(counts):
+    total = sum(counts.values())
+    return (
+        f"{counts[DONE]} of {total} done, {counts[FAILED]} failed, "
+        f"{counts[LEASED]} in progress, {counts[QUEUED]} queued"
+    )
+
+
+# ---------- Workers ----------
+class _LeaseKeeper:
+    """Background thread renewing the leases a worker holds (with its own connection)."""
+
+    def __init__(self, queue_path, worker, lease_seconds, log_func=None):
+        self.queue_path = queue_path
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.log_func = log_func
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def hold(self, item_id):
+        with self._lock:
+            self._held.add(item_id)
+
+    def drop(self, item_id):
+        with self._lock:
+            self._held.discard(item_id)
+
+    def _run(self):
+        queue = WorkQueue(self.queue_path)
+        try:
+            # renew well before expiry, so one slow write to the share does not lose the lease
+            while not self._stop.wait(self.lease_seconds / 3.0):
+                with self._lock:
+                    held = list(self._held)
+                try:
+                    queue.renew(held, self.worker, self.lease_seconds)
+                except sqlite3.Error as e:
+                    if self.log_func:
+                        self.log_func(f"  Could not renew leases: {e}")
+        finally:
+            queue.close()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue_path, worker_id=None, wait=False, poll_interval=2.0, stop_event=None, log_func=None):
+    """
+    Lease and annotate files from the queue at queue_path until none is queued or leased (with
+    wait=True: until stop_event is set). Setting stop_event also abandons the file in progress,
+    which is handed back to the queue. The tag sheet is loaded once per worker.
+
+    Returns a dict with the done and failed counts of this worker.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = stop_event or threading.Event()
+    queue = WorkQueue(queue_path)
+    config = queue.job()
+    if config is None:
+        queue.close()
+        raise RuntimeError(f"No batch has been queued in {queue_path}")
+    df = load_tag_sheet(config["excel"], config["sheet_names"], log_func)
+    if settings_digest(df, config["options"], "pdf") != config["settings"]:
+        queue.close()
+        raise RuntimeError("The tag sheet has changed since the batch was queued; queue it again in a new queue file")
+
+    lease_seconds = config["lease_seconds"]
+    max_attempts = config["max_attempts"]
+    # after a lease expires, the worker that lost it may still be saving the same output as the
+    # one that took over; each worker writes its own temporary file
+    part_suffix = "." + re.sub(r"[^\w.-]", "_", worker_id) + ".part"
+    keeper = _LeaseKeeper(queue_path, worker_id, lease_seconds, log_func)
+    result = {DONE: 0, FAILED: 0}
+    if log_func:
+        log_func(f"Worker {worker_id} started")
+    try:
+        while not stop_event.is_set():
+            leased = queue.lease(worker_id, lease_seconds, 1, max_attempts)
+            if not leased:
+                counts = queue.counts()
+                # leases held by others may still expire and come back to the queue
+                if not wait and not counts[QUEUED] and not counts[LEASED]:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            item_id, pdf_path, out_path = leased[0]
+            keeper.hold(item_id)
+            started = time.perf_counter()
+            count, error = None, None
+            try:
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                count = update_pdf_with_comments(
+                    pdf_path, df, out_path, log_func=log_func, cancel_event=stop_event, part_suffix=part_suffix,
+                    **config["options"]
+                )
+                if count is None:
+                    error = "the PDF could not be opened or saved"
+            except ProcessingCancelled:
+                queue.release(item_id, worker_id)
+                break
+            except KeyboardInterrupt:
+                queue.release(item_id, worker_id)
+                raise
+            except Exception as e:
+                error = str(e)
+                if log_func:
+                    log_func(f"Error processing {os.path.basename(pdf_path)}: {e}")
+            finally:
+                keeper.drop(item_id)
+
+            status = FAILED if error else DONE
+            if queue.complete(item_id, worker_id, status, count, time.perf_counter() - started, error):
+                result[status] += 1
+            elif log_func:
+                log_func(f"  Lease on {os.path.basename(pdf_path)} expired meanwhile; another worker retries it")
+    finally:
+        keeper.stop()
+        queue.close()
+    if log_func:
+        log_func(f"Worker {worker_id} finished: {result[DONE]} done, {result[FAILED]} failed")
+    return result
+
+
+def _log(msg):
+    print(f"{time.strftime('%H:%M:%S')} {msg}", flush=True)
+
+
+def run_workers(queue_path, processes, wait=False, poll_interval=2.0, log_func=_log):
+    """Run run_worker in processes worker processes on this host; returns the summed counts."""
+    if processes <= 1:
+        return run_worker(queue_path, wait=wait, poll_interval=poll_interval, log_func=log_func)
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(run_worker, queue_path, None, wait, poll_interval, None, log_func)
+            for _ in range(processes)
+        ]
+        results = [f.result() for f in futures]
+    return {state: sum(r[state] for r in results) for state in (DONE, FAILED)}
+
+
+# ---------- Command line ----------
+def _iter_inputs(inputs, include, exclude, log_func):
+    from commentpdf.discover import iter_pdf_files
+
+    for path in inputs:
+        if os.path.isdir(path):
+            for pdf_path in iter_pdf_files(path, include, exclude, log_func=log_func):
+                yield pdf_path, path
+        else:
+            yield path, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Annotate a large batch of PDFs with workers on several hosts.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_p = sub.add_parser("enqueue", help="Queue PDFs (files or folders) for the workers")
+    enqueue_p.add_argument("--queue", required=True, help="Queue file on a filesystem all hosts share")
+    enqueue_p.add_argument("--input", dest="inputs", action="append", required=True,
+                           help="PDF file or folder (searched recursively; repeatable)")
+    enqueue_p.add_argument("--output", required=True, help="Output folder; outputs mirror each input folder")
+    enqueue_p.add_argument("--include", action="append", default=None, help="Glob of files to include (repeatable)")
+    enqueue_p.add_argument("--exclude", action="append", default=None, help="Glob of files/folders to skip (repeatable)")
+    enqueue_p.add_argument("--priority", action="append", default=None,
+                           help="File name or glob pattern to process first (repeatable, in order)")
+    enqueue_p.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                           help="Seconds a worker's lease lasts without being renewed")
+    enqueue_p.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                           help="Fail a file after its lease expired this many times")
+    enqueue_p.add_argument("--wait", action="store_true", help="Wait for the workers to finish the batch")
+    add_tag_sheet_arguments(enqueue_p)
+    add_annotation_arguments(enqueue_p)
+
+    worker_p = sub.add_parser("worker", help="Process queued PDFs on this host")
+    worker_p.add_argument("--queue", required=True)
+    worker_p.add_argument("--processes", type=int, default=max(1, os.cpu_count() or 1))
+    worker_p.add_argument("--wait", action="store_true", help="Keep polling for new work instead of exiting when the queue is empty")
+    worker_p.add_argument("--poll", type=float, default=2.0, help="Seconds between checks of an empty queue")
+
+    status_p = sub.add_parser("status", help="Show (or --wait for) the progress of a queued batch")
+    status_p.add_argument("--queue", required=True)
+    status_p.add_argument("--wait", action="store_true", help="Wait until no file is queued or in progress")
+    status_p.add_argument("--retry-failed", action="store_true", help="Queue the failed files again")
+
+    args = parser.parse_args(argv)
+    if args.command != "enqueue" and not os.path.exists(args.queue):
+        parser.error(f"Queue file not found: {args.queue}")
+
+    try:
+        if args.command == "enqueue":
+            try:
+                options = annotation_options_from_args(args)
+            except ValueError as e:
+                parser.error(str(e))
+            enqueue_batch(
+                args.queue,
+                _iter_inputs(args.inputs, args.include, args.exclude, _log),
+                args.excel,
+                args.output,
+                sheet_names=sheet_names_from_args(args),
+                options=options,
+                priority=args.priority,
+                lease_seconds=args.lease,
+                max_attempts=args.max_attempts,
+                log_func=_log,
+            )
+            if args.wait:
+                wait_for_queue(args.queue, log_func=_log)
+        elif args.command == "worker":
+            run_workers(args.queue, args.processes, wait=args.wait, poll_interval=args.poll)
+        else:
+            queue = WorkQueue(args.queue)
+            try:
+                if args.retry_failed:
+                    _log(f"Re-queued {queue.retry_failed()} failed file(s)")
+                counts = queue.counts()
+                _log(format_counts(counts))
+                for pdf_path, error in queue.failures():
+                    _log(f"  failed: {pdf_path}: {error}")
+            finally:
+                queue.close()
+            if args.wait:
+                wait_for_queue(args.queue, log_func=_log)
+    except RuntimeError as e:
+        parser.exit(1, f"Error: {e}\n")
+    except KeyboardInterrupt:
+        parser.exit(130, "Interrupted\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Run metrics for process_files: hits per tag, tags that never matched, matches that could not be
+mapped to page coordinates, pages and annotations per second, and the slowest files.
+
+The engine fills one small stats dict per file (see new_file_stats); process_files folds them
+into a RunMetrics, so the per-hit cost is a single counter increment. The result is written as
+JSON and, optionally, as a Prometheus textfile for node_exporter's textfile collector.
+"""
+import heapq
+import json
+import os
+import time
+from collections import Counter
+
+METRICS_NAME = "commentpdf_metrics.json"
+SLOWEST_FILES = 10
+
+
+def new_file_stats():
+    """Counters for one file, filled in by update_pdf_with_comments(stats=...)."""
+    return {"pages": 0, "hits": Counter(), "unmapped": 0}
+
+
+class RunMetrics:
+    """Aggregates the per-file stats of a batch; tags are the tag sheet's tags (in sheet order)."""
+
+    def __init__(self, tags, slowest=SLOWEST_FILES):
+        self.tags = list(tags)
+        self.slowest = slowest
+        self.started = time.monotonic()
+        self.files = 0
+        self.pages = 0
+        self.unmapped = 0
+        self.file_seconds = 0.0
+        self.hits = Counter()
+        # min-heap of (seconds, path, pages, annotations), so the fastest of the slowest is dropped
+        self._slowest = []
+
+    def add_file(self, pdf_path, seconds, stats):
+        self.files += 1
+        self.file_seconds += seconds
+        self.pages += stats["pages"]
+        self.unmapped += stats["unmapped"]
+        self.hits.update(stats["hits"])
+        entry = (seconds, pdf_path, stats["pages"], sum(stats["hits"].values()))
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self.started
+        annotations = sum(self.hits.values())
+        return {
+            "files": self.files,
+            "pages": self.pages,
+            "annotations": annotations,
+            "elapsed_seconds": round(elapsed, 3),
+            "file_seconds": round(self.file_seconds, 3),
+            "pages_per_second": round(self.pages / elapsed, 3) if elapsed > 0 else 0.0,
+            "annotations_per_second": round(annotations / elapsed, 3) if elapsed > 0 else 0.0,
+            "failed_mappings": self.unmapped,
+            "hits_per_tag": dict(self.hits.most_common()),
+            "unmatched_tags": [tag for tag in self.tags if tag not in self.hits],
+            "slowest_files": [
+                {"file": path, "seconds": round(seconds, 3), "pages": pages, "annotations": count}
+                for seconds, path, pages, count in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+
+def format_metrics(metrics, top=5):
+    """Short human-readable summary of a RunMetrics.to_dict() result, one line per entry."""
+    lines = [
+        f"{metrics['files']} file(s), {metrics['pages']} page(s), {metrics['annotations']} annotation(s)"
+        f" in {metrics['elapsed_seconds']:.1f} s",
+        f"{metrics['pages_per_second']:.1f} pages/s, {metrics['annotations_per_second']:.1f} annotations/s",
+        f"Tags matched: {len(metrics['hits_per_tag'])}, never matched: {len(metrics['unmatched_tags'])},"
+        f" matches without coordinates: {metrics['failed_mappings']}",
+    ]
+    top_tags = list(metrics["hits_per_tag"].items())[:top]
+    if top_tags:
+        lines.append("Most hits: " + ", ".join(f"{tag} ({n})" for tag, n in top_tags))
+    if metrics["unmatched_tags"]:
+        shown = metrics["unmatched_tags"][:top]
+        more = len(metrics["unmatched_tags"]) - len(shown)
+        lines.append("Never matched: " + ", ".join(shown) + (f" and {more} more" if more else ""))
+    for entry in metrics["slowest_files"][:top]:
+        lines.append(
+            f"Slow: {os.path.basename(entry['file'])} {entry['seconds']:.1f} s"
+            f" ({entry['pages']} page(s), {entry['annotations']} annotation(s))"
+        )
+    return lines
+
+
+def _write_atomic(path, text):
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_metrics_json(path, metrics, summary=None):
+    """Write metrics (and the process_files summary counts, if given) to path as JSON."""
+    data = dict(metrics)
+    if summary is not None:
+        data["summary"] = {k: v for k, v in summary.items() if k != "metrics"}
+    _write_atomic(path, json.dumps(data, indent=2, ensure_ascii=False) + "\n")
+
+
+def write_prometheus_textfile(path, metrics, summary):
+    """
+    Write the run totals in the Prometheus text format to path (e.g. for node_exporter's
+    --collector.textfile.directory; the file is renamed into place so it is never read half
+    written). Per-tag counts stay in the JSON: one series per tag would explode cardinality.
+    """
+    gauges = [
+        ("commentpdf_run_pages", "Pages processed in the last run.", metrics["pages"]),
+        ("commentpdf_run_annotations", "Annotations created in the last run.", metrics["annotations"]),
+        ("commentpdf_run_duration_seconds", "Wall-clock duration of the last run.", metrics["elapsed_seconds"]),
+        ("commentpdf_run_pages_per_second", "Pages per second in the last run.", metrics["pages_per_second"]),
+        ("commentpdf_run_annotations_per_second", "Annotations per second in the last run.",
+         metrics["annotations_per_second"]),
+        ("commentpdf_run_failed_mappings", "Tag matches that could not be mapped to page coordinates.",
+         metrics["failed_mappings"]),
+        ("commentpdf_run_unmatched_tags", "Tags of the tag sheet that never matched.", len(metrics["unmatched_tags"])),
+        ("commentpdf_run_last_completion_timestamp_seconds", "Unix time the last run finished.", round(time.time(), 3)),
+    ]
+    lines = [
+        "# HELP commentpdf_run_files Files in the last run by outcome.",
+        "# TYPE commentpdf_run_files gauge",
+    ]
+    for status in ("processed", "skipped", "failed", "cancelled", "quarantined", "deduplicated"):
+        lines.append(f'commentpdf_run_files{{status="{status}"}} {summary.get(status, 0)}')
+    for name, help_text, value in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    _write_atomic(path, "\n".join(lines) + "\n")
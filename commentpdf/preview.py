@@ -0,0 +1,283 @@
+"""
+Preview rendering for the GUI (no Tk here, so it can run on a background thread).
+
+PreviewRenderer caches everything that does not depend on where the boxes go: the tag sheet
+(until the workbook changes), the tag matches of each page and the rendered page images. A
+preview with another distance, font, size or wrap width therefore only re-runs placement and
+re-draws the overlay. Pillow is required and imported when a page is rendered.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from commentpdf.core import (
+    LINE_SPACING,
+    PDF_FONT_MAP,
+    layout_page_hits,
+    load_tag_sheet,
+    match_page_rows,
+    preview_annotations,
+)
+
+PREVIEW_ZOOM = 2.0
+# Page images are RGB (3 bytes per pixel); at 2x zoom an A3 page is about 14 MB
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+# Options that change which tags match (part of the match cache key) ...
+MATCH_OPTIONS = ("case_sensitive", "whole_word", "use_regex")
+# ... and options that only change the placement (never part of any cache key)
+LAYOUT_OPTIONS = ("subject", "distance", "font_family", "font_size", "wrap_width")
+# Render settings of the cached page images (part of the tile key)
+RENDER_OPTIONS = (("alpha", False), ("annots", True))
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+class TileCache:
+    """LRU cache of rendered page images, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self._lock:
+            image = self._items.get(key)
+            if image is not None:
+                self._items.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        size = self._size(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= self._size(old)
+            self._items[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= self._size(evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
+def _load_preview_font(font_family, pixel_size):
+    from PIL import ImageFont
+
+    _, ttf_candidates = PDF_FONT_MAP.get(font_family, ("helv", ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf"]))
+    for fn in list(ttf_candidates) + ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf"]:
+        try:
+            return ImageFont.truetype(fn, size=pixel_size)
+        except Exception:
+            continue
+    return ImageFont.load_default()
+
+
+def draw_preview_snippet(page_image, annotation, zoom=PREVIEW_ZOOM, margin=28):
+    """
+    Crop page_image (rendered at zoom) around one preview annotation (see
+    build_annotations_for_preview) and draw the annotation box, the tag outline and the comment
+    with its line layout. Returns a new RGBA image; page_image is not modified.
+    """
+    from PIL import ImageDraw
+
+    annot_rect = annotation["annot_rect"]
+    inst_rect = annotation["inst_rect"]
+    # the sheet may override font, size and colour for this tag
+    font_size = annotation["font_size"]
+    fill_rgba = tuple(int(round(c * 255)) for c in annotation["fill_color"]) + (200,)
+
+    # conversion to pixels (pixmap scaled by zoom)
+    x0, y0, x1, y1 = (int(v * zoom) for v in annot_rect)
+    ix0, iy0, ix1, iy1 = (int(v * zoom) for v in inst_rect)
+    margin = int(margin * zoom)
+
+    cx0 = max(0, min(x0, ix0) - margin)
+    cy0 = max(0, min(y0, iy0) - margin)
+    cx1 = min(page_image.width, max(x1, ix1) + margin)
+    cy1 = min(page_image.height, max(y1, iy1) + margin)
+
+    snippet = page_image.crop((cx0, cy0, cx1, cy1)).convert("RGBA")
+    draw = ImageDraw.Draw(snippet)
+    # Load font at scaled size so preview shows correct visual size
+    font_obj = _load_preview_font(annotation["font_family"], int(font_size * zoom))
+
+    box = [x0 - cx0, y0 - cy0, x1 - cx0, y1 - cy0]
+    try:
+        draw.rectangle(box, fill=fill_rgba, outline=(0, 0, 0))
+    except Exception:
+        draw.rectangle(box, outline=(0, 0, 0))
+    draw.rectangle([ix0 - cx0, iy0 - cy0, ix1 - cx0, iy1 - cy0], outline=(0, 120, 200), width=2)
+
+    # Draw the comment with the same line layout the annotation box was sized for
+    line_step = int(round(font_size * LINE_SPACING * zoom))
+    for i, line in enumerate(annotation["lines"]):
+        draw.text((box[0] + int(3 * zoom), box[1] + int(2 * zoom) + i * line_step), line, fill=(0, 0, 0), font=font_obj)
+    return snippet
+
+
+class PreviewRenderer:
+    """
+    Produces preview snippets, caching tag sheets, per-page matches and page images (see the
+    module docstring). Not thread-safe: use it from one thread at a time.
+
+    options: dict with the process_files keys subject, distance, font_family, font_size,
+    case_sensitive, whole_word, use_regex and wrap_width.
+    """
+
+    def __init__(self, cache_bytes=DEFAULT_CACHE_BYTES, zoom=PREVIEW_ZOOM, max_match_pages=4096):
+        self.tiles = TileCache(cache_bytes)
+        self.zoom = zoom
+        self.max_match_pages = max_match_pages
+        self._sheet = None
+        self._sheet_key = None
+        self._matches = OrderedDict()
+        self._doc = None
+        self._doc_key = None
+
+    # ----- inputs -----
+    def use_sheet(self, df, key=None):
+        """Use an already loaded tag sheet; key identifies it in the match cache."""
+        key = key if key is not None else ("df", id(df))
+        if key != self._sheet_key:
+            self._sheet = df
+            self._sheet_key = key
+        return self._sheet
+
+    def load_sheet(self, excel_paths, sheet_names=None, log_func=None):
+        """Load the tag sheet (see load_tag_sheet) unless the same, unchanged workbooks are loaded."""
+        paths = [excel_paths] if isinstance(excel_paths, (str, os.PathLike)) else list(excel_paths)
+        key = (tuple((os.path.abspath(p), _file_signature(p)) for p in paths), repr(sheet_names))
+        if key != self._sheet_key:
+            self.use_sheet(load_tag_sheet(paths, sheet_names, log_func), key)
+        return self._sheet
+
+    def _open(self, pdf_path):
+        import fitz  # PyMuPDF
+
+        key = (os.path.abspath(pdf_path), _file_signature(pdf_path))
+        if key != self._doc_key:
+            self.close()
+            self._doc = fitz.open(pdf_path)
+            self._doc_key = key
+        return self._doc, key
+
+    def close(self):
+        if self._doc is not None:
+            try:
+                self._doc.close()
+            except Exception:
+                pass
+        self._doc = None
+        self._doc_key = None
+
+    # ----- cached stages -----
+    def _page_matches(self, doc, doc_key, page_index, options):
+        key = (doc_key, page_index, self._sheet_key, tuple(bool(options.get(k)) for k in MATCH_OPTIONS))
+        matches = self._matches.get(key)
+        if matches is None:
+            matches = match_page_rows(
+                doc[page_index],
+                self._sheet,
+                case_sensitive=bool(options.get("case_sensitive")),
+                whole_word=bool(options.get("whole_word")),
+                use_regex=bool(options.get("use_regex")),
+            )
+            self._matches[key] = matches
+            if len(self._matches) > self.max_match_pages:
+                self._matches.popitem(last=False)
+        else:
+            self._matches.move_to_end(key)
+        return matches
+
+    def page_annotations(self, pdf_path, page_index, options):
+        """Preview annotations of one page (as build_annotations_for_preview), from cached matches."""
+        doc, doc_key = self._open(pdf_path)
+        matches = self._page_matches(doc, doc_key, page_index, options)
+        if not matches:
+            return []
+        hits, boxes = layout_page_hits(
+            matches,
+            doc[page_index].rect,
+            subject=options.get("subject", "Comment"),
+            distance=options.get("distance", 10),
+            font_family=options.get("font_family", "Arial"),
+            font_size=options.get("font_size", 12),
+            measure_fontname="helv",
+            wrap_width=options.get("wrap_width"),
+        )
+        return preview_annotations(hits, boxes)
+
+    def page_image(self, pdf_path, page_index):
+        """The page rendered at self.zoom as a PIL RGB image (cached)."""
+        import fitz  # PyMuPDF
+        from PIL import Image
+
+        doc, doc_key = self._open(pdf_path)
+        key = (doc_key, page_index, self.zoom, RENDER_OPTIONS)
+        image = self.tiles.get(key)
+        if image is None:
+            pix = doc[page_index].get_pixmap(matrix=fitz.Matrix(self.zoom, self.zoom), **dict(RENDER_OPTIONS))
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            self.tiles.put(key, image)
+        return image
+
+    # ----- snippets -----
+    def snippet(self, pdf_path, options, start=0, step=1):
+        """
+        Find the first page with hits from page start in direction step (+1/-1) and return a dict
+        with page_index, page_count, annotations and image (the snippet of the first hit), or
+        None when no page in that direction has hits.
+        """
+        doc, _ = self._open(pdf_path)
+        page_count = len(doc)
+        page_index = start
+        while 0 <= page_index < page_count:
+            annotations = self.page_annotations(pdf_path, page_index, options)
+            if annotations:
+                image = draw_preview_snippet(self.page_image(pdf_path, page_index), annotations[0], self.zoom)
+                return {
+                    "page_index": page_index,
+                    "page_count": page_count,
+                    "annotations": annotations,
+                    "image": image,
+                }
+            page_index += step
+        return None
+
+    def prerender(self, pdf_path, options, stop_event=None):
+        """
+        Match every page and render the pages with hits into the tile cache, so later previews
+        of this PDF only draw overlays. Returns early once stop_event is set.
+        """
+        doc, doc_key = self._open(pdf_path)
+        for page_index in range(len(doc)):
+            if stop_event is not None and stop_event.is_set():
+                return
+            if self._page_matches(doc, doc_key, page_index, options):
+                self.page_image(pdf_path, page_index)
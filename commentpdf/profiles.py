@@ -0,0 +1,288 @@
+"""
+Profiles: several tag sheets with their own annotation and matching options applied to the same
+PDFs in one pass. Each PDF is read and opened once, and the text of each page is extracted once
+(see core.PageText) and shared by every profile; repeated search strings are located once.
+
+Usage:
+    python -m commentpdf.profiles --profiles teams.json -o out [--combine] drawings/*.pdf
+
+teams.json holds a list of profiles, for example
+    [{"name": "electrical", "excel": "elec_tags.xlsx", "subject": "Electrical"},
+     {"name": "piping", "excel": ["piping.xlsx", "valves.xlsx"], "whole_word": true, "font_size": 10}]
+
+Profile keys: name, excel (one workbook or a list, or a compiled tag index), sheet_names, and
+any of PROFILE_OPTIONS; options a profile does not set come from the batch. Without --combine
+each profile's outputs go into its own subfolder of the output folder ('out/electrical/...');
+with --combine every profile's annotations go into one '<name>_marked.pdf'.
+
+From Python: process_files(pdfs, None, "out", profiles=[...], combine=False).
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+import fitz  # PyMuPDF
+
+from commentpdf.core import (
+    PageText,
+    ProcessingCancelled,
+    annotate_and_save,
+    collect_page_hits,
+    is_missing,
+    load_tag_sheet,
+    marked_output_path,
+    page_annotation_specs,
+    prepare_tag_plan,
+    settings_digest,
+)
+
+PROFILE_OPTIONS = (
+    "subject",
+    "distance",
+    "font_family",
+    "font_size",
+    "case_sensitive",
+    "whole_word",
+    "use_regex",
+    "wrap_width",
+)
+
+
+class Profile:
+    """One review team's tag sheet (df) and annotation/matching options (PROFILE_OPTIONS)."""
+
+    def __init__(self, name, df, options):
+        self.name = name
+        self.df = df
+        self.options = dict(options)
+        self._sheet = None
+
+    def __repr__(self):
+        return f"Profile({self.name!r}, {len(self.df)} tag(s))"
+
+    def __getstate__(self):
+        # workers rebuild the row cache rather than receive it
+        return dict(self.__dict__, _sheet=None)
+
+    @property
+    def sheet(self):
+        """The tag sheet to match pages against, with its rows built once for the whole batch."""
+        if self._sheet is None:
+            self._sheet = prepare_tag_plan(self.df)
+        return self._sheet
+
+
+def _folder_name(name):
+    """name made safe for use as a folder name."""
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip(" .") or "profile"
+
+
+def load_profiles(profiles, defaults=None, sheet_names=None, log_func=None):
+    """
+    Return a list of Profile from profile dicts (see the module docstring; a dict may give an
+    already loaded tag sheet as tag_df instead of excel). defaults supplies the options a profile
+    does not set and sheet_names its default sheet selection. Workbooks shared by several
+    profiles are read once. Raises ValueError for unknown keys or duplicate names.
+    """
+    loaded = []
+    sheets_cache = {}
+    names = set()
+    for number, spec in enumerate(profiles, 1):
+        if isinstance(spec, Profile):
+            loaded.append(spec)
+            names.add(spec.name)
+            continue
+        unknown = set(spec) - set(PROFILE_OPTIONS) - {"name", "excel", "sheet_names", "tag_df"}
+        if unknown:
+            raise ValueError(f"Profile {number}: unknown setting(s) {', '.join(sorted(unknown))}")
+        excel = spec.get("excel")
+        if spec.get("tag_df") is None and not excel:
+            raise ValueError(f"Profile {number}: no 'excel' tag sheet given")
+        if isinstance(excel, (str, os.PathLike)):
+            excel = [excel]
+        name = spec.get("name") or os.path.splitext(os.path.basename(os.fspath(excel[0])))[0]
+        name = str(name)
+        if name in names:
+            raise ValueError(f"Profile name '{name}' is used more than once")
+        names.add(name)
+
+        df = spec.get("tag_df")
+        if df is None:
+            sheets = spec.get("sheet_names", sheet_names)
+            key = (tuple(os.path.abspath(os.fspath(p)) for p in excel), json.dumps(sheets))
+            if key not in sheets_cache:
+                sheets_cache[key] = load_tag_sheet(excel if len(excel) > 1 else excel[0], sheets, log_func)
+            df = sheets_cache[key]
+        options = dict(defaults or {})
+        options.update({k: spec[k] for k in PROFILE_OPTIONS if k in spec})
+        loaded.append(Profile(name, df, options))
+    if not loaded:
+        raise ValueError("No profiles given")
+    return loaded
+
+
+def load_profiles_file(path):
+    """Read the list of profile dicts from a JSON file; relative workbook paths are relative to it."""
+    with open(path, encoding="utf-8") as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError(f"{path}: expected a list of profiles")
+    base = os.path.dirname(os.path.abspath(path))
+    for spec in specs:
+        excel = spec.get("excel")
+        if isinstance(excel, str):
+            spec["excel"] = os.path.join(base, excel)
+        elif isinstance(excel, list):
+            spec["excel"] = [os.path.join(base, p) for p in excel]
+    return specs
+
+
+def profile_output_path(pdf_path, output_folder, profile, input_root=None):
+    """The '<name>_marked.pdf' output of pdf_path for profile, in the profile's subfolder."""
+    return marked_output_path(pdf_path, os.path.join(output_folder, _folder_name(profile.name)), input_root)
+
+
+def profile_page_specs(doc, profiles, log_func=None, cancel_event=None, stats=None, scoped=False):
+    """
+    Match every profile against every page of doc, extracting each page's text once.
+    Returns one list of annotation specs (see core.iter_freetext_annotations) per profile.
+    scoped: give each profile's annotations their own IDs (for one combined output).
+    ProcessingCancelled is raised before the next page once cancel_event is set.
+    """
+    specs = [[] for _ in profiles]
+    for page_num in range(len(doc)):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ProcessingCancelled()
+        page = doc[page_num]
+        text_index = PageText(page)
+        for profile, profile_specs in zip(profiles, specs):
+            hits, boxes = collect_page_hits(
+                page, profile.sheet, log_func=log_func, stats=stats, text_index=text_index, **profile.options
+            )
+            if stats is not None:
+                stats["hits"].update(hit["tag"] for _, hit in hits)
+            profile_specs.extend(page_annotation_specs(page_num, hits, boxes, profile.name if scoped else None))
+        if stats is not None:
+            stats["pages"] += 1
+    return specs
+
+
+def _on_pages(doc, specs):
+    """(page, spec) pairs for annotate_and_save, loading each page once."""
+    page = None
+    for spec in specs:
+        if page is None or page.number != spec["page"]:
+            page = doc[spec["page"]]
+        yield page, spec
+
+
+def update_pdf_with_profiles(pdf_path, profiles, output_pdf_paths, log_func=None, cancel_event=None, stats=None):
+    """
+    Annotate pdf_path for every profile in one pass. output_pdf_paths is either a list with one
+    output per profile (in profile order) or a single path that receives every profile's
+    annotations. Separate outputs are separate documents, so the file is parsed again from
+    memory for each additional output; it is read from disk and its text extracted only once.
+    Returns the total number of annotations, or None when the PDF could not be opened or an
+    output could not be saved.
+    """
+    if log_func:
+        log_func(f"Processing: {os.path.basename(pdf_path)} ({len(profiles)} profile(s))")
+    combined = isinstance(output_pdf_paths, (str, os.PathLike))
+    try:
+        with open(pdf_path, "rb") as f:
+            data = f.read()
+        doc = fitz.open(stream=data, filetype="pdf")
+    except Exception as e:
+        if log_func:
+            log_func(f"  Error opening PDF: {e}")
+        return
+
+    try:
+        specs = profile_page_specs(doc, profiles, log_func, cancel_event, stats, scoped=combined)
+        if combined:
+            all_specs = sorted((s for profile_specs in specs for s in profile_specs), key=lambda s: s["page"])
+            return annotate_and_save(doc, _on_pages(doc, all_specs), output_pdf_paths, log_func)
+
+        total = 0
+        for number, (profile, profile_specs, out_path) in enumerate(zip(profiles, specs, output_pdf_paths)):
+            if log_func:
+                log_func(f"  Profile {profile.name}: {len(profile_specs)} annotation(s)")
+            # the last output reuses the document the text was extracted from
+            target = doc if number == len(profiles) - 1 else fitz.open(stream=data, filetype="pdf")
+            try:
+                count = annotate_and_save(target, _on_pages(target, profile_specs), out_path, log_func)
+            finally:
+                if target is not doc:
+                    target.close()
+            if count is None:
+                return
+            total += count
+        return total
+    finally:
+        doc.close()
+
+
+class ProfileSet:
+    """The profiles of a process_files batch, passed to its workers in place of a tag sheet."""
+
+    def __init__(self, profiles, combine=False):
+        self.profiles = list(profiles)
+        self.combine = combine
+
+    def tags(self):
+        """Every tag of every profile, in profile and sheet order, without repeats."""
+        seen = {}
+        for profile in self.profiles:
+            for tag in profile.df["tag"]:
+                if not is_missing(tag) and str(tag).strip():
+                    seen.setdefault(str(tag), None)
+        return list(seen)
+
+    def settings_digest(self, output_mode):
+        """Digest of every profile's tag sheet and options (see core.settings_digest)."""
+        h = hashlib.sha256(f"combine={self.combine}".encode("ascii"))
+        for profile in self.profiles:
+            h.update(f"\x1f{profile.name}={settings_digest(profile.df, profile.options, output_mode)}".encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def output_paths(self, pdf_path, output_folder, input_root=None):
+        """The combined output path, or the list of per-profile output paths."""
+        if self.combine:
+            return marked_output_path(pdf_path, output_folder, input_root)
+        return [profile_output_path(pdf_path, output_folder, p, input_root) for p in self.profiles]
+
+    def annotate(self, pdf_path, output_paths, log_func=None, cancel_event=None, stats=None):
+        return update_pdf_with_profiles(pdf_path, self.profiles, output_paths, log_func, cancel_event, stats)
+
+
+def main():
+    from commentpdf.core import process_files
+
+    parser = argparse.ArgumentParser(description="Annotate PDFs with several tag sheet profiles in one pass.")
+    parser.add_argument("pdfs", nargs="+", help="PDF files to annotate")
+    parser.add_argument("--profiles", required=True, help="JSON file with the list of profiles")
+    parser.add_argument("-o", "--output", required=True, help="Output folder")
+    parser.add_argument("--combine", action="store_true", help="Write one output with every profile's annotations")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes (default: 1)")
+    parser.add_argument("--journal", action="store_true", help="Record each file in the run journal (for --resume)")
+    parser.add_argument("--resume", action="store_true", help="Skip files already done with the same profiles")
+    args = parser.parse_args()
+
+    try:
+        profiles = load_profiles_file(args.profiles)
+        summary = process_files(
+            args.pdfs, None, args.output, log_func=print, profiles=profiles, combine=args.combine,
+            workers=args.workers, journal=args.journal, resume=args.resume,
+        )
+    except Exception as e:
+        parser.exit(1, f"Error: {e}\n")
+    print(
+        f"Processed {summary['processed']} of {summary['total']} PDF file(s)"
+        f" ({summary['skipped']} skipped, {summary['failed']} failed)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Batch scheduling: estimate how expensive each PDF is to annotate, order a batch so urgent and
+large files start first, and turn the estimates into a progress fraction and time remaining.
+
+Estimates are in arbitrary "cost units"; only their ratios matter because the time remaining
+is derived from how fast the finished cost was actually processed.
+"""
+import fnmatch
+import os
+import time
+
+# Weights of the cost model. Matching runs one text search per tag per page, so pages dominate,
+# and big files (vector-heavy drawings) load and save slower.
+COST_PER_PAGE = 1.0
+COST_PER_MB = 0.5
+# floor per file (opening and saving is never free), so unreadable files still move the progress
+MIN_FILE_COST = 0.1
+
+
+def file_size_cost(pdf_path):
+    """Cost of pdf_path from its file size alone; never opens the file."""
+    try:
+        return os.path.getsize(pdf_path) / (1024 * 1024) * COST_PER_MB
+    except OSError:
+        return 0.0
+
+
+def estimate_pdf_cost(pdf_path):
+    """
+    Estimate the cost of annotating pdf_path from its file size and page count. Only the
+    document structure is read (no page text), so this stays cheap next to processing the file.
+    Files that cannot be opened are costed by size alone.
+    """
+    import fitz  # PyMuPDF
+
+    cost = file_size_cost(pdf_path)
+    try:
+        with fitz.open(pdf_path) as doc:
+            cost += len(doc) * COST_PER_PAGE
+    except Exception:
+        pass
+    return cost
+
+
+def priority_rank(pdf_path, priority):
+    """
+    Return the index of the first entry in priority matching pdf_path, or len(priority).
+    Entries are file names or glob patterns (matched case-insensitively against the file name)
+    or full paths.
+    """
+    name = os.path.basename(pdf_path).lower()
+    full = os.path.normcase(os.path.abspath(pdf_path))
+    for rank, pattern in enumerate(priority):
+        pattern = str(pattern).strip()
+        if not pattern:
+            continue
+        if os.path.dirname(pattern):
+            if os.path.normcase(os.path.abspath(pattern)) == full:
+                return rank
+        elif fnmatch.fnmatchcase(name, pattern.lower()):
+            return rank
+    return len(priority)
+
+
+def schedule_pdf_paths(pdf_paths, priority=None, cost_func=estimate_pdf_cost):
+    """
+    Return [(pdf_path, cost), ...] in dispatch order: files matching the priority list first (in
+    list order), then longest-processing-time first, so a single huge file is never started last
+    while the other workers sit idle. Ties keep the input order.
+    """
+    priority = list(priority or [])
+    jobs = [(path, max(MIN_FILE_COST, cost_func(path))) for path in pdf_paths]
+    order = sorted(
+        range(len(jobs)),
+        key=lambda i: (priority_rank(jobs[i][0], priority), -jobs[i][1], i),
+    )
+    return [jobs[i] for i in order]
+
+
+class CostProgress:
+    """
+    Cost-weighted progress for a batch. fraction() is the share of the estimated cost finished;
+    eta() extrapolates the remaining cost at the observed rate (seconds per cost unit), which
+    also accounts for any parallelism.
+    """
+
+    def __init__(self, total_cost):
+        self.total_cost = float(total_cost)
+        self.done_cost = 0.0
+        self.started = time.monotonic()
+
+    def add(self, cost):
+        self.done_cost += cost
+
+    def fraction(self):
+        if self.total_cost <= 0:
+            return 1.0
+        return min(1.0, self.done_cost / self.total_cost)
+
+    def eta(self):
+        """Estimated seconds remaining, or None until some cost has been finished."""
+        if self.done_cost <= 0:
+            return None
+        elapsed = time.monotonic() - self.started
+        return max(0.0, elapsed / self.done_cost * (self.total_cost - self.done_cost))
+
+
+def format_eta(seconds):
+    """Format an ETA in seconds as 'm:ss' or 'h:mm:ss' ('--:--' when unknown)."""
+    if seconds is None:
+        return "--:--"
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
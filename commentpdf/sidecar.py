@@ -0,0 +1,323 @@
+"""
+Annotation sidecars: write the computed freetext annotations to an XFDF or JSON file instead of
+rewriting the PDF, and apply such a sidecar to the PDF later.
+
+Usage:
+    python -m commentpdf.sidecar apply drawing.pdf drawing_marked.xfdf [-o drawing_marked.pdf]
+
+The PDF is only ever opened for reading while a sidecar is written, and annotations are written
+out as they are found, so memory use does not grow with the number of hits.
+
+JSON sidecars use PyMuPDF page coordinates (origin top-left); XFDF uses PDF user space
+(origin bottom-left) so review tools can import it directly.
+"""
+import argparse
+import json
+import os
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+import fitz  # PyMuPDF
+
+from commentpdf.core import (
+    ProcessingCancelled,
+    annotation_name,
+    apply_annotation_specs,
+    iter_freetext_annotations,
+    mirrored_output_folder,
+    parse_annotation_name,
+    save_pdf_atomic,
+)
+
+SIDECAR_FORMATS = ("xfdf", "json")
+JSON_FORMAT_NAME = "commentpdf-annotations"
+XFDF_NS = "http://ns.adobe.com/xfdf/"
+# Base-14 font resource names used in a /DA string (as Acrobat and PyMuPDF write them) for the
+# PyMuPDF short names of core.PDF_FONT_MAP, and back
+DA_FONT_NAMES = {"helv": "Helv", "times": "TiRo", "tiro": "TiRo", "cour": "Cour", "symb": "Symb", "zadb": "ZaDb"}
+PDF_FONT_NAMES = {"Helv": "helv", "TiRo": "times", "Cour": "cour", "Symb": "symb", "ZaDb": "zadb"}
+
+
+def sidecar_output_path(pdf_path, output_folder, fmt, input_root=None):
+    """Return the '<name>_marked.<fmt>' sidecar path for pdf_path (see mirrored_output_folder)."""
+    name, _ = os.path.splitext(os.path.basename(pdf_path))
+    return os.path.join(mirrored_output_folder(pdf_path, output_folder, input_root), f"{name}_marked.{fmt}")
+
+
+def _hex_color(rgb):
+    return "#" + "".join(f"{int(round(c * 255)):02X}" for c in rgb)
+
+
+def _parse_hex_color(text, default):
+    if not text or len(text) != 7 or not text.startswith("#"):
+        return default
+    try:
+        return tuple(int(text[i: i + 2], 16) / 255.0 for i in (1, 3, 5))
+    except ValueError:
+        return default
+
+
+class _JsonWriter:
+    def __init__(self, f, pdf_path):
+        self.f = f
+        self.count = 0
+        header = {"format": JSON_FORMAT_NAME, "version": 1, "source": os.path.basename(pdf_path)}
+        # stream the annotations array: write the header object without its closing brace
+        self.f.write(json.dumps(header)[:-1] + ', "annotations": [\n')
+
+    def add(self, page, spec):
+        item = {
+            "page": spec["page"],
+            "annot_id": spec["annot_id"],
+            "rect": list(spec["rect"]),
+            "content": spec["content"],
+            "tag": spec["tag"],
+            "subject": spec["subject"],
+            "font_family": spec["font_family"],
+            "pdf_fontname": spec["pdf_fontname"],
+            "font_size": spec["font_size"],
+            "text_color": list(spec["text_color"]),
+            "fill_color": list(spec["fill_color"]),
+            "border_color": list(spec["border_color"]),
+        }
+        self.f.write((",\n" if self.count else "") + json.dumps(item))
+        self.count += 1
+
+    def close(self):
+        self.f.write(f'\n], "count": {self.count}}}\n')
+
+
+class _XfdfWriter:
+    def __init__(self, f, pdf_path):
+        self.f = f
+        self.count = 0
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.f.write(f'<xfdf xmlns="{XFDF_NS}" xml:space="preserve">\n')
+        self.f.write(f"<f href={quoteattr(os.path.basename(pdf_path))}/>\n<annots>\n")
+
+    def add(self, page, spec):
+        # XFDF rects are in PDF user space; transformation_matrix maps PDF -> PyMuPDF coordinates
+        r = spec["rect"] * ~page.transformation_matrix
+        r.normalize()
+        tc = " ".join(f"{c:g}" for c in spec["text_color"])
+        font = DA_FONT_NAMES.get(spec["pdf_fontname"].lower(), "Helv")
+        attrs = {
+            "page": str(spec["page"]),
+            "name": annotation_name(spec),
+            "rect": ",".join(f"{v:.4f}" for v in r),
+            "subject": spec["subject"],
+            "title": spec["tag"],
+            "color": _hex_color(spec["fill_color"]),
+            "width": "0.5",
+            "dashes": "2",
+            "flags": "print",
+        }
+        attr_text = " ".join(f"{k}={quoteattr(str(v))}" for k, v in attrs.items())
+        self.f.write(
+            f"<freetext {attr_text}>"
+            f"<contents>{escape(spec['content'])}</contents>"
+            f"<defaultappearance>{tc} rg /{font} {spec['font_size']:g} Tf</defaultappearance>"
+            f"<defaultstyle>font: {spec['font_family']} {spec['font_size']:g}pt; "
+            f"color: {_hex_color(spec['text_color'])}</defaultstyle>"
+            f"</freetext>\n"
+        )
+        self.count += 1
+
+    def close(self):
+        self.f.write("</annots>\n</xfdf>\n")
+
+
+def write_annotation_sidecar(
+    pdf_path,
+    df,
+    sidecar_path,
+    fmt="xfdf",
+    subject="Comment",
+    distance=10,
+    log_func=None,
+    font_family="Arial",
+    font_size=12,
+    case_sensitive=False,
+    whole_word=False,
+    use_regex=False,
+    cancel_event=None,
+    wrap_width=None,
+    stats=None,
+):
+    """
+    Write the annotations update_pdf_with_comments would add to pdf_path into an XFDF or JSON
+    sidecar, streaming them as they are found. The PDF itself is opened read-only and never saved.
+
+    Returns the number of annotations written, or None when the PDF could not be opened.
+    Raises ProcessingCancelled (leaving no sidecar behind) when cancel_event is set mid-file.
+    """
+    if fmt not in SIDECAR_FORMATS:
+        raise ValueError(f"Unknown sidecar format '{fmt}' (expected one of {', '.join(SIDECAR_FORMATS)})")
+    if log_func:
+        log_func(f"Processing: {os.path.basename(pdf_path)}")
+
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        if log_func:
+            log_func(f"  Error opening PDF: {e}")
+        return
+
+    writer_cls = _XfdfWriter if fmt == "xfdf" else _JsonWriter
+    # write to a temporary name so an interrupted run never leaves a truncated sidecar behind
+    tmp_path = sidecar_path + ".part"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            writer = writer_cls(f, pdf_path)
+            for page, spec in iter_freetext_annotations(
+                doc,
+                df,
+                subject=subject,
+                distance=distance,
+                log_func=log_func,
+                font_family=font_family,
+                font_size=font_size,
+                case_sensitive=case_sensitive,
+                whole_word=whole_word,
+                use_regex=use_regex,
+                cancel_event=cancel_event,
+                wrap_width=wrap_width,
+                stats=stats,
+            ):
+                writer.add(page, spec)
+            writer.close()
+        os.replace(tmp_path, sidecar_path)
+    except Exception as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        if isinstance(e, ProcessingCancelled):
+            raise
+        if log_func:
+            log_func(f"  Error writing sidecar: {e}")
+        return
+    finally:
+        doc.close()
+
+    if log_func:
+        log_func(f"Saved: {os.path.basename(sidecar_path)} (Total annotations: {writer.count})")
+    return writer.count
+
+
+def read_annotation_sidecar(sidecar_path):
+    """
+    Read an XFDF or JSON sidecar and return (fmt, specs). XFDF rects are left in PDF user space
+    (apply_annotation_sidecar converts them per page).
+    """
+    fmt = os.path.splitext(sidecar_path)[1].lower().lstrip(".")
+    if fmt == "json":
+        with open(sidecar_path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != JSON_FORMAT_NAME:
+            raise ValueError(f"{os.path.basename(sidecar_path)} is not a CommentPdfFromExcel sidecar")
+        specs = []
+        for item in data.get("annotations", []):
+            spec = dict(item)
+            spec["rect"] = fitz.Rect(item["rect"])
+            for key in ("text_color", "fill_color", "border_color"):
+                spec[key] = tuple(item.get(key) or (0, 0, 0))
+            specs.append(spec)
+        return fmt, specs
+
+    if fmt == "xfdf":
+        specs = []
+        ns = {"x": XFDF_NS}
+        root = ET.parse(sidecar_path).getroot()
+        for el in root.iterfind("x:annots/x:freetext", ns):
+            contents = el.find("x:contents", ns)
+            da = el.findtext("x:defaultappearance", default="", namespaces=ns).split()
+            # "<r> <g> <b> rg /<Font> <size> Tf"
+            text_color = (0, 0, 0)
+            pdf_fontname, font_size = "helv", 12
+            if "rg" in da and da.index("rg") >= 3:
+                i = da.index("rg")
+                text_color = tuple(float(v) for v in da[i - 3: i])
+            if "Tf" in da and da.index("Tf") >= 2:
+                i = da.index("Tf")
+                font = da[i - 2].lstrip("/")
+                pdf_fontname = PDF_FONT_NAMES.get(font, font.lower())
+                font_size = float(da[i - 1])
+            parsed = parse_annotation_name(el.get("name", ""))
+            specs.append(
+                {
+                    "page": int(el.get("page", "0")),
+                    "annot_id": parsed[0] if parsed else None,
+                    "rect": fitz.Rect([float(v) for v in el.get("rect", "0,0,0,0").split(",")]),
+                    "content": contents.text if contents is not None and contents.text else "",
+                    "tag": el.get("title", ""),
+                    "subject": el.get("subject", "Comment"),
+                    "pdf_fontname": pdf_fontname,
+                    "font_size": font_size,
+                    "text_color": text_color,
+                    "fill_color": _parse_hex_color(el.get("color"), (1, 1, 0)),
+                    "border_color": (0, 0, 0),
+                }
+            )
+        return fmt, specs
+
+    raise ValueError(f"Unknown sidecar type '{sidecar_path}' (expected .xfdf or .json)")
+
+
+def _sidecar_page_specs(doc, fmt, specs, log_func=None):
+    """(page, spec) pairs for apply_annotation_specs, with XFDF rects converted to page coordinates."""
+    page = None
+    for spec in specs:
+        if not 0 <= spec["page"] < len(doc):
+            if log_func:
+                log_func(f"  Skipping annotation for missing page {spec['page'] + 1}")
+            continue
+        if page is None or page.number != spec["page"]:
+            page = doc[spec["page"]]
+        if fmt == "xfdf":
+            spec["rect"] = spec["rect"] * page.transformation_matrix
+            spec["rect"].normalize()
+        yield page, spec
+
+
+def apply_annotation_sidecar(pdf_path, sidecar_path, output_pdf_path, log_func=None):
+    """
+    Add the freetext annotations recorded in an XFDF/JSON sidecar to pdf_path and save the result
+    to output_pdf_path. Annotations an earlier run or apply left in the PDF are kept, replaced or
+    removed to match the sidecar instead of being duplicated. Returns the number of tool
+    annotations in the output.
+    """
+    fmt, specs = read_annotation_sidecar(sidecar_path)
+    doc = fitz.open(pdf_path)
+    try:
+        reconciler = apply_annotation_specs(doc, _sidecar_page_specs(doc, fmt, specs, log_func), log_func)
+        save_pdf_atomic(doc, output_pdf_path, **reconciler.save_options())
+    finally:
+        doc.close()
+    if log_func:
+        log_func(f"Saved: {os.path.basename(output_pdf_path)} (Total annotations: {reconciler.total})")
+    return reconciler.total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work with CommentPdfFromExcel annotation sidecars.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    apply_p = sub.add_parser("apply", help="Merge an XFDF/JSON sidecar into its PDF")
+    apply_p.add_argument("pdf")
+    apply_p.add_argument("sidecar")
+    apply_p.add_argument("-o", "--output", default=None,
+                         help="Output PDF (default: '<name>_marked.pdf' next to the input)")
+    args = parser.parse_args(argv)
+
+    output = args.output
+    if not output:
+        name, ext = os.path.splitext(args.pdf)
+        output = f"{name}_marked{ext}"
+    try:
+        apply_annotation_sidecar(args.pdf, args.sidecar, output, log_func=print)
+    except Exception as e:
+        parser.exit(1, f"Error: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
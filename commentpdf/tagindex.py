@@ -0,0 +1,463 @@
+"""
+Compiled tag index: a tag sheet turned into one binary file that opens in milliseconds and is
+memory-mapped read-only, so every worker process shares the same pages instead of parsing the
+workbook again.
+
+Usage:
+    python -m commentpdf.tagindex compile --excel register.xlsx [--all-sheets] [-o register.cpidx]
+    python -m commentpdf.tagindex info register.cpidx
+
+A '.cpidx' path can be used wherever a workbook is accepted (load_tag_sheet opens it). The index
+holds the merged, deduplicated rows of load_tag_sheet as UTF-8 string tables and numeric columns,
+the width of every comment in each PDF base font, and a trigram prefilter: each tag is filed under
+its rarest three-character substring (case-folded), so a page only has to check the tags whose
+trigram occurs in its text. Tags shorter than three characters are always checked. Regex
+matching cannot be prefiltered and checks every row.
+
+The index records the SHA-256 of its source workbooks; when a workbook changes, the index is
+recompiled the next time it is opened (or used as is when the workbooks are not reachable).
+Workbooks whose size and modification time still match the ones recorded at compile time are
+not hashed again, and a digest computed once is reused in-process until the workbooks change.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import Counter
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from commentpdf.core import (
+    OVERRIDE_COLUMNS,
+    PDF_FONT_MAP,
+    TAG_INDEX_SUFFIX,
+    WIDTH_SAFETY,
+    add_tag_sheet_arguments,
+    file_sha256,
+    is_missing,
+    load_tag_sheet,
+    sheet_names_from_args,
+)
+
+FORMAT_NAME = "commentpdf-tag-index"
+FORMAT_VERSION = 1
+_MAGIC = b"CPIDX\x00\x00\x01"
+# magic, header offset, header length
+_PREAMBLE = struct.Struct("<8sQQ")
+# PDF base fonts comment widths are precomputed for
+PDF_FONTNAMES = tuple(sorted({fontname for fontname, _ in PDF_FONT_MAP.values()}))
+_STRING_COLUMNS = ("tag", "comment", "source", "subject", "font")
+_NUMBER_COLUMNS = ("distance", "font_size")
+# (workbooks, sheet selection, their signatures) -> source_digest, so reopening does not re-hash
+_DIGEST_CACHE = {}
+
+
+def default_index_path(excel_path):
+    """'<workbook without extension>.cpidx' next to the (first) workbook."""
+    first = excel_path if isinstance(excel_path, (str, os.PathLike)) else list(excel_path)[0]
+    return os.path.splitext(os.fspath(first))[0] + TAG_INDEX_SUFFIX
+
+
+def source_signatures(excel_paths):
+    """[[size, mtime_ns], ...] of the workbooks, or None when one of them cannot be stat'ed."""
+    signatures = []
+    for path in excel_paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signatures.append([st.st_size, st.st_mtime_ns])
+    return signatures
+
+
+def source_digest(excel_paths, sheet_names=None, signatures=None):
+    """
+    Digest of the workbooks' contents (in order), the sheet selection and the index format.
+    With signatures (see source_signatures), a digest already computed for the same workbook
+    signatures is returned without reading them.
+    """
+    key = None
+    if signatures is not None:
+        key = (json.dumps([[os.path.abspath(p) for p in excel_paths], sheet_names]), json.dumps(signatures))
+        if key in _DIGEST_CACHE:
+            return _DIGEST_CACHE[key]
+    h = hashlib.sha256()
+    h.update(json.dumps([FORMAT_VERSION, sheet_names]).encode("utf-8"))
+    for path in excel_paths:
+        h.update(file_sha256(path).encode("ascii"))
+    if key is not None:
+        _DIGEST_CACHE[key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def _gram_key(gram):
+    # three code points of at most 21 bits each fit one uint64
+    return (ord(gram[0]) << 42) | (ord(gram[1]) << 21) | ord(gram[2])
+
+
+def _text_grams(text):
+    return {text[i: i + 3] for i in range(len(text) - 2)}
+
+
+def _string_table(values):
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, b"".join(encoded)
+
+
+def _build_sections(df):
+    """Return {section name: numpy array or bytes} for a load_tag_sheet DataFrame."""
+    n = len(df)
+    sections = {}
+    columns = [c for c in _STRING_COLUMNS if c in df.columns]
+    for col in columns:
+        values = ["" if is_missing(v) else str(v) for v in df[col]]
+        sections[f"{col}.offsets"], sections[f"{col}.data"] = _string_table(values)
+    for col in _NUMBER_COLUMNS:
+        if col in df.columns:
+            columns.append(col)
+            sections[col] = np.array([np.nan if is_missing(v) else float(v) for v in df[col]], dtype=np.float64)
+    if "color" in df.columns:
+        columns.append("color")
+        colors = np.full((n, 3), np.nan, dtype=np.float64)
+        for i, value in enumerate(df["color"]):
+            if isinstance(value, (tuple, list)):
+                colors[i] = value
+        sections["color"] = colors
+
+    # widths at font size 1; NaN where PyMuPDF cannot measure (the engine then measures itself)
+    widths = np.full((n, len(PDF_FONTNAMES)), np.nan, dtype=np.float64)
+    measured = {}
+    for i, comment in enumerate(df["comment"]):
+        row_widths = measured.get(comment)
+        if row_widths is None:
+            row_widths = []
+            for fontname in PDF_FONTNAMES:
+                try:
+                    w = float(fitz.get_text_length(comment, fontname=fontname, fontsize=1))
+                except Exception:
+                    w = 0.0
+                row_widths.append(w if w > 0 else np.nan)
+            measured[comment] = row_widths
+        widths[i] = row_widths
+    sections["widths"] = widths
+
+    # trigram prefilter: file each tag under its rarest trigram
+    folded = [str(tag).casefold() for tag in df["tag"]]
+    frequency = Counter()
+    for text in folded:
+        frequency.update(_text_grams(text))
+    keys = np.zeros(n, dtype=np.uint64)
+    short = []
+    for i, text in enumerate(folded):
+        grams = _text_grams(text)
+        if not grams:
+            short.append(i)
+            continue
+        keys[i] = _gram_key(min(grams, key=lambda g: (frequency[g], g)))
+    indexed = np.setdiff1d(np.arange(n, dtype=np.uint32), np.asarray(short, dtype=np.uint32))
+    order = indexed[np.argsort(keys[indexed], kind="stable")]
+    gram_keys, starts = np.unique(keys[order], return_index=True)
+    sections["gram.keys"] = gram_keys.astype(np.uint64)
+    sections["gram.starts"] = np.append(starts, len(order)).astype(np.uint64)
+    sections["gram.rows"] = order.astype(np.uint32)
+    sections["short.rows"] = np.asarray(short, dtype=np.uint32)
+    return columns, sections
+
+
+def write_tag_index(df, index_path, sources=(), sheet_names=None, digest=None, signatures=None):
+    """
+    Write a load_tag_sheet DataFrame to index_path (via a '.part' file and an atomic rename).
+    digest and signatures describe the sources (see source_digest and source_signatures).
+    """
+    columns, sections = _build_sections(df)
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "rows": len(df),
+        "columns": columns,
+        "sources": [os.path.abspath(p) for p in sources],
+        "sheet_names": sheet_names,
+        "source_digest": digest,
+        "source_signatures": signatures,
+        "conflicts": df.attrs.get("conflicts", []),
+        "sections": {},
+    }
+    tmp_path = index_path + ".part"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(_PREAMBLE.pack(_MAGIC, 0, 0))
+            for name, data in sections.items():
+                # 8-byte alignment keeps every array directly viewable from the map
+                f.write(b"\0" * (-f.tell() % 8))
+                offset = f.tell()
+                if isinstance(data, np.ndarray):
+                    data = np.ascontiguousarray(data)
+                    f.write(data.tobytes())
+                    header["sections"][name] = [offset, data.dtype.str, list(data.shape)]
+                else:
+                    f.write(data)
+                    header["sections"][name] = [offset, "bytes", [len(data)]]
+            header_bytes = json.dumps(header, ensure_ascii=False, default=str).encode("utf-8")
+            header_offset = f.tell()
+            f.write(header_bytes)
+            f.seek(0)
+            f.write(_PREAMBLE.pack(_MAGIC, header_offset, len(header_bytes)))
+        os.replace(tmp_path, index_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return index_path
+
+
+def compile_tag_index(excel_path, sheet_names=None, index_path=None, log_func=None):
+    """Compile the tag sheet(s) (see load_tag_sheet) into a tag index file; returns its path."""
+    paths = [excel_path] if isinstance(excel_path, (str, os.PathLike)) else list(excel_path)
+    index_path = index_path or default_index_path(paths)
+    # stat before hashing: a workbook saved meanwhile then fails the signature check next time
+    signatures = source_signatures(paths)
+    digest = source_digest(paths, sheet_names, signatures)
+    df = load_tag_sheet(paths, sheet_names, log_func)
+    write_tag_index(df, index_path, paths, sheet_names, digest, signatures)
+    if log_func:
+        log_func(f"Compiled {len(df)} tag(s) into {os.path.basename(index_path)}")
+    return index_path
+
+
+class _IndexRow:
+    """One row of a TagIndex, read like a pandas row (row['tag'], row.get('subject'))."""
+
+    __slots__ = ("_index", "_i")
+
+    def __init__(self, index, i):
+        self._index = index
+        self._i = i
+
+    def __getitem__(self, col):
+        if col not in self._index.columns:
+            raise KeyError(col)
+        return self._index.value(col, self._i)
+
+    def get(self, col, default=None):
+        if col not in self._index.columns:
+            return default
+        value = self._index.value(col, self._i)
+        return default if value is None else value
+
+    def text_width(self, pdf_fontname, font_size):
+        """Precomputed width in points of the row's comment (with the usual margin), or None."""
+        try:
+            col = PDF_FONTNAMES.index(pdf_fontname)
+        except ValueError:
+            return None
+        width = float(self._index._widths[self._i, col])
+        if width != width:
+            return None
+        return width * float(font_size) * WIDTH_SAFETY
+
+
+class _Column:
+    """Read-only sequence view of one TagIndex column."""
+
+    def __init__(self, index, col):
+        self._index = index
+        self._col = col
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        return self._index.value(self._col, i)
+
+    def __iter__(self):
+        return (self._index.value(self._col, i) for i in range(len(self._index)))
+
+
+class TagIndex:
+    """
+    A memory-mapped tag index. It can stand in for the load_tag_sheet DataFrame in the engine
+    (len, df[col], iterrows(), attrs['conflicts']), and iter_candidate_rows() adds the trigram
+    prefilter. Pickling reopens the file, so worker processes share the mapping.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_offset, header_len = _PREAMBLE.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self._mm.close()
+            raise RuntimeError(f"{os.path.basename(path)} is not a tag index file")
+        header = json.loads(self._mm[header_offset: header_offset + header_len].decode("utf-8"))
+        if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+            self._mm.close()
+            raise RuntimeError(f"{os.path.basename(path)} was written by another version; compile it again")
+        self.header = header
+        self.columns = header["columns"]
+        self.sources = header["sources"]
+        self.sheet_names = header["sheet_names"]
+        self.source_digest = header["source_digest"]
+        self.attrs = {"conflicts": header.get("conflicts", [])}
+        self._rows = header["rows"]
+        self._sections = {name: self._section(name) for name in header["sections"]}
+        self._widths = self._sections["widths"]
+        self._gram_keys = self._sections["gram.keys"]
+        self._gram_starts = self._sections["gram.starts"]
+        self._gram_rows = self._sections["gram.rows"]
+        self._short_rows = self._sections["short.rows"]
+        self._numbers = {col: self._sections[col] for col in _NUMBER_COLUMNS + ("color",) if col in self._sections}
+
+    def _section(self, name):
+        offset, dtype, shape = self.header["sections"][name]
+        if dtype == "bytes":
+            return memoryview(self._mm)[offset: offset + shape[0]]
+        count = int(np.prod(shape)) if shape else 1
+        # a view into the map: nothing is copied or read until it is touched
+        return np.frombuffer(self._mm, dtype=np.dtype(dtype), count=count, offset=offset).reshape(shape)
+
+    def __reduce__(self):
+        return (open_tag_index, (self.path, False))
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, col):
+        if col not in self.columns:
+            raise KeyError(col)
+        return _Column(self, col)
+
+    def value(self, col, i):
+        """The value of column col in row i (None for an empty override)."""
+        if col in self._numbers:
+            value = self._numbers[col][i]
+            if col == "color":
+                return None if np.isnan(value[0]) else tuple(float(c) for c in value)
+            return None if np.isnan(value) else float(value)
+        offsets = self._sections[f"{col}.offsets"]
+        text = bytes(self._sections[f"{col}.data"][int(offsets[i]): int(offsets[i + 1])]).decode("utf-8")
+        if not text and col in OVERRIDE_COLUMNS:
+            return None
+        return text
+
+    def iterrows(self):
+        for i in range(self._rows):
+            yield i, _IndexRow(self, i)
+
+    def candidate_rows(self, page_text):
+        """Sorted row numbers whose tag may occur (case-insensitively) in page_text."""
+        codes = np.frombuffer(page_text.casefold().encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        parts = [self._short_rows]
+        if len(codes) >= 3 and len(self._gram_keys):
+            keys = np.unique((codes[:-2] << np.uint64(42)) | (codes[1:-1] << np.uint64(21)) | codes[2:])
+            pos = np.searchsorted(self._gram_keys, keys)
+            found = pos < len(self._gram_keys)
+            found[found] = self._gram_keys[pos[found]] == keys[found]
+            for j in pos[found]:
+                parts.append(self._gram_rows[int(self._gram_starts[j]): int(self._gram_starts[j + 1])])
+        return np.unique(np.concatenate(parts)) if len(parts) > 1 else np.asarray(self._short_rows)
+
+    def iter_candidate_rows(self, page_text):
+        """Like iterrows(), but only for the rows candidate_rows() keeps (in sheet order)."""
+        for i in self.candidate_rows(page_text):
+            yield int(i), _IndexRow(self, int(i))
+
+    def matches(self, excel_paths, sheet_names=None):
+        """
+        True when the index was compiled from excel_paths (as they are now) with sheet_names.
+        Unchanged sizes and modification times are trusted without hashing the workbooks.
+        """
+        signatures = source_signatures(excel_paths)
+        if (
+            signatures is not None
+            and signatures == self.header.get("source_signatures")
+            and [os.path.abspath(p) for p in excel_paths] == self.sources
+            and json.dumps(sheet_names) == json.dumps(self.sheet_names)
+        ):
+            return True
+        return source_digest(excel_paths, sheet_names, signatures) == self.source_digest
+
+    def is_current(self):
+        """False when a source workbook is reachable and no longer matches the recorded digest."""
+        if not self.sources or not all(os.path.isfile(p) for p in self.sources):
+            return True
+        return self.matches(self.sources, self.sheet_names)
+
+    def close(self):
+        # numpy views keep the map alive until they are released
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+
+
+def open_tag_index(path, verify=True, log_func=None):
+    """
+    Open a tag index. With verify, an index whose source workbooks have changed is recompiled
+    first; when the workbooks cannot be reached the index is used as it is.
+    """
+    index = TagIndex(path)
+    if not verify:
+        return index
+    if not index.sources or not all(os.path.isfile(p) for p in index.sources):
+        if log_func:
+            log_func(f"Using {os.path.basename(path)} without checking it: its source workbooks are not reachable")
+        return index
+    if index.is_current():
+        return index
+    if log_func:
+        log_func(f"{os.path.basename(path)} is out of date; compiling it again")
+    sources, sheet_names = index.sources, index.sheet_names
+    index.close()
+    compile_tag_index(sources, sheet_names, path, log_func)
+    return TagIndex(path)
+
+
+def load_tag_index(excel_path, sheet_names=None, index_path=None, log_func=None):
+    """Open the index of the given workbook(s), compiling it first when it is missing or stale."""
+    paths = [excel_path] if isinstance(excel_path, (str, os.PathLike)) else list(excel_path)
+    index_path = index_path or default_index_path(paths)
+    if os.path.exists(index_path):
+        try:
+            index = TagIndex(index_path)
+        except RuntimeError:
+            index = None
+        if index is not None:
+            if index.matches(paths, sheet_names):
+                return index
+            index.close()
+    compile_tag_index(paths, sheet_names, index_path, log_func)
+    return TagIndex(index_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile tag sheets into a memory-mapped tag index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compile_p = sub.add_parser("compile", help="Compile workbook(s) into a .cpidx file")
+    add_tag_sheet_arguments(compile_p)
+    compile_p.add_argument("-o", "--output", default=None,
+                           help=f"Index file (default: the first workbook with a {TAG_INDEX_SUFFIX} extension)")
+    info_p = sub.add_parser("info", help="Describe an index file and check it against its workbooks")
+    info_p.add_argument("index")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "compile":
+            compile_tag_index(args.excel, sheet_names_from_args(args), args.output, log_func=print)
+        else:
+            index = TagIndex(args.index)
+            print(f"{index.path}: {len(index)} tag(s), columns: {', '.join(index.columns)}")
+            print(f"Sources: {', '.join(index.sources) or '-'} (sheets: {index.sheet_names or 'first'})")
+            print("Up to date" if index.is_current() else "Out of date: the workbooks have changed")
+    except RuntimeError as e:
+        parser.exit(1, f"Error: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+"""
+Per-file watchdog for process_files: a cheap pre-scan that flags PDFs not worth processing,
+and supervised worker processes that are killed when a file exceeds its time or memory limits.
+
+Usage:
+    from commentpdf import process_files
+    from commentpdf.watchdog import FileLimits
+
+    process_files(pdfs, "tags.xlsx", "out", prescan=True,
+                  limits=FileLimits(seconds=600, page_seconds=120, memory_mb=2048))
+
+With limits, files run in supervised worker processes (up to `workers` at a time) that receive
+the tag sheet once and take one file after another. A file that runs too long in total, spends
+too long on one page, uses too much memory or crashes its process is killed together with its
+worker (which is replaced, and whose partial output is removed) and recorded in the quarantine
+list (QUARANTINE_NAME in the output folder) with the reason; the batch continues with the next
+file. The pre-scan quarantines files that cannot be opened, need a password, have no pages or
+contain no text at all (no page uses a font, e.g. scans without OCR), so no tag could ever
+match; it only reads the page resources, not the text.
+
+Memory is measured as the growth of the worker's resident set size (read from /proc) over what it
+used when the file started, so memory inherited from the parent or kept from earlier files does
+not count; where /proc is not available the limit is set as the worker's address-space limit
+instead (POSIX only). Where neither is available (Windows) memory_mb cannot be enforced and
+process_files logs a warning.
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+QUARANTINE_NAME = "commentpdf_quarantine.json"
+# how often the parent checks its workers and a worker publishes its page progress
+POLL_INTERVAL = 0.1
+
+
+class FileLimits:
+    """
+    Limits for one file, each None for no limit: seconds (whole file: open, match, save),
+    page_seconds (without progress from one page to the next) and memory_mb (resident memory
+    the process handling the file gains while working on it).
+    """
+
+    def __init__(self, seconds=None, page_seconds=None, memory_mb=None):
+        self.seconds = seconds
+        self.page_seconds = page_seconds
+        self.memory_mb = memory_mb
+
+    def __repr__(self):
+        return f"FileLimits(seconds={self.seconds}, page_seconds={self.page_seconds}, memory_mb={self.memory_mb})"
+
+
+def prescan_pdf(pdf_path, log_func=None):
+    """
+    Return the reason pdf_path is not worth processing, or None. Damaged files that MuPDF could
+    repair on opening are only reported through log_func.
+    """
+    import fitz  # PyMuPDF
+
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        return f"damaged: cannot be opened ({e})"
+    try:
+        if doc.needs_pass:
+            return "encrypted: a password is required"
+        if not len(doc):
+            return "damaged: no pages"
+        if doc.is_repaired and log_func:
+            log_func(f"  {os.path.basename(pdf_path)} is damaged but was repaired on opening")
+        try:
+            if not any(doc.get_page_fonts(i) for i in range(len(doc))):
+                return "no text: no page contains text (scanned without OCR?)"
+        except Exception as e:
+            return f"damaged: page resources cannot be read ({e})"
+    finally:
+        doc.close()
+    return None
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Quarantine:
+    """
+    The files set aside in a batch, saved as a JSON list at path whenever one is added. With
+    resume=True the list of the previous run is kept and its files (unless changed since) are
+    skipped; otherwise it starts empty.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for entry in json.load(f):
+                        self.entries[entry["file"]] = entry
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def get(self, pdf_path):
+        """Return the entry of pdf_path if it is quarantined and unchanged since, else None."""
+        entry = self.entries.get(os.path.abspath(pdf_path))
+        try:
+            if entry and entry.get("signature") == _file_signature(pdf_path):
+                return entry
+        except OSError:
+            pass
+        return None
+
+    def add(self, pdf_path, reason, stage):
+        """Quarantine pdf_path; stage is "prescan" or "limits"."""
+        entry = {
+            "file": os.path.abspath(pdf_path),
+            "reason": reason,
+            "stage": stage,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        try:
+            entry["signature"] = _file_signature(pdf_path)
+        except OSError:
+            pass
+        self.entries[entry["file"]] = entry
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.values()), f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        os.replace(tmp_path, self.path)
+
+
+def _rss_bytes(pid):
+    """Resident memory of process pid, or None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def memory_limit_supported():
+    """Whether FileLimits.memory_mb can be enforced on this platform."""
+    if _rss_bytes(os.getpid()) is not None:
+        return True
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# the shared progress array of a worker process, for the task it is running
+_TASK_PROGRESS = None
+
+
+def _worker_main(conn, progress, initializer, initargs, memory_bytes):
+    """
+    Worker process: run initializer(*initargs) once, then each (func, args) task received on
+    conn, answering ("done", result), ("error", exception) or ("limit", "out of memory"). The
+    resident memory when a task starts is published, in KiB, to progress[2].
+    """
+    global _TASK_PROGRESS
+    _TASK_PROGRESS = progress
+    if memory_bytes and _rss_bytes(os.getpid()) is None:
+        try:
+            import resource
+
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+        except (ImportError, ValueError, OSError):
+            pass
+    initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        func, args = task
+        rss = _rss_bytes(os.getpid())
+        progress[2] = rss // 1024 if rss is not None else -1
+        try:
+            reply = ("done", func(*args))
+        except MemoryError:
+            reply = ("limit", "out of memory")
+        except Exception as e:
+            reply = ("error", e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # a result or exception that cannot be pickled
+            conn.send(("error", RuntimeError(str(reply[1]))))
+
+
+class SupervisedWorker:
+    """
+    A long-lived worker process: initializer(*initargs) runs once when it starts (e.g. to
+    receive the tag sheet), then it runs the tasks given to run() one at a time. A worker that
+    was killed or crashed cannot be reused; start a new one in its place (see WorkerPool).
+    """
+
+    def __init__(self, initializer, initargs=(), memory_mb=None):
+        # [pages done, page count (-1 until known), resident KiB when the task started (-1 until measured)]
+        self.progress = multiprocessing.Array("i", [0, -1, -1], lock=False)
+        self._conn, child_conn = multiprocessing.Pipe()
+        memory_bytes = int(memory_mb * 1024 * 1024) if memory_mb else None
+        self._process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, self.progress, initializer, initargs, memory_bytes),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self.started = None
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def run(self, func, *args):
+        """Start func(*args) (a module-level function) in the worker; poll() returns its outcome."""
+        self.progress[0], self.progress[1], self.progress[2] = 0, -1, -1
+        self.started = time.monotonic()
+        self._conn.send((func, args))
+
+    def poll(self, timeout=0):
+        """
+        Wait up to timeout seconds for the task to end and return (kind, value): ("done", result),
+        ("error", exception), ("limit", reason) when it ran out of memory or ("crashed", reason)
+        when the process died. Returns None while it is still running.
+        """
+        try:
+            if not self._conn.poll(timeout):
+                return None
+            return self._conn.recv()
+        except (EOFError, OSError):
+            # the pipe is closed: the process is exiting
+            self._process.join(5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        code = self._process.exitcode
+        reason = f"killed by signal {-code}" if code and code < 0 else f"exited with code {code}"
+        return "crashed", f"worker process crashed ({reason})"
+
+    def memory_growth(self):
+        """Bytes of resident memory gained since the task started, or None where it is not known."""
+        baseline_kib = self.progress[2]
+        rss = _rss_bytes(self._process.pid)
+        if baseline_kib < 0 or rss is None:
+            return None
+        return rss - baseline_kib * 1024
+
+    def kill(self):
+        """Stop the process at once, whatever it is doing."""
+        if self._process.is_alive():
+            self._process.kill()
+        self._process.join()
+        self._conn.close()
+
+    def close(self):
+        """Let an idle worker exit."""
+        try:
+            self._conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self._process.join(timeout=5)
+        self.kill()
+
+
+class WorkerPool:
+    """
+    Up to size SupervisedWorker processes started with the same initializer. Workers are reused
+    from task to task; one that was killed or crashed is replaced by a new one when a worker is
+    next needed. Safe to use from several threads.
+    """
+
+    def __init__(self, size, initializer, initargs=(), memory_mb=None):
+        self.size = max(1, int(size))
+        self.initializer = initializer
+        self.initargs = initargs
+        self.memory_mb = memory_mb
+        self._idle = []
+        self._workers = set()
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def warm(self, timeout=None):
+        """Start every worker and wait until each has run its initializer; return their PIDs."""
+        workers = [self.acquire() for _ in range(self.size)]
+        for worker in workers:
+            worker.run(os.getpid)
+        pids = []
+        for worker in workers:
+            result = worker.poll(timeout)
+            if result and result[0] == "done":
+                pids.append(result[1])
+            self.release(worker)
+        return pids
+
+    def acquire(self, timeout=None):
+        """Take an idle worker, starting one while fewer than size exist; None after timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("worker pool is closed")
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.is_alive():
+                        return worker
+                    # died while idle
+                    worker.kill()
+                    self._workers.discard(worker)
+                    self._count -= 1
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+        return self._start_worker()
+
+    def _start_worker(self):
+        # the caller has counted the worker already
+        try:
+            worker = SupervisedWorker(self.initializer, self.initargs, self.memory_mb)
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._workers.add(worker)
+        return worker
+
+    def replenish(self):
+        """Start idle workers in place of those killed or crashed, up to size."""
+        while True:
+            with self._cond:
+                if self._closed or self._count >= self.size:
+                    return
+                self._count += 1
+            worker = self._start_worker()
+            self.release(worker)
+
+    def pids(self):
+        """Process IDs of the running workers, idle or busy."""
+        with self._cond:
+            return sorted(w.pid for w in self._workers if w.is_alive())
+
+    def release(self, worker):
+        """Give a worker back after its task; a killed or crashed one makes room for a new one."""
+        with self._cond:
+            if worker.is_alive() and not self._closed:
+                self._idle.append(worker)
+            else:
+                worker.kill()
+                self._workers.discard(worker)
+                self._count -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Stop the idle workers; workers still busy are stopped when they are released."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._workers.difference_update(idle)
+            self._count -= len(idle)
+            self._cond.notify_all()
+        for worker in idle:
+            worker.close()
+
+
+def _supervised_file(pdf_path, out_path):
+    """Worker task: annotate one file with the worker's tag sheet, publishing the pages done."""
+    import fitz  # PyMuPDF
+
+    from commentpdf.batch import process_in_worker
+    from commentpdf.metrics import new_file_stats
+
+    progress = _TASK_PROGRESS
+    try:
+        with fitz.open(pdf_path) as doc:
+            progress[1] = len(doc)
+    except Exception:
+        # update_pdf_with_comments reports it
+        pass
+    stats = new_file_stats()
+    done = threading.Event()
+
+    def publish():
+        # a page that holds the GIL inside MuPDF stops this thread too, which is fine: the
+        # parent only sees that the page count did not move
+        while not done.wait(POLL_INTERVAL):
+            progress[0] = stats["pages"]
+
+    threading.Thread(target=publish, daemon=True).start()
+    try:
+        return process_in_worker(pdf_path, out_path, stats)
+    finally:
+        done.set()
+
+
+def _remove_partial_outputs(out_path):
+    """Delete the '.part' files a killed worker may have left for out_path (a path or list of paths)."""
+    for path in [out_path] if isinstance(out_path, (str, os.PathLike)) else out_path:
+        try:
+            os.remove(os.fspath(path) + ".part")
+        except OSError:
+            pass
+
+
+class SupervisedFile:
+    """
+    One file being annotated under limits (a FileLimits) by a worker of a WorkerPool started
+    with commentpdf.batch.init_batch_worker. Call poll() periodically until it returns (kind, value):
+    ("done", (count, log lines, seconds, stats)), ("error", message) or ("limit", reason) once
+    the worker was killed or crashed; the output's '.part' file is then removed. Give the
+    worker back to its pool afterwards.
+    """
+
+    def __init__(self, worker, pdf_path, out_path, limits):
+        self.worker = worker
+        self.pdf_path = pdf_path
+        self.out_path = out_path
+        self.limits = limits
+        worker.run(_supervised_file, pdf_path, out_path)
+        self.started = worker.started
+        self._pages_done = 0
+        self._page_started = self.started
+
+    def _kill(self, kind, value):
+        self.worker.kill()
+        _remove_partial_outputs(self.out_path)
+        return kind, value
+
+    def kill(self):
+        """Stop the worker (e.g. when the batch is cancelled); nothing is written."""
+        self._kill(None, None)
+
+    def poll(self):
+        result = self.worker.poll()
+        if result is not None:
+            kind, value = result
+            if kind in ("limit", "crashed"):
+                return self._kill("limit", value)
+            if kind == "error":
+                return kind, str(value)
+            return kind, value
+
+        now = time.monotonic()
+        limits = self.limits
+        if limits.seconds and now - self.started > limits.seconds:
+            return self._kill("limit", f"took longer than {limits.seconds:g} s")
+        progress = self.worker.progress
+        pages_done, page_count = progress[0], progress[1]
+        if pages_done != self._pages_done:
+            self._pages_done, self._page_started = pages_done, now
+        # once every page is done only the file limit applies (saving)
+        if limits.page_seconds and (page_count < 0 or pages_done < page_count):
+            if now - self._page_started > limits.page_seconds:
+                return self._kill("limit", f"page {pages_done + 1} took longer than {limits.page_seconds:g} s")
+        if limits.memory_mb:
+            grown = self.worker.memory_growth()
+            if grown is not None and grown > limits.memory_mb * 1024 * 1024:
+                return self._kill(
+                    "limit", f"used more than {limits.memory_mb:g} MB of memory ({grown / (1024 * 1024):.0f} MB)"
+                )
+        return None
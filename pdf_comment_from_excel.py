@@ -1,9 +1,14 @@
-import fitz  # PyMuPDF
-import pandas as pd
+"""
+CommentPdfFromExcel GUI.
+
+The annotation engine lives in the commentpdf package (commentpdf.core); its public functions are
+re-exported here so existing `import pdf_comment_from_excel` callers keep working. Pillow is only
+imported when a preview is shown, and pandas when a tag sheet is read.
+"""
+import importlib.util
 import os
 import io
 import threading
-import re
 from tkinter import (
     Tk,
     StringVar,
@@ -29,384 +34,40 @@ from tkinter import (
 )
 from tkinter.ttk import Frame, Progressbar
 
-# Pillow is optional but required for preview mode and accurate text metric measurements
-try:
-    from PIL import Image, ImageDraw, ImageTk, ImageFont
-    PIL_AVAILABLE = True
-except Exception:
-    PIL_AVAILABLE = False
-
-
-# Map friendly font names to PDF "standard" font resource names and TTF candidates for preview/measurement
-PDF_FONT_MAP = {
-    "DejaVuSans": ("helv", ["DejaVuSans.ttf", "DejaVuSans.otf"]),
-    "Arial": ("helv", ["arial.ttf", "Arial.ttf"]),
-    "Times New Roman": ("times", ["Times New Roman.ttf", "Times_New_Roman.ttf", "Times.ttf"]),
-    "Courier": ("cour", ["Courier.ttf", "cour.ttf"]),
-}
-
-
-def compute_text_size_points(text, fontsize, ttf_candidates=None, pdf_fontname="helv"):
-    """
-    Return (width_pts, height_pts, ascent_pts, descent_pts) for the given text and font size.
-
-    Strategy:
-    1) Try fitz.get_text_length(text, fontsize, pdf_fontname) to get a width in points that
-       matches PyMuPDF annotation font metrics (best for annotation sizing).
-    2) If that's not available or fails, fall back to Pillow/TTF measurement (pixel==point at 72dpi).
-    3) Last resort: heuristic.
-
-    Adds a small safety multiplier to the measured width to avoid clipping in viewers that may slightly
-    vary metrics.
-    """
-    # 3) heuristic defaults (conservative estimates to avoid clipping)
-    approx_w = max(10.0, len(text) * (fontsize * 0.6))
-    approx_h = max(12.0, fontsize * 1.2)
-    # Typography conventions: ascent ≈ 0.8 of font size, descent ≈ 0.2
-    approx_ascent = fontsize * 0.8
-    approx_descent = fontsize * 0.2
-
-    # 1) try fitz.get_text_length with pdf_fontname (preferred)
-    try:
-        # fitz.get_text_length returns width in points for given fontsize and font name
-        # Correct parameter order: get_text_length(text, fontname, fontsize, encoding)
-        w = fitz.get_text_length(text, fontname=pdf_fontname, fontsize=fontsize)
-        if w and w > 0:
-            # add a safety margin (5%) to avoid clipping when viewer metrics differ slightly
-            w = float(w) * 1.05
-            h = float(max(12.0, fontsize * 1.2))
-            # Typography conventions: ascent ≈ 0.8 of font size, descent ≈ 0.2
-            ascent = fontsize * 0.8
-            descent = fontsize * 0.2
-            return float(w), h, ascent, descent
-    except Exception:
-        # not available or failed -> continue to Pillow fallback
-        pass
-
-    # 2) Pillow measurement (best-effort; assumes TTF available)
-    if PIL_AVAILABLE:
-        font = None
-        if ttf_candidates:
-            for fn in ttf_candidates:
-                try:
-                    font = ImageFont.truetype(fn, size=int(fontsize))
-                    break
-                except Exception:
-                    font = None
-        if font is None:
-            try:
-                font = ImageFont.truetype("arial.ttf", size=int(fontsize))
-            except Exception:
-                try:
-                    font = ImageFont.truetype("Arial.ttf", size=int(fontsize))
-                except Exception:
-                    try:
-                        font = ImageFont.truetype("DejaVuSans.ttf", size=int(fontsize))
-                    except Exception:
-                        font = ImageFont.load_default()
-
-        try:
-            # create a temp image large enough to measure
-            img = Image.new("RGB", (4000, 800), (255, 255, 255))
-            draw = ImageDraw.Draw(img)
-            # use textbbox for accurate metrics
-            bbox = draw.textbbox((0, 0), text, font=font)
-            w_px = bbox[2] - bbox[0]
-            h_px = bbox[3] - bbox[1]
-            try:
-                ascent, descent = font.getmetrics()
-                ascent = float(ascent)
-                descent = float(descent)
-            except Exception:
-                ascent = h_px * 0.75
-                descent = h_px * 0.25
-            # safety margin
-            return float(w_px) * 1.05, float(h_px), ascent, descent
-        except Exception:
-            pass
-
-    # fallback heuristic
-    return approx_w, approx_h, approx_ascent, approx_descent
-
-
-def update_pdf_with_comments(
-    pdf_path,
-    df,
-    output_pdf_path,
-    subject="Comment",
-    distance=10,
-    log_func=None,
-    font_family="Arial",
-    font_size=12,
-    case_sensitive=False,
-    whole_word=False,
-    use_regex=False,
-):
-    """
-    Create freetext annotations (editable) and size them to the measured text metrics
-    so the box fits the entire comment horizontally (no wrapping).
-
-    Matching options:
-      - case_sensitive: when False (default) matching is case-insensitive
-      - whole_word: when True use word-boundary matching
-      - use_regex: when True interpret tag as a regular expression
-    """
-    if log_func:
-        log_func(f"Processing: {os.path.basename(pdf_path)}")
-
-    # Map to PDF font resource and ttf candidates for measurement/preview
-    pdf_fontname, ttf_candidates = PDF_FONT_MAP.get(
-        font_family, ("helv", ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf"])
-    )
-
-    try:
-        doc = fitz.open(pdf_path)
-    except Exception as e:
-        if log_func:
-            log_func(f"  Error opening PDF: {e}")
-        return
-
-    annotation_count = 0
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        page_text = page.get_text("text")
-
-        for index, row in df.iterrows():
-            tag = str(row["tag"]) if not pd.isna(row["tag"]) else ""
-            comment = str(row["comment"]) if not pd.isna(row["comment"]) else ""
-
-            if not tag or tag.strip() == "":
-                continue
-
-            # Determine matches and their rectangles (best-effort)
-            rects = []
-
-            if use_regex:
-                try:
-                    flags = 0 if case_sensitive else re.IGNORECASE
-                    pattern = re.compile(tag, flags)
-                except re.error as rex:
-                    if log_func:
-                        log_func(f"  Invalid regex for tag '{tag}': {rex}")
-                    # skip this tag
-                    continue
-
-                for m in pattern.finditer(page_text):
-                    match_text = m.group(0)
-                    found = page.search_for(match_text)
-                    if not found and not case_sensitive:
-                        # Try common case variants as best-effort
-                        for cand in {match_text.lower(), match_text.upper(), match_text.title()}:
-                            found = page.search_for(cand)
-                            if found:
-                                break
-                    if not found:
-                        if log_func:
-                            log_func(f"  Warning: regex match '{match_text}' could not be mapped to page coordinates.")
-                        continue
-                    rects.extend(found)
-
-            else:
-                # Non-regex matching
-                if whole_word:
-                    flags = 0 if case_sensitive else re.IGNORECASE
-                    pattern = re.compile(r"\b" + re.escape(tag) + r"\b", flags)
-                    matches = list(pattern.finditer(page_text))
-                    if not matches:
-                        continue
-                    for m in matches:
-                        matched_text = page_text[m.start(): m.end()]
-                        found = page.search_for(matched_text)
-                        if not found and not case_sensitive:
-                            for cand in {matched_text.lower(), matched_text.upper(), matched_text.title()}:
-                                found = page.search_for(cand)
-                                if found:
-                                    break
-                        if not found:
-                            if log_func:
-                                log_func(f"  Warning: whole-word match '{matched_text}' could not be mapped to page coordinates.")
-                            continue
-                        rects.extend(found)
-                else:
-                    # simple containment (respect case option for detection)
-                    if case_sensitive:
-                        if tag not in page_text:
-                            continue
-                    else:
-                        if tag.lower() not in page_text.lower():
-                            continue
-
-                    # Try direct search_for using the literal tag first
-                    found = page.search_for(tag)
-                    if not found and not case_sensitive:
-                        # Try some common variants as a best-effort
-                        for cand in {tag.lower(), tag.upper(), tag.title()}:
-                            found = page.search_for(cand)
-                            if found:
-                                break
-                    if not found:
-                        if log_func:
-                            log_func(f"  Warning: tag '{tag}' found in page text but could not find coordinates (search_for returned empty).")
-                        continue
-                    rects.extend(found)
-
-            # Create annotations for all found rects
-            for inst in rects:
-                text_w_pts, text_h_pts, ascent_pts, descent_pts = compute_text_size_points(
-                    comment, font_size, ttf_candidates, pdf_fontname
-                )
-
-                padding_x = max(8.0, font_size * 0.5)
-                padding_y = max(4.0, font_size * 0.25)
-
-                width = text_w_pts + 2.0 * padding_x
-                measured_text_height = ascent_pts + descent_pts if (ascent_pts and descent_pts) else text_h_pts
-                height = max(12.0, measured_text_height + 2.0 * padding_y)
-
-                page_rect = page.rect
-
-                pref_x0 = inst.x1 + distance
-                pref_x1 = pref_x0 + width
-
-                if pref_x1 <= page_rect.x1 - 5:
-                    x0 = pref_x0
-                    x1 = pref_x1
-                else:
-                    x1 = inst.x0 - distance
-                    x0 = x1 - width
-                    if x0 < page_rect.x0 + 5:
-                        x0 = page_rect.x0 + 5
-                        x1 = min(page_rect.x1 - 5, x0 + width)
-
-                inst_mid = (inst.y0 + inst.y1) / 2.0
-                y0 = inst_mid - (height / 2.0)
-                y1 = y0 + height
-
-                if y0 < page_rect.y0 + 5:
-                    y0 = page_rect.y0 + 5
-                    y1 = y0 + height
-                if y1 > page_rect.y1 - 5:
-                    y1 = page_rect.y1 - 5
-                    y0 = y1 - height
-                    if y0 < page_rect.y0 + 5:
-                        y0 = page_rect.y0 + 5
-
-                rect = fitz.Rect(x0, y0, x1, y1)
-
-                try:
-                    annot = page.add_freetext_annot(
-                        rect,
-                        comment,
-                        fontsize=font_size,
-                        text_color=(0, 0, 0),
-                        fill_color=(1, 1, 0),
-                        rotate=0,
-                        align=fitz.TEXT_ALIGN_LEFT,
-                    )
-
-                    try:
-                        annot.set_font(pdf_fontname)
-                    except Exception:
-                        try:
-                            annot.set_font("helv")
-                        except Exception:
-                            pass
-
-                    try:
-                        annot.set_border(width=0.5, dashes=[2])
-                    except Exception:
-                        pass
-                    try:
-                        annot.set_colors(stroke=(0, 0, 0), fill=(1, 1, 0))
-                    except Exception:
-                        pass
-                    try:
-                        annot.set_info({"subject": subject})
-                    except Exception:
-                        pass
-
-                    annot.update()
-                    annotation_count += 1
-                    if log_func:
-                        log_func(f"  Added freetext annot on page {page_num+1} at {rect} (font={font_family}, size={font_size})")
-                except Exception as e:
-                    if log_func:
-                        log_func(f"  Error creating freetext annot at {rect}: {e}")
-
-    try:
-        doc.save(output_pdf_path)
-    except Exception as e:
-        if log_func:
-            log_func(f"  Error saving PDF: {e}")
-    finally:
-        doc.close()
-
-    if log_func:
-        log_func(f"Saved: {os.path.basename(output_pdf_path)} (Total annotations: {annotation_count})")
-
-
-def process_files(
-    pdf_paths,
-    excel_path,
-    output_folder,
-    subject="Comment",
-    distance=10,
-    log_func=None,
-    font_family="Arial",
-    font_size=12,
-    case_sensitive=False,
-    whole_word=False,
-    use_regex=False,
-    progress_callback=None,
-):
-    try:
-        df = pd.read_excel(excel_path)
-    except Exception as e:
-        raise RuntimeError(f"Failed to read Excel file: {e}")
-
-    if "tag" not in df.columns or "comment" not in df.columns:
-        raise RuntimeError("Excel must contain 'tag' and 'comment' columns.")
-
-    df["tag"] = df["tag"].astype(str)
-    df["comment"] = df["comment"].astype(str)
+from commentpdf.core import (  # noqa: F401  (re-exported for backward compatibility)
+    DEFAULT_FILL_COLOR,
+    LINE_SPACING,
+    PDF_FONT_MAP,
+    add_annotation_arguments,
+    add_tag_sheet_arguments,
+    annotation_options_from_args,
+    build_annotations_for_preview,
+    compute_text_size_points,
+    is_marked_output,
+    load_tag_sheet,
+    marked_output_path,
+    parse_color,
+    process_files,
+    row_annotation_settings,
+    sheet_names_from_args,
+    update_pdf_with_comments,
+)
+from commentpdf.discover import iter_pdf_files, split_patterns
+from commentpdf.metrics import format_metrics
+from commentpdf.preview import PreviewRenderer
+from commentpdf.schedule import format_eta
+from commentpdf.watchdog import QUARANTINE_NAME, FileLimits
 
-    os.makedirs(output_folder, exist_ok=True)
 
-    total = len(pdf_paths) if pdf_paths else 0
-    for idx, pdf_path in enumerate(pdf_paths):
-        base = os.path.basename(pdf_path)
-        name, ext = os.path.splitext(base)
-        output_pdf_path = os.path.join(output_folder, f"{name}_marked{ext}")
-        try:
-            update_pdf_with_comments(
-                pdf_path,
-                df,
-                output_pdf_path,
-                subject=subject,
-                distance=distance,
-                log_func=log_func,
-                font_family=font_family,
-                font_size=font_size,
-                case_sensitive=case_sensitive,
-                whole_word=whole_word,
-                use_regex=use_regex,
-            )
-        except Exception as e:
-            if log_func:
-                log_func(f"Error processing {base}: {e}")
-            # continue to next file
-        finally:
-            # update progress after each file
-            if progress_callback and total > 0:
-                try:
-                    pct = int(((idx + 1) / total) * 100)
-                    progress_callback(pct)
-                except Exception:
-                    pass
+# ---------- Preview utilities ----------
+def pil_available():
+    """Whether Pillow (needed for previews) is installed, without importing it."""
+    return importlib.util.find_spec("PIL") is not None
 
 
-# ---------- Preview utilities ----------
 def render_page_pil_from_pixmap(pix):
+    from PIL import Image
+
     png_bytes = pix.tobytes("png")
     return Image.open(io.BytesIO(png_bytes)).convert("RGBA")
 
@@ -431,292 +92,109 @@ def get_text_size(draw, text, font):
         return (len(text) * 7, int(getattr(font, "size", 12)))
 
 
-def build_annotations_for_preview(
-    page,
-    df,
-    distance,
-    font_family="Arial",
-    font_size=12,
-    case_sensitive=False,
-    whole_word=False,
-    use_regex=False,
-):
-    annotations = []
-    page_text = page.get_text("text")
-
-    _, ttf_candidates = PDF_FONT_MAP.get(font_family, ("helv", ["DeJaVuSans.ttf"]))
+def open_preview_window(parent, pdf_path, result, on_step=None):
+    """
+    Show a preview snippet (a PreviewRenderer.snippet result) in a Toplevel. With on_step, Prev
+    and Next buttons call on_step(-1) / on_step(1). The window's show(result) swaps in another
+    snippet (optionally of another PDF) without rebuilding the window.
+    """
+    from PIL import Image, ImageTk
 
-    for index, row in df.iterrows():
-        tag = str(row["tag"]) if not pd.isna(row["tag"]) else ""
-        comment = str(row["comment"]) if not pd.isna(row["comment"]) else ""
-        if not tag or tag.strip() == "":
-            continue
+    win = Toplevel(parent)
+    win.geometry("700x420")
+    win.minsize(320, 200)
 
-        rects = []
+    img_frame = Frame(win)
+    img_frame.pack(expand=True, fill="both", padx=6, pady=6)
 
-        if use_regex:
-            try:
-                flags = 0 if case_sensitive else re.IGNORECASE
-                pattern = re.compile(tag, flags)
-            except re.error:
-                continue
-            for m in pattern.finditer(page_text):
-                match_text = m.group(0)
-                found = page.search_for(match_text)
-                if not found and not case_sensitive:
-                    for cand in {match_text.lower(), match_text.upper(), match_text.title()}:
-                        found = page.search_for(cand)
-                        if found:
-                            break
-                if not found:
-                    continue
-                rects.extend(found)
+    img_label = Label(img_frame)
+    img_label.pack(expand=True, fill="both")
 
-        else:
-            if whole_word:
-                flags = 0 if case_sensitive else re.IGNORECASE
-                pattern = re.compile(r"\b" + re.escape(tag) + r"\b", flags)
-                matches = list(pattern.finditer(page_text))
-                if not matches:
-                    continue
-                for m in matches:
-                    matched_text = page_text[m.start(): m.end()]
-                    found = page.search_for(matched_text)
-                    if not found and not case_sensitive:
-                        for cand in {matched_text.lower(), matched_text.upper(), matched_text.title()}:
-                            found = page.search_for(cand)
-                            if found:
-                                break
-                    if not found:
-                        continue
-                    rects.extend(found)
-            else:
-                if case_sensitive:
-                    if tag not in page_text:
-                        continue
-                else:
-                    if tag.lower() not in page_text.lower():
-                        continue
-                found = page.search_for(tag)
-                if not found and not case_sensitive:
-                    for cand in {tag.lower(), tag.upper(), tag.title()}:
-                        found = page.search_for(cand)
-                        if found:
-                            break
-                if not found:
-                    continue
-                rects.extend(found)
-
-        for inst in rects:
-            text_w_pts, text_h_pts, ascent_pts, descent_pts = compute_text_size_points(
-                comment, font_size, ttf_candidates, pdf_fontname="helv"
-            )
-            padding_x = max(8.0, font_size * 0.5)
-            padding_y = max(4.0, font_size * 0.25)
-            width = text_w_pts + 2.0 * padding_x
-            measured_text_height = ascent_pts + descent_pts if (ascent_pts and descent_pts) else text_h_pts
-            height = max(12.0, measured_text_height + 2.0 * padding_y)
-
-            page_rect = page.rect
-            pref_x0 = inst.x1 + distance
-            pref_x1 = pref_x0 + width
-
-            if pref_x1 <= page_rect.x1 - 5:
-                x0 = pref_x0
-                x1 = pref_x1
-            else:
-                x1 = inst.x0 - distance
-                x0 = x1 - width
-                if x0 < page_rect.x0 + 5:
-                    x0 = page_rect.x0 + 5
-                    x1 = min(page_rect.x1 - 5, x0 + width)
-
-            inst_mid = (inst.y0 + inst.y1) / 2.0
-            y0 = inst_mid - (height / 2.0)
-            y1 = y0 + height
-            if y0 < page_rect.y0 + 5:
-                y0 = page_rect.y0 + 5
-                y1 = y0 + height
-            if y1 > page_rect.y1 - 5:
-                y1 = page_rect.y1 - 5
-                y0 = y1 - height
-                if y0 < page_rect.y0 + 5:
-                    y0 = page_rect.y0 + 5
-
-            annot_rect = fitz.Rect(x0, y0, x1, y1)
-            annotations.append(
-                {
-                    "annot_rect": annot_rect,
-                    "comment": comment,
-                    "inst_rect": inst,
-                    "tag": tag,
-                }
+    bottom = Frame(win)
+    bottom.pack(fill="x", padx=6, pady=(0, 6))
+    info = Label(bottom, anchor="w")
+    info.pack(side="left", fill="x", expand=True)
+    if on_step is not None:
+        Button(bottom, text="Next >", command=lambda: on_step(1)).pack(side="right")
+        Button(bottom, text="< Prev", command=lambda: on_step(-1)).pack(side="right", padx=(0, 4))
+
+    def show(result, path=None):
+        snippet = result["image"]
+        page_number = result["page_index"] + 1
+        win.title(f"Preview - {os.path.basename(path or pdf_path)} (page {page_number})")
+        win.update_idletasks()
+        avail_w = max(200, win.winfo_width() - 40)
+        avail_h = max(120, win.winfo_height() - 120)
+        ratio = min(avail_w / snippet.width, avail_h / snippet.height, 1.0)
+        if ratio < 1.0:
+            display_img = snippet.resize(
+                (int(snippet.width * ratio), int(snippet.height * ratio)), Image.LANCZOS
             )
+        else:
+            display_img = snippet
+
+        try:
+            photo = ImageTk.PhotoImage(display_img.convert("RGB"))
+        except Exception as e:
+            messagebox.showerror("Preview error", f"Failed to build preview image: {e}")
+            return
 
-    return annotations
+        win._photo = photo
+        img_label.config(image=photo)
+        count = len(result["annotations"])
+        info.config(
+            text=f"Replacement on page {page_number} of {result['page_count']} ({count} on this page)"
+        )
+
+    win.show = show
+    show(result)
+    return win
 
 
-def show_preview_snippet(parent, pdf_path, df, subject, distance, font_family, font_size, case_sensitive=False, whole_word=False, use_regex=False):
-    if not PIL_AVAILABLE:
+def show_preview_snippet(parent, pdf_path, df, subject, distance, font_family, font_size, case_sensitive=False, whole_word=False, use_regex=False, wrap_width=None):
+    """Synchronous one-off preview of the first replacement in pdf_path (the App uses a cached, threaded preview)."""
+    # Pillow is optional but required for preview mode
+    if not pil_available():
         messagebox.showerror(
             "Preview unavailable",
             "Pillow is required for preview mode. Install it with: pip install pillow",
         )
         return
 
+    options = {
+        "subject": subject,
+        "distance": distance,
+        "font_family": font_family,
+        "font_size": font_size,
+        "case_sensitive": case_sensitive,
+        "whole_word": whole_word,
+        "use_regex": use_regex,
+        "wrap_width": wrap_width,
+    }
+    renderer = PreviewRenderer()
+    renderer.use_sheet(df)
     try:
-        doc = fitz.open(pdf_path)
+        result = renderer.snippet(pdf_path, options)
     except Exception as e:
-        messagebox.showerror("Preview error", f"Failed to open PDF: {e}")
-        return
-
-    if len(doc) == 0:
-        messagebox.showwarning("Preview", "PDF has no pages.")
-        doc.close()
+        messagebox.showerror("Preview error", f"Failed to render preview: {e}")
         return
+    finally:
+        renderer.close()
 
-    first_found = None
-    first_page_index = None
-    first_annotation = None
-
-    for i in range(len(doc)):
-        page = doc[i]
-        anns = build_annotations_for_preview(page, df, distance, font_family=font_family, font_size=font_size, case_sensitive=case_sensitive, whole_word=whole_word, use_regex=use_regex)
-        if anns:
-            first_found = page
-            first_page_index = i
-            first_annotation = anns[0]
-            break
-
-    if first_found is None:
+    if result is None:
         messagebox.showinfo("Preview", "No tags found in the PDF to preview.")
-        doc.close()
         return
-
-    zoom = 2.0
-    try:
-        pix = first_found.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
-        pil_full = render_page_pil_from_pixmap(pix)
-    except Exception as e:
-        messagebox.showerror("Preview error", f"Failed to render page for preview: {e}")
-        doc.close()
-        return
-
-    annot_rect = first_annotation["annot_rect"]
-    inst_rect = first_annotation["inst_rect"]
-    comment = first_annotation["comment"]
-    tag = first_annotation["tag"]
-
-    # conversion to pixels (pixmap scaled by zoom)
-    x0 = int(annot_rect.x0 * zoom)
-    y0 = int(annot_rect.y0 * zoom)
-    x1 = int(annot_rect.x1 * zoom)
-    y1 = int(annot_rect.y1 * zoom)
-    margin = int(28 * zoom)
-
-    ix0 = int(inst_rect.x0 * zoom)
-    iy0 = int(inst_rect.y0 * zoom)
-    ix1 = int(inst_rect.x1 * zoom)
-    iy1 = int(inst_rect.y1 * zoom)
-
-    cx0 = max(0, min(x0, ix0) - margin)
-    cy0 = max(0, min(y0, iy0) - margin)
-    cx1 = min(pil_full.width, max(x1, ix1) + margin)
-    cy1 = min(pil_full.height, max(y1, iy1) + margin)
-
-    snippet = pil_full.crop((cx0, cy0, cx1, cy1)).convert("RGBA")
-    draw = ImageDraw.Draw(snippet)
-
-    # Load font at scaled size so preview shows correct visual size
-    _, ttf_candidates = PDF_FONT_MAP.get(font_family, ("helv", ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf"]))
-    font_obj = None
-    for fn in ttf_candidates:
-        try:
-            font_obj = ImageFont.truetype(fn, size=int(font_size * zoom))
-            break
-        except Exception:
-            font_obj = None
-    if font_obj is None:
-        try:
-            font_obj = ImageFont.truetype("arial.ttf", size=int(font_size * zoom))
-        except Exception:
-            try:
-                font_obj = ImageFont.truetype("Arial.ttf", size=int(font_size * zoom))
-            except Exception:
-                try:
-                    font_obj = ImageFont.truetype("DejaVuSans.ttf", size=int(font_size * zoom))
-                except Exception:
-                    font_obj = ImageFont.load_default()
-
-    r_ax0 = x0 - cx0
-    r_ay0 = y0 - cy0
-    r_ax1 = x1 - cx0
-    r_ay1 = y1 - cy0
-
-    r_ix0 = ix0 - cx0
-    r_iy0 = iy0 - cy0
-    r_ix1 = ix1 - cx0
-    r_iy1 = iy1 - cy0
-
-    # draw annotation area and tag area
-    try:
-        draw.rectangle([r_ax0, r_ay0, r_ax1, r_ay1], fill=(255, 255, 0, 200), outline=(0, 0, 0))
-    except Exception:
-        draw.rectangle([r_ax0, r_ay0, r_ax1, r_ay1], outline=(0, 0, 0))
-    draw.rectangle([r_ix0, r_iy0, r_ix1, r_iy1], outline=(0, 120, 200), width=2)
-
-    # Draw full comment text (no trimming, no wrapping). The annotation RECT is sized to fit.
-    draw.text((r_ax0 + int(3 * zoom), r_ay0 + int(2 * zoom)), comment, fill=(0, 0, 0), font=font_obj)
-
-    # Show in Toplevel
-    win = Toplevel(parent)
-    win.title(f"Preview - {os.path.basename(pdf_path)} (page {first_page_index+1})")
-    win.geometry("700x420")
-    win.minsize(320, 200)
-
-    img_frame = Frame(win)
-    img_frame.pack(expand=True, fill="both", padx=6, pady=6)
-
-    img_label = Label(img_frame)
-    img_label.pack(expand=True, fill="both")
-
-    win.update_idletasks()
-    avail_w = max(200, win.winfo_width() - 40)
-    avail_h = max(120, win.winfo_height() - 120)
-    ratio = min(avail_w / snippet.width, avail_h / snippet.height, 1.0)
-    if ratio < 1.0:
-        display_img = snippet.resize(
-            (int(snippet.width * ratio), int(snippet.height * ratio)), Image.LANCZOS
-        )
-    else:
-        display_img = snippet
-
-    try:
-        photo = ImageTk.PhotoImage(display_img.convert("RGB"))
-    except Exception as e:
-        messagebox.showerror("Preview error", f"Failed to build preview image: {e}")
-        doc.close()
-        win.destroy()
-        return
-
-    win._photo = photo
-    img_label.config(image=photo)
-
-    info = Label(win, text=f"First replacement on page {first_page_index+1}", anchor="w")
-    info.pack(fill="x", padx=6, pady=(0, 6))
-
-    def on_close():
-        try:
-            doc.close()
-        except Exception:
-            pass
-        win.destroy()
-
-    win.protocol("WM_DELETE_WINDOW", on_close)
+    open_preview_window(parent, pdf_path, result)
 
 
 # ---------- GUI Application ----------
 FONT_CHOICES = ["Arial", "DejaVuSans", "Times New Roman", "Courier"]
+# (menu label, process_files output_mode)
+OUTPUT_FORMAT_CHOICES = [
+    ("Annotated PDF", "pdf"),
+    ("XFDF sidecar", "xfdf"),
+    ("JSON sidecar", "json"),
+]
 
 
 class App(Frame):
@@ -730,6 +208,7 @@ class App(Frame):
         self.excel_path = ""
         self.pdf_paths = []
         self.folder_mode = IntVar(value=1)
+        self.recursive = IntVar(value=1)
         self.output_folder = ""
         self.subject = StringVar(value="Comment")
         self.distance = IntVar(value=10)
@@ -740,10 +219,31 @@ class App(Frame):
         self.case_sensitive = IntVar(value=0)
         self.whole_word = IntVar(value=0)
         self.use_regex = IntVar(value=0)
+        self.all_sheets = IntVar(value=0)
+        self.output_format = StringVar(value=OUTPUT_FORMAT_CHOICES[0][0])
+        self.resume = IntVar(value=0)
+        self.keep_journal = IntVar(value=0)
+        self.dedupe = IntVar(value=0)
+        self.workers = IntVar(value=1)
+        self.prescan = IntVar(value=0)
+        self.eta_text = StringVar(value="")
+        # set by the Cancel button; the batch stops after the current page
+        self.cancel_event = threading.Event()
+        # True from Start until the batch thread has finished (read and written on the Tk thread)
+        self.processing = False
+        # Preview: cached sheets/matches/page images, computed off the Tk thread. PyMuPDF is not
+        # thread-safe, so preview and processing threads take preview_lock; prefetch_stop ends
+        # the background pre-rendering of hit pages.
+        self.preview_renderer = PreviewRenderer()
+        self.preview_lock = threading.Lock()
+        self.prefetch_stop = threading.Event()
+        self.preview_window = None
+        self.preview_state = None
 
         self.preview_button = None
         self.start_button = None
         self.quit_button = None
+        self.cancel_button = None
         self.progress = None
 
         self.create_widgets()
@@ -752,7 +252,7 @@ class App(Frame):
     def create_widgets(self):
         row = 0
 
-        Label(self, text="Excel File (with 'tag' and 'comment' columns):").grid(
+        Label(self, text="Excel File(s) (with 'tag' and 'comment' columns):").grid(
             column=0, row=row, sticky=W, padx=5, pady=5
         )
         self.excel_entry = Entry(self, width=60)
@@ -771,6 +271,8 @@ class App(Frame):
             value=0,
             command=self.update_input_mode,
         ).grid(column=2, row=row, sticky=W)
+        self.recursive_check = Checkbutton(self, text="Include subfolders", variable=self.recursive)
+        self.recursive_check.grid(column=3, row=row, sticky=W, padx=5)
         row += 1
 
         self.input_entry = Entry(self, width=60)
@@ -779,6 +281,16 @@ class App(Frame):
         self.input_button.grid(column=3, row=row, padx=5)
         row += 1
 
+        # Folder mode filters (globs on the file name or the path below the folder, ';'-separated)
+        Label(self, text="Include:").grid(column=0, row=row, sticky=W, padx=5, pady=5)
+        self.include_entry = Entry(self, width=30)
+        self.include_entry.insert(0, "*.pdf")
+        self.include_entry.grid(column=1, row=row, sticky=W, padx=5)
+        Label(self, text="Exclude:").grid(column=2, row=row, sticky=W, padx=5)
+        self.exclude_entry = Entry(self, width=20)
+        self.exclude_entry.grid(column=3, row=row, sticky=W, padx=5)
+        row += 1
+
         Label(self, text="Output folder:").grid(column=0, row=row, sticky=W, padx=5, pady=5)
         self.output_entry = Entry(self, width=60)
         self.output_entry.grid(column=1, row=row, columnspan=2, sticky=(W, E), padx=5)
@@ -803,12 +315,56 @@ class App(Frame):
         self.font_size_entry.grid(column=3, row=row, sticky=W, padx=5)
         row += 1
 
+        Label(self, text="Wrap width (points):").grid(column=0, row=row, sticky=W, padx=5, pady=5)
+        self.wrap_width_entry = Entry(self, width=10)
+        self.wrap_width_entry.grid(column=1, row=row, sticky=W, padx=5)
+        Label(self, text="(blank: one line per comment)").grid(column=2, row=row, columnspan=2, sticky=W, padx=5)
+        row += 1
+
+        Label(self, text="Output:").grid(column=0, row=row, sticky=W, padx=5, pady=5)
+        output_menu = OptionMenu(self, self.output_format, *[label for label, _ in OUTPUT_FORMAT_CHOICES])
+        output_menu.grid(column=1, row=row, sticky=W, padx=5)
+        Checkbutton(self, text="Resume previous run", variable=self.resume).grid(
+            column=2, row=row, columnspan=2, sticky=W, padx=5
+        )
+        row += 1
+
+        # Run journal (needed by a later resume) and reuse of outputs for byte-identical inputs
+        Checkbutton(self, text="Keep run journal", variable=self.keep_journal).grid(
+            column=0, row=row, columnspan=2, sticky=W, padx=5
+        )
+        Checkbutton(self, text="Reuse outputs of identical PDFs", variable=self.dedupe).grid(
+            column=2, row=row, columnspan=2, sticky=W, padx=5
+        )
+        row += 1
+
+        # Scheduling: urgent files first, then the largest estimated cost first
+        Label(self, text="Priority files:").grid(column=0, row=row, sticky=W, padx=5, pady=5)
+        self.priority_entry = Entry(self, width=30)
+        self.priority_entry.grid(column=1, row=row, sticky=W, padx=5)
+        Label(self, text="Workers:").grid(column=2, row=row, sticky=W, padx=5)
+        self.workers_entry = Entry(self, textvariable=self.workers, width=6)
+        self.workers_entry.grid(column=3, row=row, sticky=W, padx=5)
+        row += 1
+
+        # Watchdog: files over the time limit are killed and quarantined, the batch continues
+        Label(self, text="Time limit per file (s):").grid(column=0, row=row, sticky=W, padx=5, pady=5)
+        self.time_limit_entry = Entry(self, width=10)
+        self.time_limit_entry.grid(column=1, row=row, sticky=W, padx=5)
+        Checkbutton(self, text="Skip encrypted/damaged/text-less PDFs", variable=self.prescan).grid(
+            column=2, row=row, columnspan=2, sticky=W, padx=5
+        )
+        row += 1
+
         # Matching option checkbuttons
         Checkbutton(self, text="Case sensitive", variable=self.case_sensitive).grid(column=0, row=row, sticky=W, padx=5)
         Checkbutton(self, text="Whole word", variable=self.whole_word).grid(column=1, row=row, sticky=W, padx=5)
         Checkbutton(self, text="Use regex", variable=self.use_regex).grid(column=2, row=row, sticky=W, padx=5)
+        Checkbutton(self, text="All sheets", variable=self.all_sheets).grid(column=3, row=row, sticky=W, padx=5)
         row += 1
 
+        self.cancel_button = Button(self, text="Cancel", command=self.cancel_processing, width=12, state=DISABLED)
+        self.cancel_button.grid(column=0, row=row, padx=5, pady=10)
         self.preview_button = Button(self, text="Preview", command=self.preview_sample, width=12)
         self.preview_button.grid(column=1, row=row, padx=5, pady=10)
         self.start_button = Button(self, text="Start", command=self.start_processing, width=12)
@@ -819,7 +375,8 @@ class App(Frame):
 
         # Progress bar (shows progress across selected PDFs)
         self.progress = Progressbar(self, orient="horizontal", mode="determinate", maximum=100)
-        self.progress.grid(column=0, row=row, columnspan=4, sticky=(W, E), padx=5, pady=(0, 6))
+        self.progress.grid(column=0, row=row, columnspan=3, sticky=(W, E), padx=5, pady=(0, 6))
+        Label(self, textvariable=self.eta_text).grid(column=3, row=row, sticky=W, padx=5, pady=(0, 6))
         row += 1
 
         Label(self, text="Log:").grid(column=0, row=row, sticky=NW, padx=5)
@@ -827,6 +384,12 @@ class App(Frame):
         self.log.grid(column=0, row=row + 1, columnspan=4, padx=5, pady=(0, 10))
         self.log.configure(state=DISABLED)
 
+        # Per-run metrics (hits, unmatched tags, throughput, slowest files); filled after each run
+        Label(self, text="Run summary:").grid(column=0, row=row + 2, sticky=NW, padx=5)
+        self.summary_text = Text(self, width=90, height=7)
+        self.summary_text.grid(column=0, row=row + 3, columnspan=4, padx=5, pady=(0, 10))
+        self.summary_text.configure(state=DISABLED)
+
         for c in range(4):
             self.grid_columnconfigure(c, weight=1)
 
@@ -834,6 +397,9 @@ class App(Frame):
 
     def update_input_mode(self):
         mode = self.folder_mode.get()
+        self.pdf_paths = []
+        for w in (self.recursive_check, self.include_entry, self.exclude_entry):
+            w.config(state=NORMAL if mode == 1 else DISABLED)
         if mode == 1:
             self.input_entry.delete(0, END)
             self.input_entry.insert(0, "")
@@ -844,14 +410,73 @@ class App(Frame):
             self.input_button.config(text="Browse PDF(s)...")
 
     def browse_excel(self):
-        path = filedialog.askopenfilename(
-            title="Select Excel File", filetypes=[("Excel files", "*.xlsx *.xls")]
+        paths = filedialog.askopenfilenames(
+            title="Select Excel File(s)",
+            filetypes=[("Excel files", "*.xlsx *.xls"), ("Compiled tag index", "*.cpidx"), ("All files", "*.*")],
         )
-        if path:
-            self.excel_path = path
+        if paths:
+            self.excel_path = "; ".join(paths)
             self.excel_entry.delete(0, END)
-            self.excel_entry.insert(0, path)
-            self.append_log(f"Excel selected: {os.path.basename(path)}")
+            self.excel_entry.insert(0, self.excel_path)
+            self.append_log(f"Excel selected: {', '.join(os.path.basename(p) for p in paths)}")
+
+    def get_excel_paths(self):
+        """Return the Excel file(s) in the entry ('; '-separated), or None if any is missing."""
+        paths = [p.strip() for p in self.excel_entry.get().split(";") if p.strip()]
+        if not paths or not all(os.path.isfile(p) for p in paths):
+            return None
+        return paths
+
+    def get_sheet_names(self):
+        return "*" if self.all_sheets.get() else None
+
+    def get_priority(self):
+        return [p.strip() for p in self.priority_entry.get().split(";") if p.strip()]
+
+    def get_input_pdfs(self):
+        """
+        Return (pdf_paths, input_root) for the current input mode, or (None, None) if nothing is
+        selected. In folder mode pdf_paths is a lazy iterator over the folder tree and input_root
+        the folder, so outputs mirror its sub-folders.
+        """
+        if self.folder_mode.get() == 1:
+            folder = self.input_entry.get().strip()
+            if not folder or not os.path.isdir(folder):
+                return None, None
+            pdfs = iter_pdf_files(
+                folder,
+                include=split_patterns(self.include_entry.get()) or None,
+                exclude=split_patterns(self.exclude_entry.get()),
+                recursive=bool(self.recursive.get()),
+                log_func=self.append_log,
+            )
+            return pdfs, folder
+        if not self.pdf_paths:
+            return None, None
+        return list(self.pdf_paths), None
+
+    def get_wrap_width(self):
+        """Return the wrap width in points, or None when blank. Raises ValueError if invalid."""
+        text = self.wrap_width_entry.get().strip()
+        if not text:
+            return None
+        value = float(text)
+        if value <= 0:
+            raise ValueError("Wrap width must be positive")
+        return value
+
+    def get_time_limit(self):
+        """Return the per-file time limit in seconds, or None when blank. Raises ValueError if invalid."""
+        text = self.time_limit_entry.get().strip()
+        if not text:
+            return None
+        value = float(text)
+        if value <= 0:
+            raise ValueError("Time limit must be positive")
+        return value
+
+    def get_output_mode(self):
+        return dict(OUTPUT_FORMAT_CHOICES).get(self.output_format.get(), "pdf")
 
     def browse_input(self):
         if self.folder_mode.get() == 1:
@@ -859,12 +484,8 @@ class App(Frame):
             if folder:
                 self.input_entry.delete(0, END)
                 self.input_entry.insert(0, folder)
-                self.pdf_paths = [
-                    os.path.join(folder, f)
-                    for f in os.listdir(folder)
-                    if f.lower().endswith(".pdf")
-                ]
-                self.append_log(f"Loaded {len(self.pdf_paths)} PDF(s) from folder.")
+                # PDFs are discovered when processing starts, while the first files are already running
+                self.append_log(f"Folder selected: {folder}")
         else:
             files = filedialog.askopenfilenames(
                 title="Select PDF File(s)", filetypes=[("PDF files", "*.pdf")]
@@ -895,6 +516,14 @@ class App(Frame):
         finally:
             self.log.configure(state=DISABLED)
 
+    def show_run_summary(self, lines):
+        self.summary_text.configure(state=NORMAL)
+        try:
+            self.summary_text.delete("1.0", END)
+            self.summary_text.insert(END, "\n".join(lines))
+        finally:
+            self.summary_text.configure(state=DISABLED)
+
     def set_progress_value(self, val):
         try:
             # clamp to [0,100]
@@ -905,27 +534,19 @@ class App(Frame):
             pass
 
     def start_processing(self):
-        excel = self.excel_entry.get().strip()
-        if not excel or not os.path.isfile(excel):
+        excel = self.get_excel_paths()
+        if not excel:
             messagebox.showerror("Input error", "Please select a valid Excel file.")
             return
 
-        if not self.pdf_paths:
-            if self.folder_mode.get() == 1:
-                folder = self.input_entry.get().strip()
-                if folder and os.path.isdir(folder):
-                    self.pdf_paths = [
-                        os.path.join(folder, f)
-                        for f in os.listdir(folder)
-                        if f.lower().endswith(".pdf")
-                    ]
-            if not self.pdf_paths:
-                messagebox.showerror("Input error", "Please select PDF files or a folder containing PDFs.")
-                return
+        pdf_paths, input_root = self.get_input_pdfs()
+        if pdf_paths is None:
+            messagebox.showerror("Input error", "Please select PDF files or a folder containing PDFs.")
+            return
 
         out_folder = self.output_entry.get().strip()
         if not out_folder:
-            out_folder = os.path.dirname(self.pdf_paths[0])
+            out_folder = input_root or os.path.dirname(pdf_paths[0])
             self.output_entry.insert(0, out_folder)
 
         try:
@@ -944,6 +565,26 @@ class App(Frame):
             messagebox.showerror("Input error", "Please enter a valid positive integer for font size.")
             return
 
+        try:
+            workers = int(self.workers_entry.get())
+            if workers <= 0:
+                raise ValueError()
+        except Exception:
+            messagebox.showerror("Input error", "Please enter a valid positive integer for workers.")
+            return
+
+        try:
+            wrap_width = self.get_wrap_width()
+        except Exception:
+            messagebox.showerror("Input error", "Please enter a positive number for wrap width (or leave it blank).")
+            return
+
+        try:
+            time_limit = self.get_time_limit()
+        except Exception:
+            messagebox.showerror("Input error", "Please enter a positive time limit in seconds (or leave it blank).")
+            return
+
         subj = self.subject_entry.get().strip() or "Comment"
         ffamily = self.font_family.get() or "Arial"
 
@@ -951,20 +592,34 @@ class App(Frame):
         ww = bool(self.whole_word.get())
         ur = bool(self.use_regex.get())
 
+        self.cancel_event.clear()
+        # stop pre-rendering previews; the processing thread waits for it to finish
+        self.prefetch_stop.set()
+        self.processing = True
         self.disable_ui()
         self.append_log("Starting processing...")
         # reset progress
         self.set_progress_value(0)
+        self.eta_text.set("")
 
         # run processing in background thread
         thread = threading.Thread(
             target=self._process_thread,
-            args=(list(self.pdf_paths), excel, out_folder, subj, dist, ffamily, fsize, cs, ww, ur),
+            args=(
+                pdf_paths, excel, out_folder, subj, dist, ffamily, fsize, cs, ww, ur,
+                self.get_sheet_names(), self.get_output_mode(), bool(self.resume.get()),
+                self.get_priority(), workers, input_root, wrap_width, time_limit, bool(self.prescan.get()),
+                bool(self.keep_journal.get()), bool(self.dedupe.get()),
+            ),
             daemon=True,
         )
         thread.start()
 
-    def _process_thread(self, pdf_paths, excel, out_folder, subj, dist, ffamily, fsize, cs, ww, ur):
+    def _process_thread(
+        self, pdf_paths, excel, out_folder, subj, dist, ffamily, fsize, cs, ww, ur,
+        sheets=None, output_mode="pdf", resume=False, priority=None, workers=1, input_root=None,
+        wrap_width=None, time_limit=None, prescan=False, journal=False, dedupe=False,
+    ):
         try:
             # progress callback that schedules UI update on main thread
             def progress_cb(pct):
@@ -973,64 +628,102 @@ class App(Frame):
                 except Exception:
                     pass
 
-            process_files(
-                pdf_paths,
-                excel,
-                out_folder,
-                subject=subj,
-                distance=dist,
-                log_func=self.append_log,
-                font_family=ffamily,
-                font_size=fsize,
-                case_sensitive=cs,
-                whole_word=ww,
-                use_regex=ur,
-                progress_callback=progress_cb,
+            def eta_cb(seconds):
+                text = f"ETA {format_eta(seconds)}"
+                try:
+                    self.root.after(0, lambda: self.eta_text.set(text))
+                except Exception:
+                    pass
+
+            # wait for a running preview or pre-render to stop (PyMuPDF is not thread-safe)
+            with self.preview_lock:
+                summary = process_files(
+                    pdf_paths,
+                    excel,
+                    out_folder,
+                    subject=subj,
+                    distance=dist,
+                    log_func=self.append_log,
+                    font_family=ffamily,
+                    font_size=fsize,
+                    case_sensitive=cs,
+                    whole_word=ww,
+                    use_regex=ur,
+                    progress_callback=progress_cb,
+                    sheet_names=sheets,
+                    output_mode=output_mode,
+                    cancel_event=self.cancel_event,
+                    journal=journal,
+                    resume=resume,
+                    dedupe="copy" if dedupe else None,
+                    priority=priority,
+                    workers=workers,
+                    eta_callback=eta_cb,
+                    input_root=input_root,
+                    wrap_width=wrap_width,
+                    prescan=prescan,
+                    limits=FileLimits(seconds=time_limit) if time_limit else None,
+                )
+            result = (
+                f"Processed {summary['processed']} of {summary['total']} PDF file(s)"
+                f" ({summary['skipped']} skipped, {summary['failed']} failed).\nSaved to: {out_folder}"
             )
-            # ensure progress shows complete
-            self.root.after(0, lambda: self.set_progress_value(100))
+            if summary["quarantined"]:
+                result += (
+                    f"\n{summary['quarantined']} file(s) quarantined, see"
+                    f" {os.path.join(out_folder, QUARANTINE_NAME)}."
+                )
+            if summary["deduplicated"]:
+                result += (
+                    f"\n{summary['deduplicated']} identical file(s) reused an existing output"
+                    f" (about {format_eta(summary['seconds_saved'])} of processing saved)."
+                )
+            summary_lines = format_metrics(summary["metrics"])
             # UI interactions must be done on the main thread
-            self.root.after(0, lambda: self.append_log("All done."))
-            self.root.after(0, lambda: messagebox.showinfo("Success", f"Processed {len(pdf_paths)} PDF file(s).\nSaved to: {out_folder}"))
+            self.root.after(0, lambda: self.show_run_summary(summary_lines))
+            if summary["cancelled"]:
+                self.root.after(0, lambda: self.append_log("Cancelled."))
+                self.root.after(0, lambda: messagebox.showwarning("Cancelled", result))
+            else:
+                # ensure progress shows complete
+                self.root.after(0, lambda: self.set_progress_value(100))
+                self.root.after(0, lambda: self.eta_text.set(""))
+                self.root.after(0, lambda: self.append_log("All done."))
+                self.root.after(0, lambda: messagebox.showinfo("Success", result))
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"An error occurred:\n{e}"))
-            self.root.after(0, lambda: self.append_log(f"Error: {e}"))
+            error = str(e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"An error occurred:\n{error}"))
+            self.root.after(0, lambda: self.append_log(f"Error: {error}"))
         finally:
-            self.root.after(0, self.enable_ui)
+            self.root.after(0, self._processing_done)
+
+    def _processing_done(self):
+        self.processing = False
+        self.enable_ui()
+
+    def cancel_processing(self):
+        if not self.cancel_event.is_set():
+            self.cancel_event.set()
+            self.append_log("Cancelling after the current page...")
+        self.cancel_button.configure(state=DISABLED)
 
     def preview_sample(self):
-        excel = self.excel_entry.get().strip()
-        if not excel or not os.path.isfile(excel):
+        excel = self.get_excel_paths()
+        if not excel:
             messagebox.showerror("Input error", "Please select a valid Excel file before previewing.")
             return
 
-        try:
-            df = pd.read_excel(excel)
-        except Exception as e:
-            messagebox.showerror("Input error", f"Failed to read Excel file: {e}")
-            return
-
-        if "tag" not in df.columns or "comment" not in df.columns:
-            messagebox.showerror("Input error", "Excel must contain 'tag' and 'comment' columns.")
+        if not pil_available():
+            messagebox.showerror(
+                "Preview unavailable",
+                "Pillow is required for preview mode. Install it with: pip install pillow",
+            )
             return
 
-        df["tag"] = df["tag"].astype(str)
-        df["comment"] = df["comment"].astype(str)
-
-        if not self.pdf_paths:
-            if self.folder_mode.get() == 1:
-                folder = self.input_entry.get().strip()
-                if folder and os.path.isdir(folder):
-                    self.pdf_paths = [
-                        os.path.join(folder, f)
-                        for f in os.listdir(folder)
-                        if f.lower().endswith(".pdf")
-                    ]
-        if not self.pdf_paths:
+        pdf_paths, _ = self.get_input_pdfs()
+        if pdf_paths is None:
             messagebox.showerror("Input error", "Please select at least one PDF (or a folder with PDFs) to preview.")
             return
-
-        sample_pdf = self.pdf_paths[0]
         try:
             dist = int(self.distance_entry.get())
             if dist < 0:
@@ -1045,15 +738,98 @@ class App(Frame):
         except Exception:
             fsize = 12
 
-        ffamily = self.font_family.get() or "Arial"
-        subj = self.subject_entry.get().strip() or "Comment"
+        try:
+            wrap_width = self.get_wrap_width()
+        except Exception:
+            wrap_width = None
+
+        options = {
+            "subject": self.subject_entry.get().strip() or "Comment",
+            "distance": dist,
+            "font_family": self.font_family.get() or "Arial",
+            "font_size": fsize,
+            "case_sensitive": bool(self.case_sensitive.get()),
+            "whole_word": bool(self.whole_word.get()),
+            "use_regex": bool(self.use_regex.get()),
+            "wrap_width": wrap_width,
+        }
+        self._start_preview(pdf_paths, options, excel=excel, sheets=self.get_sheet_names())
+
+    def step_preview(self, step):
+        if self.preview_state is None:
+            return
+        pdf_path, options, page_index = self.preview_state
+        self._start_preview([pdf_path], options, start=page_index + step, step=step)
+
+    def _start_preview(self, pdf_paths, options, excel=None, sheets=None, start=0, step=1):
+        # stop pre-rendering; the preview thread waits for the lock until it has stopped
+        self.prefetch_stop.set()
+        for w in (self.preview_button, self.start_button):
+            w.configure(state=DISABLED)
+        thread = threading.Thread(
+            target=self._preview_thread,
+            args=(pdf_paths, options, excel, sheets, start, step),
+            daemon=True,
+        )
+        thread.start()
 
-        cs = bool(self.case_sensitive.get())
-        ww = bool(self.whole_word.get())
-        ur = bool(self.use_regex.get())
+    def _preview_thread(self, pdf_paths, options, excel=None, sheets=None, start=0, step=1):
+        with self.preview_lock:
+            self.prefetch_stop.clear()
+            sample_pdf = None
+            try:
+                # in folder mode this only scans the tree up to the first PDF
+                sample_pdf = next(iter(pdf_paths), None)
+                if sample_pdf is None:
+                    self.root.after(0, lambda: messagebox.showerror("Input error", "No PDFs found to preview."))
+                    return
+                if excel is not None:
+                    # re-read only when the workbook or sheet selection changed
+                    self.preview_renderer.load_sheet(excel, sheets, self.append_log)
+                result = self.preview_renderer.snippet(sample_pdf, options, start=start, step=step)
+            except RuntimeError as e:
+                error = str(e)
+                self.root.after(0, lambda: messagebox.showerror("Input error", error))
+                return
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: messagebox.showerror("Preview error", f"Failed to render preview: {error}"))
+                return
+            finally:
+                self.root.after(0, self._preview_done)
+
+            self.root.after(0, lambda: self._show_preview(sample_pdf, options, result, excel is None))
 
-        self.append_log(f"Showing preview snippet for: {os.path.basename(sample_pdf)}")
-        show_preview_snippet(self.root, sample_pdf, df, subj, dist, ffamily, fsize, case_sensitive=cs, whole_word=ww, use_regex=ur)
+            # pre-render the other pages with hits so changing distance/font only redraws overlays
+            try:
+                self.preview_renderer.prerender(sample_pdf, options, self.prefetch_stop)
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: self.append_log(f"Preview pre-rendering stopped: {error}"))
+
+    def _preview_done(self):
+        # processing may have started meanwhile (and may still be winding down after Cancel); it
+        # owns the buttons then
+        if not self.processing:
+            for w in (self.preview_button, self.start_button):
+                w.configure(state=NORMAL)
+
+    def _show_preview(self, pdf_path, options, result, stepping=False):
+        if result is None:
+            if stepping:
+                messagebox.showinfo("Preview", "No further pages with tags in that direction.")
+            else:
+                messagebox.showinfo("Preview", "No tags found in the PDF to preview.")
+            return
+        self.preview_state = (pdf_path, options, result["page_index"])
+        window = self.preview_window
+        if window is not None and window.winfo_exists():
+            window.show(result, pdf_path)
+            window.lift()
+            return
+        if not stepping:
+            self.append_log(f"Showing preview snippet for: {os.path.basename(pdf_path)}")
+        self.preview_window = open_preview_window(self.root, pdf_path, result, on_step=self.step_preview)
 
     def disable_ui(self):
         widgets_to_disable = [
@@ -1066,12 +842,19 @@ class App(Frame):
             self.preview_button,
             self.start_button,
             self.font_size_entry,
+            self.priority_entry,
+            self.workers_entry,
+            self.include_entry,
+            self.exclude_entry,
+            self.wrap_width_entry,
+            self.time_limit_entry,
         ]
         for w in widgets_to_disable:
             try:
                 w.configure(state=DISABLED)
             except Exception:
                 pass
+        self.cancel_button.configure(state=NORMAL)
 
     def enable_ui(self):
         widgets_to_enable = [
@@ -1084,12 +867,22 @@ class App(Frame):
             self.preview_button,
             self.start_button,
             self.font_size_entry,
+            self.priority_entry,
+            self.workers_entry,
+            self.include_entry,
+            self.exclude_entry,
+            self.wrap_width_entry,
+            self.time_limit_entry,
         ]
         for w in widgets_to_enable:
             try:
                 w.configure(state=NORMAL)
             except Exception:
                 pass
+        if self.folder_mode.get() != 1:
+            self.include_entry.configure(state=DISABLED)
+            self.exclude_entry.configure(state=DISABLED)
+        self.cancel_button.configure(state=DISABLED)
 
 
 def main():
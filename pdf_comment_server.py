@@ -0,0 +1,476 @@
+"""
+Local annotation service for CommentPdfFromExcel.
+
+Keeps a pool of warm worker processes (PyMuPDF/pandas already imported, tag sheets already parsed)
+so other tools can annotate a PDF on demand without paying the start-up cost per document.
+
+Usage:
+    python pdf_comment_server.py --excel tags.xlsx [--excel piping=piping.xlsx] [--port 8765]
+    python pdf_comment_server.py --excel tags.xlsx --unix-socket /tmp/commentpdf.sock
+
+Repeating --excel with the same NAME merges those workbooks into one tag index; --sheet and
+--all-sheets pick the worksheets read from each workbook.
+
+Endpoints:
+    GET  /health     JSON with the loaded sheets and worker/concurrency settings
+    POST /annotate   Body is the PDF (application/pdf), or empty with ?path=... for a server-side file
+                     (only under --allow-path roots). Query options: sheet, subject, distance, font,
+                     font_size, wrap_width, case_sensitive, whole_word, regex, report.
+                     Returns the annotated PDF, or a JSON match report when report=1.
+
+Every response to /annotate carries Server-Timing plus X-Queue-Time-Ms / X-Process-Time-Ms /
+X-Total-Time-Ms headers. A request that exceeds --request-timeout is answered with 504 and its
+worker is stopped; a worker that crashes (502) is replaced as well, so a pathological PDF never
+holds on to a worker or a concurrency slot.
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import fitz  # PyMuPDF
+
+from commentpdf.core import (
+    PDF_FONT_MAP,
+    add_annotation_arguments,
+    add_tag_sheet_arguments,
+    annotate_pdf_bytes,
+    annotation_options_from_args,
+    build_annotations_for_preview,
+    load_tag_sheet,
+    prepare_tag_plan,
+    sheet_names_from_args,
+)
+from commentpdf.watchdog import WorkerPool
+
+DEFAULT_SHEET = "default"
+
+
+# ---------- Worker process state ----------
+_WORKER_SHEETS = {}
+
+
+def _init_worker(sheets):
+    global _WORKER_SHEETS
+    # rows are built once per worker instead of once per page
+    _WORKER_SHEETS = {name: prepare_tag_plan(df) for name, df in sheets.items()}
+
+
+def _annotate_request(pdf_bytes, pdf_path, sheet, options, report_only):
+    """
+    Run one request inside a worker. Returns a dict with either 'pdf' (bytes) or 'report',
+    plus 'annotations' and 'seconds'. Raises ValueError for unusable input.
+    """
+    start = time.perf_counter()
+    df = _WORKER_SHEETS[sheet]
+
+    if report_only:
+        try:
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf") if pdf_bytes is not None else fitz.open(pdf_path)
+        except Exception as e:
+            raise ValueError(f"Could not open PDF: {e}")
+        matches = []
+        try:
+            for page_num in range(len(doc)):
+                anns = build_annotations_for_preview(
+                    doc[page_num],
+                    df,
+                    options.get("distance", 10),
+                    font_family=options.get("font_family", "Arial"),
+                    font_size=options.get("font_size", 12),
+                    case_sensitive=options.get("case_sensitive", False),
+                    whole_word=options.get("whole_word", False),
+                    use_regex=options.get("use_regex", False),
+                    subject=options.get("subject", "Comment"),
+                    wrap_width=options.get("wrap_width"),
+                )
+                for a in anns:
+                    matches.append(
+                        {
+                            "page": page_num + 1,
+                            "tag": a["tag"],
+                            "comment": a["comment"],
+                            "subject": a["subject"],
+                            "fill_color": list(a["fill_color"]),
+                            "tag_rect": list(a["inst_rect"]),
+                            "annot_rect": list(a["annot_rect"]),
+                            "lines": list(a["lines"]),
+                        }
+                    )
+            page_count = len(doc)
+        finally:
+            doc.close()
+        report = {"pages": page_count, "annotations": len(matches), "matches": matches}
+        return {"report": report, "annotations": len(matches), "seconds": time.perf_counter() - start}
+
+    # uploads are annotated in memory; server-side files are read once
+    if pdf_bytes is not None:
+        data, result = annotate_pdf_bytes(pdf_bytes, df, **options)
+    else:
+        try:
+            with open(pdf_path, "rb") as f:
+                data, result = annotate_pdf_bytes(f, df, **options)
+        except OSError as e:
+            raise ValueError(f"Could not read PDF: {e}")
+    return {"pdf": data, "annotations": result["annotations"], "seconds": time.perf_counter() - start}
+
+
+class RequestError(Exception):
+    """A request that cannot be served; carries the HTTP status to answer with."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def _flag(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+class AnnotationService:
+    """
+    Warm worker pool with preloaded tag sheets (see commentpdf.watchdog.WorkerPool).
+
+    sheets: mapping of sheet name -> Excel path (or list of paths merged into one tag index);
+        requests pick one with ?sheet= (default: 'default', or the only sheet when just one is loaded).
+    sheet_names: which worksheets to read from each workbook, as for load_tag_sheet.
+    max_concurrent: requests processed at once; further requests wait up to queue_timeout seconds
+        for a slot and are then rejected with 503.
+    request_timeout: seconds a single request may take in a worker before 504 is returned; that
+        worker is stopped and replaced.
+    allowed_roots: folders under which ?path= requests may read files (empty disables path mode).
+    """
+
+    def __init__(
+        self,
+        sheets,
+        sheet_names=None,
+        workers=2,
+        max_concurrent=None,
+        queue_timeout=30.0,
+        request_timeout=300.0,
+        max_upload_mb=512,
+        allowed_roots=None,
+        default_options=None,
+        log_func=None,
+    ):
+        self.sheet_paths = dict(sheets)
+        self.sheet_names = sheet_names
+        self.workers = max(1, int(workers))
+        self.max_concurrent = int(max_concurrent or self.workers)
+        self.queue_timeout = float(queue_timeout)
+        self.request_timeout = float(request_timeout)
+        self.max_upload_bytes = int(max_upload_mb * 1024 * 1024)
+        self.allowed_roots = [os.path.realpath(r) for r in (allowed_roots or [])]
+        self.default_options = dict(default_options or {})
+        self.log_func = log_func
+
+        self.sheet_rows = {}
+        self.sheet_conflicts = {}
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._pool = None
+
+    def log(self, msg):
+        if self.log_func:
+            self.log_func(msg)
+
+    def start(self):
+        """Parse every tag sheet and start (and warm) the worker processes."""
+        sheets = {}
+        for name, path in self.sheet_paths.items():
+            sheets[name] = load_tag_sheet(path, self.sheet_names, self.log)
+            self.sheet_rows[name] = len(sheets[name])
+            self.sheet_conflicts[name] = len(sheets[name].attrs.get("conflicts", []))
+            files = ", ".join(os.path.basename(p) for p in ([path] if isinstance(path, str) else path))
+            self.log(f"Loaded sheet '{name}': {files} ({len(sheets[name])} tags)")
+        self._pool = WorkerPool(self.workers, _init_worker, (sheets,))
+        pids = self._pool.warm()
+        self.log(f"{len(pids)} worker process(es) ready.")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _replace_workers(self):
+        # start the replacement now rather than when the next request needs it
+        threading.Thread(target=self._pool.replenish, daemon=True).start()
+
+    def resolve_sheet(self, name):
+        if not name:
+            if len(self.sheet_paths) == 1:
+                return next(iter(self.sheet_paths))
+            name = DEFAULT_SHEET
+        if name not in self.sheet_paths:
+            raise RequestError(404, f"Unknown sheet '{name}'. Loaded: {', '.join(sorted(self.sheet_paths))}")
+        return name
+
+    def resolve_path(self, path):
+        if not self.allowed_roots:
+            raise RequestError(403, "Path requests are disabled (start the server with --allow-path).")
+        real = os.path.realpath(path)
+        if not any(os.path.commonpath([real, root]) == root for root in self.allowed_roots):
+            raise RequestError(403, "Path is outside the allowed folders.")
+        if not os.path.isfile(real):
+            raise RequestError(404, f"No such file: {path}")
+        return real
+
+    def options_from_query(self, query):
+        """Merge query parameters over the server defaults into annotate_pdf_bytes options."""
+        opts = dict(self.default_options)
+        try:
+            if "subject" in query:
+                opts["subject"] = query["subject"] or "Comment"
+            if "distance" in query:
+                opts["distance"] = int(query["distance"])
+                if opts["distance"] < 0:
+                    raise ValueError("distance must be >= 0")
+            if "font" in query:
+                if query["font"] not in PDF_FONT_MAP:
+                    raise ValueError(f"unknown font '{query['font']}'")
+                opts["font_family"] = query["font"]
+            if "font_size" in query:
+                opts["font_size"] = int(query["font_size"])
+                if opts["font_size"] <= 0:
+                    raise ValueError("font_size must be a positive integer")
+            if "wrap_width" in query:
+                opts["wrap_width"] = float(query["wrap_width"]) if query["wrap_width"] else None
+                if opts["wrap_width"] is not None and opts["wrap_width"] <= 0:
+                    raise ValueError("wrap_width must be positive")
+        except ValueError as e:
+            raise RequestError(400, f"Invalid option: {e}")
+        for key, opt in (("case_sensitive", "case_sensitive"), ("whole_word", "whole_word"), ("regex", "use_regex")):
+            if key in query:
+                opts[opt] = _flag(query[key])
+        return opts
+
+    def annotate(self, pdf_bytes, pdf_path, sheet, options, report_only):
+        """Run one request on the pool; return (result dict, timings dict in milliseconds)."""
+        t0 = time.perf_counter()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise RequestError(503, "Server busy; try again later.")
+        try:
+            worker = self._pool.acquire(timeout=max(0.0, self.queue_timeout - (time.perf_counter() - t0)))
+            if worker is None:
+                raise RequestError(503, "Server busy; try again later.")
+            t1 = time.perf_counter()
+            try:
+                worker.run(_annotate_request, pdf_bytes, pdf_path, sheet, options, report_only)
+                outcome = worker.poll(self.request_timeout)
+                if outcome is None:
+                    # the only way to stop a running page: the worker goes, a fresh one replaces it
+                    worker.kill()
+                    self.log(f"Request exceeded {self.request_timeout:.0f}s; its worker was stopped.")
+                    raise RequestError(504, f"Processing exceeded {self.request_timeout:.0f}s.")
+            except OSError as e:
+                # the worker died before it received the request
+                worker.kill()
+                outcome = ("crashed", f"worker process unavailable ({e})")
+            finally:
+                self._pool.release(worker)
+                if not worker.is_alive():
+                    self._replace_workers()
+        finally:
+            self._slots.release()
+        kind, result = outcome
+        if kind in ("crashed", "limit"):
+            self.log(f"Request failed: {result}")
+            raise RequestError(502, f"Processing failed: {result}.")
+        if kind == "error":
+            if isinstance(result, ValueError):
+                raise RequestError(422, str(result))
+            raise result
+        t2 = time.perf_counter()
+        timings = {
+            "queue": (t1 - t0) * 1000.0,
+            "process": result["seconds"] * 1000.0,
+            "total": (t2 - t0) * 1000.0,
+        }
+        return result, timings
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "CommentPdfFromExcel"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def address_string(self):
+        # Unix-socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return "unix"
+
+    def log_message(self, format, *args):
+        self.service.log(f"{self.address_string()} {format % args}")
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, obj, headers=None):
+        self._send(status, json.dumps(obj).encode("utf-8"), "application/json", headers)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._send_json(404, {"error": "Not found"})
+            return
+        svc = self.service
+        self._send_json(
+            200,
+            {
+                "status": "ok",
+                "sheets": svc.sheet_rows,
+                "conflicting_tags": svc.sheet_conflicts,
+                "workers": svc.workers,
+                "max_concurrent": svc.max_concurrent,
+                "path_requests": bool(svc.allowed_roots),
+            },
+        )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/annotate":
+            self._send_json(404, {"error": "Not found"})
+            return
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > self.service.max_upload_bytes:
+                # the body is not read, so the connection cannot carry another request
+                self.close_connection = True
+                raise RequestError(413, "Upload too large.")
+            pdf_bytes = self.rfile.read(length) if length > 0 else None
+
+            pdf_path = None
+            if pdf_bytes is None:
+                if not query.get("path"):
+                    raise RequestError(400, "Send the PDF as the request body or pass ?path=.")
+                pdf_path = self.service.resolve_path(query["path"])
+
+            sheet = self.service.resolve_sheet(query.get("sheet"))
+            options = self.service.options_from_query(query)
+            report_only = _flag(query.get("report", "0"))
+            result, timings = self.service.annotate(pdf_bytes, pdf_path, sheet, options, report_only)
+        except RequestError as e:
+            self._send_json(e.status, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": f"Internal error: {e}"})
+            return
+
+        headers = {
+            "X-Queue-Time-Ms": f"{timings['queue']:.1f}",
+            "X-Process-Time-Ms": f"{timings['process']:.1f}",
+            "X-Total-Time-Ms": f"{timings['total']:.1f}",
+            "Server-Timing": (
+                f"queue;dur={timings['queue']:.1f}, process;dur={timings['process']:.1f}, "
+                f"total;dur={timings['total']:.1f}"
+            ),
+            "X-Annotation-Count": str(result["annotations"]),
+        }
+        if report_only:
+            self._send_json(200, result["report"], headers)
+        else:
+            self._send(200, result["pdf"], "application/pdf", headers)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a stale socket file from a previous run would make bind() fail
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    """Create (but do not start) the HTTP server for a started AnnotationService."""
+    if unix_socket:
+        server = _UnixHTTPServer(unix_socket, _RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve PDF annotation over local HTTP with warm workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="Listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--max-concurrent", type=int, default=None,
+                        help="Requests processed at once (default: number of workers)")
+    parser.add_argument("--queue-timeout", type=float, default=30.0)
+    parser.add_argument("--request-timeout", type=float, default=300.0)
+    parser.add_argument("--max-upload-mb", type=int, default=512)
+    parser.add_argument("--allow-path", action="append", default=[],
+                        help="Allow ?path= requests for files under this folder (repeatable)")
+    add_tag_sheet_arguments(parser)
+    add_annotation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        options = annotation_options_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sheets = {}
+    for spec in args.excel:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = DEFAULT_SHEET, spec
+        # the same NAME given several times merges those workbooks into one tag index
+        sheets.setdefault(name, []).append(path)
+
+    def log(msg):
+        print(f"{time.strftime('%H:%M:%S')} {msg}", flush=True)
+
+    service = AnnotationService(
+        sheets,
+        sheet_names=sheet_names_from_args(args),
+        workers=args.workers,
+        max_concurrent=args.max_concurrent,
+        queue_timeout=args.queue_timeout,
+        request_timeout=args.request_timeout,
+        max_upload_mb=args.max_upload_mb,
+        allowed_roots=args.allow_path,
+        default_options=options,
+        log_func=log,
+    )
+    try:
+        service.start()
+    except RuntimeError as e:
+        parser.exit(1, f"Error: {e}\n")
+
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    log(f"Listening on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""
+Watch-folder service mode for CommentPdfFromExcel.
+
+Runs until interrupted, annotating PDFs as they are dropped into (or replaced in) one or more
+input folders. The tag sheet is loaded once and kept in memory by every worker process; it is
+only reloaded when the Excel file itself changes.
+
+Usage:
+    python pdf_comment_watch.py --excel tags.xlsx --input /mnt/share/incoming [--input other] [--output out]
+
+Folder events come from the optional 'watchdog' package (inotify on Linux) when it is installed;
+otherwise the folders are polled. Either way a file is only queued once its size and modification
+time have stopped changing for --settle seconds, so half-copied PDFs are never picked up.
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from commentpdf.core import (
+    add_annotation_arguments,
+    add_tag_sheet_arguments,
+    annotation_options_from_args,
+    is_marked_output,
+    load_tag_sheet,
+    marked_output_path,
+    sheet_names_from_args,
+    update_pdf_with_comments,
+)
+from commentpdf.schedule import schedule_pdf_paths
+
+# watchdog is optional; without it the watcher falls back to polling
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except Exception:
+    WATCHDOG_AVAILABLE = False
+
+
+# ---------- Worker process state ----------
+# Each worker process receives the tag sheet once (via the pool initializer) instead of per file.
+_WORKER_TAG_DF = None
+_WORKER_OPTIONS = {}
+
+
+def _init_worker(tag_df, options):
+    global _WORKER_TAG_DF, _WORKER_OPTIONS
+    _WORKER_TAG_DF = tag_df
+    _WORKER_OPTIONS = dict(options)
+
+
+def _annotate_in_worker(pdf_path, output_pdf_path):
+    """
+    Annotate one PDF with the worker's preloaded tag sheet; return (annotation count, log lines,
+    seconds). The count is None when the PDF could not be opened or saved.
+    """
+    lines = []
+    start = time.perf_counter()
+    count = update_pdf_with_comments(
+        pdf_path, _WORKER_TAG_DF, output_pdf_path, log_func=lines.append, **_WORKER_OPTIONS
+    )
+    return count, lines, time.perf_counter() - start
+
+
+def _file_signature(path):
+    """Return (size, mtime_ns) for path, or None if it cannot be stat'ed (e.g. removed meanwhile)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+class FolderWatcher:
+    """
+    Watch input folders and the Excel tag sheet(s), queueing new or changed PDFs to a worker pool.
+
+    excel_path: a workbook or a list of workbooks; sheet_names as for load_tag_sheet.
+    output_folder: where '<name>_marked.pdf' files are written; None writes next to each input.
+    settle_seconds: a file must keep the same size/mtime this long before it is processed.
+    poll_interval: seconds between folder checks (also the event-loop tick when using watchdog).
+    rescan_interval: with watchdog, a full rescan still runs this often to catch missed events
+        (network shares do not always deliver them).
+    reprocess_on_workbook_change: re-annotate every known PDF after the tag sheet changes.
+    priority: file names/glob patterns queued ahead of others that become ready at the same time;
+        the rest are queued largest file first (see commentpdf.schedule).
+    """
+
+    def __init__(
+        self,
+        input_folders,
+        excel_path,
+        output_folder=None,
+        sheet_names=None,
+        options=None,
+        workers=2,
+        settle_seconds=2.0,
+        poll_interval=1.0,
+        rescan_interval=60.0,
+        reprocess_on_workbook_change=False,
+        log_func=None,
+        priority=None,
+    ):
+        self.input_folders = [os.path.abspath(f) for f in input_folders]
+        paths = [excel_path] if isinstance(excel_path, (str, os.PathLike)) else excel_path
+        self.excel_paths = [os.path.abspath(p) for p in paths]
+        self.sheet_names = sheet_names
+        self.output_folder = output_folder
+        self.options = dict(options or {})
+        self.workers = max(1, int(workers))
+        self.settle_seconds = float(settle_seconds)
+        self.poll_interval = float(poll_interval)
+        self.rescan_interval = float(rescan_interval)
+        self.reprocess_on_workbook_change = reprocess_on_workbook_change
+        self.log_func = log_func
+        self.priority = list(priority or [])
+
+        self._tag_df = None
+        self._excel_sig = None
+        # (signature, first seen) of a workbook change that is still settling
+        self._excel_pending = None
+        self._pool = None
+        # incremented on every tag sheet (re)load; in-flight files remember the version they run with
+        self._sheet_version = 0
+        self._observer = None
+
+        # path -> signature of the version last processed
+        self._done = {}
+        # path -> signature of a version that failed; retried once the file changes
+        self._failed = {}
+        # path -> (signature, time the signature was first seen)
+        self._pending = {}
+        # path -> (future, signature, tag sheet version)
+        self._in_flight = {}
+        # paths reported by watchdog since the last tick
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def log(self, msg):
+        if self.log_func:
+            self.log_func(msg)
+
+    # ----- tag sheet -----
+    def _workbook_signature(self):
+        sigs = tuple(_file_signature(p) for p in self.excel_paths)
+        return None if None in sigs else sigs
+
+    def _reload_tag_sheet(self):
+        """Load the workbook(s) and restart the worker pool with them. Return True on success."""
+        sig = self._workbook_signature()
+        try:
+            df = load_tag_sheet(self.excel_paths, self.sheet_names, self.log)
+        except RuntimeError as e:
+            if self._tag_df is None:
+                raise
+            self.log(f"Tag sheet reload failed, keeping previous version: {e}")
+            # remember the signature so a broken save is not re-read every tick
+            self._excel_sig = sig
+            return False
+
+        self._tag_df = df
+        self._excel_sig = sig
+        self._sheet_version += 1
+        self._restart_pool()
+        names = ", ".join(os.path.basename(p) for p in self.excel_paths)
+        self.log(f"Loaded tag sheet: {names} ({len(df)} tags)")
+        return True
+
+    def _check_workbook(self, now):
+        sig = self._workbook_signature()
+        if sig is None or sig == self._excel_sig:
+            self._excel_pending = None
+            return
+        # debounce the workbook exactly like PDFs: Excel writes it in several steps
+        seen = self._excel_pending
+        if seen is None or seen[0] != sig:
+            self._excel_pending = (sig, now)
+            return
+        if now - seen[1] < self.settle_seconds:
+            return
+        self._excel_pending = None
+        if self._reload_tag_sheet() and self.reprocess_on_workbook_change:
+            self.log("Tag sheet changed; re-queueing all known PDFs.")
+            self._done.clear()
+            self._failed.clear()
+
+    def _restart_pool(self):
+        if self._pool is not None:
+            # running files finish with the old tag sheet in the background and are reaped as usual;
+            # queued ones are cancelled and re-submitted below to the pool with the new one
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self._tag_df, self.options),
+        )
+        for path, (future, sig, _) in list(self._in_flight.items()):
+            if future.cancelled():
+                self._submit(path, sig)
+
+    # ----- discovery -----
+    def _is_candidate(self, path):
+        return path.lower().endswith(".pdf") and not is_marked_output(path)
+
+    def _scan_folders(self):
+        paths = set()
+        for folder in self.input_folders:
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file() and self._is_candidate(entry.path):
+                            paths.add(entry.path)
+            except OSError as e:
+                self.log(f"Cannot scan {folder}: {e}")
+        return paths
+
+    def _collect_ready(self, candidates, now):
+        """Update debounce state for candidates and return the paths that are ready to process."""
+        ready = []
+        for path in candidates:
+            if path in self._in_flight:
+                continue
+            sig = _file_signature(path)
+            if sig is None:
+                self._pending.pop(path, None)
+                self._done.pop(path, None)
+                self._failed.pop(path, None)
+                continue
+            if self._done.get(path) == sig or self._failed.get(path) == sig:
+                self._pending.pop(path, None)
+                continue
+            seen = self._pending.get(path)
+            if seen is None or seen[0] != sig:
+                self._pending[path] = (sig, now)
+                continue
+            if now - seen[1] >= self.settle_seconds:
+                del self._pending[path]
+                ready.append((path, sig))
+        return ready
+
+    def _forget_removed(self, found):
+        """Drop the processing history of files gone from a folder that is still reachable."""
+        for history in (self._done, self._failed):
+            for path in [p for p in history if p not in found]:
+                if os.path.isdir(os.path.dirname(path)) and not os.path.exists(path):
+                    del history[path]
+
+    # ----- processing -----
+    def _output_path(self, pdf_path):
+        folder = self.output_folder or os.path.dirname(pdf_path)
+        return marked_output_path(pdf_path, folder)
+
+    def _order_ready(self, ready):
+        """
+        Order a batch of ready (path, signature) pairs: priority matches, then biggest first. The
+        size comes from the signature, so no file is opened on the watch loop.
+        """
+        if len(ready) < 2:
+            return ready
+        sigs = dict(ready)
+        ordered = schedule_pdf_paths(list(sigs), self.priority, cost_func=lambda path: sigs[path][0])
+        return [(path, sigs[path]) for path, _ in ordered]
+
+    def _submit(self, path, sig):
+        out_path = self._output_path(path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        future = self._pool.submit(_annotate_in_worker, path, out_path)
+        self._in_flight[path] = (future, sig, self._sheet_version)
+        self.log(f"Queued: {path}")
+
+    def _reap_finished(self):
+        for path, (future, sig, version) in list(self._in_flight.items()):
+            if not future.done():
+                continue
+            del self._in_flight[path]
+            if future.cancelled():
+                continue
+            try:
+                count, lines, seconds = future.result()
+            except Exception as e:
+                count, lines = None, [f"Error processing {os.path.basename(path)}: {e}"]
+            for line in lines:
+                self.log(line)
+            if count is None:
+                self.log(f"Failed {os.path.basename(path)}; it is retried when it changes.")
+                self._failed[path] = sig
+                continue
+            self.log(f"Finished {os.path.basename(path)} in {seconds:.2f}s")
+            self._failed.pop(path, None)
+            if version != self._sheet_version and self.reprocess_on_workbook_change:
+                # annotated with the previous tag sheet; queued again with the current one
+                continue
+            self._done[path] = sig
+
+    # ----- event source -----
+    def _start_observer(self):
+        if not WATCHDOG_AVAILABLE:
+            self.log("watchdog not installed; polling input folders.")
+            return
+
+        watcher = self
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                with watcher._dirty_lock:
+                    watcher._dirty.add(os.path.abspath(event.src_path))
+                    dest = getattr(event, "dest_path", None)
+                    if dest:
+                        watcher._dirty.add(os.path.abspath(dest))
+                watcher._wake.set()
+
+        self._observer = Observer()
+        handler = _Handler()
+        for folder in self.input_folders:
+            self._observer.schedule(handler, folder, recursive=False)
+        self._observer.start()
+
+    def _take_dirty(self):
+        with self._dirty_lock:
+            dirty = self._dirty
+            self._dirty = set()
+        return {p for p in dirty if self._is_candidate(p)}
+
+    def stop(self):
+        """Ask run() to return after the current tick (safe to call from another thread)."""
+        self._stop.set()
+        self._wake.set()
+
+    def run(self):
+        """Watch until stop() is called or KeyboardInterrupt; blocks the calling thread."""
+        self._reload_tag_sheet()
+        self._start_observer()
+        self.log(f"Watching {len(self.input_folders)} folder(s) with {self.workers} worker(s).")
+
+        last_full_scan = 0.0
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                self._check_workbook(now)
+                self._reap_finished()
+
+                if self._observer is None or now - last_full_scan >= self.rescan_interval:
+                    candidates = self._scan_folders()
+                    self._forget_removed(candidates)
+                    last_full_scan = now
+                else:
+                    candidates = self._take_dirty()
+                # files still settling must be re-checked even without new events
+                candidates.update(self._pending)
+
+                for path, sig in self._order_ready(self._collect_ready(candidates, now)):
+                    self._submit(path, sig)
+
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        except KeyboardInterrupt:
+            self.log("Interrupted; waiting for running files to finish...")
+        finally:
+            if self._observer is not None:
+                self._observer.stop()
+                self._observer.join()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._reap_finished()
+            self.log("Watcher stopped.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Annotate PDFs as they arrive in watched folders.")
+    parser.add_argument("--input", dest="inputs", action="append", required=True,
+                        help="Folder to watch (repeat for several folders)")
+    parser.add_argument("--output", default=None, help="Output folder (default: next to each input PDF)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--poll", type=float, default=1.0, help="Polling interval in seconds")
+    parser.add_argument("--reprocess-on-change", action="store_true",
+                        help="Re-annotate all known PDFs when the Excel file changes")
+    parser.add_argument("--priority", action="append", default=None,
+                        help="File name or glob pattern to process first (repeatable, in order)")
+    add_tag_sheet_arguments(parser)
+    add_annotation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        options = annotation_options_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for folder in args.inputs:
+        if not os.path.isdir(folder):
+            parser.error(f"Not a folder: {folder}")
+
+    def log(msg):
+        print(f"{time.strftime('%H:%M:%S')} {msg}", flush=True)
+
+    watcher = FolderWatcher(
+        args.inputs,
+        args.excel,
+        output_folder=args.output,
+        sheet_names=sheet_names_from_args(args),
+        options=options,
+        workers=args.workers,
+        settle_seconds=args.settle,
+        poll_interval=args.poll,
+        reprocess_on_workbook_change=args.reprocess_on_change,
+        log_func=log,
+        priority=args.priority,
+    )
+    try:
+        watcher.run()
+    except RuntimeError as e:
+        parser.exit(1, f"Error: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the engine is imported from the checkout, as the GUI and the service scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
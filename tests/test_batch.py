@@ -0,0 +1,146 @@
+import os
+import shutil
+import threading
+
+import fitz
+import pandas as pd
+
+from commentpdf.batch import BatchRun, PathFeed, SerialDispatcher, run_batch
+from commentpdf.core import JOURNAL_NAME, BatchJournal, process_files
+from commentpdf.schedule import estimate_pdf_cost
+
+DF = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+
+
+def _make_pdf(path, pages=1, text="PT-0001"):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def test_queue_puts_priority_files_first_then_largest(tmp_path):
+    small = _make_pdf(str(tmp_path / "small.pdf"), pages=1)
+    large = _make_pdf(str(tmp_path / "large.pdf"), pages=20)
+    urgent = _make_pdf(str(tmp_path / "urgent.pdf"), pages=1)
+    run = BatchRun(DF, {}, str(tmp_path / "out"), priority=["urgent*"], cost_func=estimate_pdf_cost)
+    for path in (small, large, urgent):
+        run.admit(path)
+
+    order = [os.path.basename(run.pop_ready()[0]) for _ in range(3)]
+    assert order == ["urgent.pdf", "large.pdf", "small.pdf"]
+    assert run.summary["total"] == 3
+
+
+def test_streamed_inputs_are_processed_as_they_are_found(tmp_path):
+    paths = [_make_pdf(str(tmp_path / f"d{n}.pdf")) for n in range(3)]
+    out = str(tmp_path / "out")
+    run = BatchRun(DF, {}, out)
+    run_batch(run, PathFeed(iter(paths)), SerialDispatcher(run))
+
+    assert run.summary["processed"] == 3
+    assert sorted(os.listdir(out)) == ["d0_marked.pdf", "d1_marked.pdf", "d2_marked.pdf"]
+
+
+def test_resume_skips_files_done_with_the_same_settings(tmp_path):
+    pdfs = [_make_pdf(str(tmp_path / f"d{n}.pdf")) for n in range(2)]
+    out = str(tmp_path / "out")
+    assert process_files(pdfs, None, out, tag_df=DF, journal=True)["processed"] == 2
+
+    summary = process_files(pdfs, None, out, tag_df=DF, journal=True, resume=True)
+    assert summary["skipped"] == 2
+    # other settings make the earlier outputs unusable
+    summary = process_files(pdfs, None, out, tag_df=DF, journal=True, resume=True, subject="Other")
+    assert summary["processed"] == 2
+
+
+def test_cancelling_counts_the_files_not_started(tmp_path):
+    pdfs = [_make_pdf(str(tmp_path / f"d{n}.pdf")) for n in range(4)]
+    out = str(tmp_path / "out")
+    cancel = threading.Event()
+    summary = process_files(
+        pdfs, None, out, tag_df=DF, journal=True, cancel_event=cancel, progress_callback=lambda pct: cancel.set()
+    )
+    assert summary["processed"] == 1
+    assert summary["cancelled"] == 3
+    assert not [name for name in os.listdir(out) if name.endswith(".part")]
+
+    journal = BatchJournal(os.path.join(out, JOURNAL_NAME), resume=True)
+    try:
+        assert [e["status"] for e in journal.entries.values()] == ["done"]
+    finally:
+        journal.close()
+
+
+def test_identical_inputs_are_processed_once(tmp_path):
+    first = _make_pdf(str(tmp_path / "first.pdf"))
+    copy = str(tmp_path / "copy.pdf")
+    shutil.copyfile(first, copy)
+    out = str(tmp_path / "out")
+    run = BatchRun(DF, {}, out, dedupe="copy")
+    run_batch(run, PathFeed([first, copy]), SerialDispatcher(run))
+
+    assert run.summary["processed"] == 2
+    assert run.summary["deduplicated"] == 1
+    with open(os.path.join(out, "first_marked.pdf"), "rb") as a, open(os.path.join(out, "copy_marked.pdf"), "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_pool_dispatcher_processes_every_file(tmp_path):
+    pdfs = [_make_pdf(str(tmp_path / f"d{n}.pdf")) for n in range(3)]
+    summary = process_files(pdfs, None, str(tmp_path / "out"), tag_df=DF, workers=2)
+    assert summary["processed"] == 3
+    # the workers' per-file stats reach the run metrics
+    assert summary["metrics"]["hits_per_tag"] == {"PT-0001": 3}
+
+
+def test_costs_are_estimated_off_the_dispatch_thread_only_with_several_workers(tmp_path, monkeypatch):
+    import commentpdf.schedule
+
+    estimated = []
+    real = commentpdf.schedule.estimate_pdf_cost
+
+    def spy(path):
+        estimated.append(threading.current_thread() is threading.main_thread())
+        return real(path)
+
+    monkeypatch.setattr(commentpdf.schedule, "estimate_pdf_cost", spy)
+    pdfs = [_make_pdf(str(tmp_path / f"d{n}.pdf")) for n in range(3)]
+    assert process_files(pdfs, None, str(tmp_path / "serial"), tag_df=DF, workers=1)["processed"] == 3
+    assert estimated == []
+
+    assert process_files(pdfs, None, str(tmp_path / "pool"), tag_df=DF, workers=2)["processed"] == 3
+    assert estimated == [False, False, False]
+
+
+def test_discarding_a_list_feed_counts_paths_not_yet_costed():
+    release = threading.Event()
+    feed = PathFeed(["a.pdf", "b.pdf", "c.pdf"], cost_func=lambda path: release.wait() and 1.0)
+    release.set()
+    assert feed.take(1, block=True) == ["a.pdf"]
+    assert feed.costs == {"a.pdf": 1.0}
+    assert feed.discard() == 2
+
+
+def test_defaults_leave_only_the_outputs_in_the_output_folder(tmp_path):
+    first = _make_pdf(str(tmp_path / "first.pdf"))
+    copy = str(tmp_path / "copy.pdf")
+    shutil.copyfile(first, copy)
+    out = str(tmp_path / "out")
+    summary = process_files([first, copy], None, out, tag_df=DF)
+
+    assert summary["processed"] == 2
+    assert summary["deduplicated"] == 0
+    assert summary["metrics"]["hits_per_tag"] == {"PT-0001": 2}
+    assert sorted(os.listdir(out)) == ["copy_marked.pdf", "first_marked.pdf"]
+
+
+def test_dedupe_true_copies_outputs(tmp_path):
+    first = _make_pdf(str(tmp_path / "first.pdf"))
+    copy = str(tmp_path / "copy.pdf")
+    shutil.copyfile(first, copy)
+    out = str(tmp_path / "out")
+    assert process_files([first, copy], None, out, tag_df=DF, dedupe=True)["deduplicated"] == 1
+    assert os.stat(os.path.join(out, "copy_marked.pdf")).st_nlink == 1
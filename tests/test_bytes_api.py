@@ -0,0 +1,71 @@
+import io
+import mmap
+import threading
+
+import fitz
+import pandas as pd
+import pytest
+
+from commentpdf import annotate_pdf_bytes, prepare_tag_plan, update_pdf_with_comments
+from commentpdf.core import ProcessingCancelled
+
+DF = pd.DataFrame({"tag": ["PT-0001", "PT-0002"], "comment": ["Gasket", "Valve"]})
+
+
+def _pdf_bytes():
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "PT-0001 and PT-0002")
+    doc.new_page().insert_text((72, 72), "PT-0001")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _annotations(data):
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return [(page.number, annot.info["content"], tuple(annot.rect)) for page in doc for annot in page.annots()]
+
+
+def test_every_input_kind_gives_the_file_based_result(tmp_path):
+    data = _pdf_bytes()
+    pdf, out = tmp_path / "drawing.pdf", str(tmp_path / "out.pdf")
+    pdf.write_bytes(data)
+    assert update_pdf_with_comments(str(pdf), DF, out) == 3
+    with open(out, "rb") as f:
+        expected = _annotations(f.read())
+
+    plan = prepare_tag_plan(DF)
+    with open(pdf, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        readers = [io.BytesIO(data), io.BufferedReader(io.BytesIO(data))]
+        for source in [data, bytearray(data), memoryview(data), mapped] + readers:
+            result_bytes, result = annotate_pdf_bytes(source, plan)
+            assert _annotations(result_bytes) == expected
+            assert result["annotations"] == result["added"] == 3
+            assert result["pages"] == 2
+            assert result["hits_per_tag"] == {"PT-0001": 2, "PT-0002": 1}
+            assert [(h["page"], h["tag"], h["comment"]) for h in result["hits"]] == [
+                (1, "PT-0001", "Gasket"), (1, "PT-0002", "Valve"), (2, "PT-0001", "Gasket")
+            ]
+            assert set(result["timings"]) == {"open", "match", "annotate", "save", "total"}
+
+
+def test_output_stream_and_re_annotation(tmp_path):
+    plan = prepare_tag_plan(DF)
+    sink = io.BytesIO()
+    data, result = annotate_pdf_bytes(_pdf_bytes(), plan, output=sink)
+    assert data is None
+    assert result["annotations"] == 3
+
+    # annotating the output again recognises the tool's annotations instead of duplicating them
+    again, result = annotate_pdf_bytes(sink.getvalue(), plan)
+    assert (result["annotations"], result["added"], result["kept"]) == (3, 0, 3)
+    assert len(_annotations(again)) == 3
+
+
+def test_errors_and_cancellation():
+    with pytest.raises(ValueError, match="Could not open PDF"):
+        annotate_pdf_bytes(b"not a pdf", DF)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(ProcessingCancelled):
+        annotate_pdf_bytes(_pdf_bytes(), DF, cancel_event=cancel)
@@ -0,0 +1,54 @@
+import os
+
+from commentpdf.discover import iter_pdf_files, split_patterns
+
+
+def _touch(root, *rel_paths):
+    for rel in rel_paths:
+        path = os.path.join(root, *rel.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"%PDF")
+
+
+def _found(root, **kwargs):
+    return sorted(os.path.relpath(p, root).replace(os.sep, "/") for p in iter_pdf_files(root, **kwargs))
+
+
+def test_split_patterns_accepts_commas_and_semicolons():
+    assert split_patterns(" *.pdf; rev?/*, ,old*;") == ["*.pdf", "rev?/*", "old*"]
+    assert split_patterns("") == []
+
+
+def test_walks_the_tree_and_skips_marked_outputs(tmp_path):
+    root = str(tmp_path)
+    _touch(root, "a.pdf", "B.PDF", "a_marked.pdf", "notes.txt", "sub/c.pdf", "sub/deeper/d.pdf")
+
+    assert _found(root) == ["B.PDF", "a.pdf", "sub/c.pdf", "sub/deeper/d.pdf"]
+    assert _found(root, recursive=False) == ["B.PDF", "a.pdf"]
+    assert "a_marked.pdf" in _found(root, skip_marked=False)
+
+
+def test_include_and_exclude_match_names_and_relative_paths(tmp_path):
+    root = str(tmp_path)
+    _touch(root, "P-101.pdf", "I-200.pdf", "drawings/rev1/P-102.pdf", "drawings/rev2/P-103.pdf", "old/P-104.pdf")
+
+    assert _found(root, include=["p-*"]) == [
+        "P-101.pdf", "drawings/rev1/P-102.pdf", "drawings/rev2/P-103.pdf", "old/P-104.pdf"
+    ]
+    assert _found(root, include=["drawings/*/p-*.pdf"]) == ["drawings/rev1/P-102.pdf", "drawings/rev2/P-103.pdf"]
+    # an excluded folder is not entered; an excluded path drops single files
+    assert _found(root, exclude=["OLD", "drawings/rev1/*"]) == ["I-200.pdf", "P-101.pdf", "drawings/rev2/P-103.pdf"]
+
+
+def test_sub_folders_are_visited_in_name_order(tmp_path):
+    root = str(tmp_path)
+    _touch(root, "b/1.pdf", "a/2.pdf", "c/3.pdf", "a/z/4.pdf")
+    found = [os.path.relpath(p, root).replace(os.sep, "/") for p in iter_pdf_files(root)]
+    assert found == ["a/2.pdf", "a/z/4.pdf", "b/1.pdf", "c/3.pdf"]
+
+
+def test_unreadable_root_is_logged(tmp_path):
+    logged = []
+    assert list(iter_pdf_files(str(tmp_path / "missing"), log_func=logged.append)) == []
+    assert logged and logged[0].startswith("Cannot scan ")
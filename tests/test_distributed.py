@@ -0,0 +1,70 @@
+import os
+import time
+
+import fitz
+import pandas as pd
+
+from commentpdf.distributed import DONE, FAILED, WorkQueue, enqueue_batch, run_workers
+
+
+def _make_batch(tmp_path, count):
+    excel = str(tmp_path / "tags.xlsx")
+    pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]}).to_excel(excel, index=False)
+    pdfs = []
+    for n in range(count):
+        path = str(tmp_path / f"d{n}.pdf")
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "PT-0001")
+        doc.save(path)
+        doc.close()
+        pdfs.append(path)
+    return excel, pdfs
+
+
+def _abandon_lease(queue_path, worker):
+    """Lease the first queued file as a worker that then dies; return its (id, input, output)."""
+    queue = WorkQueue(queue_path)
+    try:
+        item = queue.lease(worker, lease_seconds=0.05)[0]
+    finally:
+        queue.close()
+    time.sleep(0.1)
+    return item
+
+
+def test_workers_take_over_expired_leases(tmp_path):
+    excel, pdfs = _make_batch(tmp_path, 4)
+    queue_path, out = str(tmp_path / "job.db"), str(tmp_path / "out")
+    enqueue_batch(queue_path, pdfs, excel, out, priority=["d0.pdf"], max_attempts=3)
+    item_id, _, out_path = _abandon_lease(queue_path, "dead-host:1")
+    # the dead worker's temporary output; the next worker must not write to the same name
+    os.makedirs(out_path + ".part")
+
+    assert run_workers(queue_path, 2, poll_interval=0.1, log_func=None) == {DONE: 4, FAILED: 0}
+    queue = WorkQueue(queue_path)
+    try:
+        assert queue.counts()[DONE] == 4
+        assert queue._conn.execute("SELECT attempts FROM items WHERE id = ?", (item_id,)).fetchone() == (2,)
+    finally:
+        queue.close()
+    assert sorted(n for n in os.listdir(out) if n.endswith(".pdf")) == [f"d{n}_marked.pdf" for n in range(4)]
+    assert [n for n in os.listdir(out) if n.endswith(".part")] == ["d0_marked.pdf.part"]
+
+
+def test_file_fails_after_max_attempts_expired_leases(tmp_path):
+    excel, pdfs = _make_batch(tmp_path, 3)
+    queue_path, out = str(tmp_path / "job.db"), str(tmp_path / "out")
+    enqueue_batch(queue_path, pdfs, excel, out, priority=["d0.pdf"], max_attempts=2)
+    first = _abandon_lease(queue_path, "dead-host:1")
+    # the expired lease is queued again and killed its second worker too
+    assert _abandon_lease(queue_path, "dead-host:2")[0] == first[0]
+
+    assert run_workers(queue_path, 2, poll_interval=0.1, log_func=None) == {DONE: 2, FAILED: 0}
+    queue = WorkQueue(queue_path)
+    try:
+        assert queue.counts() == {"queued": 0, "leased": 0, DONE: 2, FAILED: 1}
+        [(pdf_path, error)] = queue.failures()
+    finally:
+        queue.close()
+    assert pdf_path == os.path.abspath(pdfs[0])
+    assert error.startswith("lease expired 2 time(s)")
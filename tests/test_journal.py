@@ -0,0 +1,68 @@
+import os
+import shutil
+
+import fitz
+import pandas as pd
+
+from commentpdf.core import BatchJournal, JOURNAL_NAME, process_files
+
+
+def _make_pdf(path, text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+
+
+def test_identical_input_reuses_output_from_two_runs_back(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001", "PT-0002"], "comment": ["Gasket", "Valve"]})
+    first, other, copy = (str(tmp_path / name) for name in ("first.pdf", "other.pdf", "copy.pdf"))
+    _make_pdf(first, "PT-0001")
+    _make_pdf(other, "PT-0002")
+    shutil.copyfile(first, copy)
+    out = str(tmp_path / "out")
+
+    opts = {"tag_df": df, "journal": True, "dedupe": "copy"}
+    assert process_files([first], None, out, **opts)["processed"] == 1
+    # an unrelated run in between must not forget the first run's output
+    assert process_files([other], None, out, **opts)["deduplicated"] == 0
+    summary = process_files([copy], None, out, **opts)
+    assert summary["processed"] == 1
+    assert summary["deduplicated"] == 1
+
+
+def test_carried_records_are_not_resumed(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    _make_pdf(pdf, "PT-0001")
+    out = str(tmp_path / "out")
+
+    process_files([pdf], None, out, tag_df=df, journal=True, dedupe="copy")
+    journal = BatchJournal(str(tmp_path / "out" / JOURNAL_NAME))
+    journal.close()
+    # the fresh journal keeps the record only for reuse by content, not as a finished file
+    assert journal.by_content
+    resumed = BatchJournal(str(tmp_path / "out" / JOURNAL_NAME), resume=True)
+    resumed.close()
+    assert resumed.entries == {}
+
+
+def test_resume_checks_every_profile_output(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    _make_pdf(pdf, "PT-0001")
+    out = tmp_path / "out"
+    profiles = [{"name": "process", "tag_df": df}, {"name": "piping", "tag_df": df}]
+
+    assert process_files([pdf], None, str(out), profiles=profiles, journal=True)["processed"] == 1
+    journal = BatchJournal(str(out / JOURNAL_NAME), resume=True)
+    journal.close()
+    record = journal.entries[pdf]
+    assert [os.path.basename(os.path.dirname(o["output"])) for o in record["outputs"]] == ["process", "piping"]
+
+    assert process_files([pdf], None, str(out), profiles=profiles, resume=True)["skipped"] == 1
+    # losing the second profile's output makes the file pending again
+    os.remove(record["outputs"][1]["output"])
+    summary = process_files([pdf], None, str(out), profiles=profiles, resume=True)
+    assert summary["processed"] == 1
+    assert os.path.exists(record["outputs"][1]["output"])
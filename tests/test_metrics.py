@@ -0,0 +1,75 @@
+import json
+import os
+from collections import Counter
+
+import fitz
+import pandas as pd
+
+from commentpdf.core import process_files
+from commentpdf.metrics import METRICS_NAME, RunMetrics, format_metrics, new_file_stats, write_prometheus_textfile
+
+
+def _stats(pages, hits, unmapped=0):
+    stats = new_file_stats()
+    stats.update(pages=pages, hits=Counter(hits), unmapped=unmapped)
+    return stats
+
+
+def test_run_metrics_fold_file_stats():
+    run = RunMetrics(["PT-0001", "PT-0002", "PT-0003"], slowest=2)
+    run.add_file("a.pdf", 1.0, _stats(2, {"PT-0001": 3}))
+    run.add_file("b.pdf", 3.0, _stats(1, {"PT-0001": 1, "PT-0002": 1}, unmapped=1))
+    run.add_file("c.pdf", 2.0, _stats(4, {}))
+    metrics = run.to_dict()
+
+    assert (metrics["files"], metrics["pages"], metrics["annotations"]) == (3, 7, 5)
+    assert metrics["file_seconds"] == 6.0
+    assert metrics["failed_mappings"] == 1
+    assert metrics["hits_per_tag"] == {"PT-0001": 4, "PT-0002": 1}
+    assert list(metrics["hits_per_tag"]) == ["PT-0001", "PT-0002"]
+    assert metrics["unmatched_tags"] == ["PT-0003"]
+    assert [(e["file"], e["annotations"]) for e in metrics["slowest_files"]] == [("b.pdf", 2), ("c.pdf", 0)]
+
+    lines = format_metrics(metrics, top=1)
+    assert lines[0].startswith("3 file(s), 7 page(s), 5 annotation(s)")
+    assert "Most hits: PT-0001 (4)" in lines
+    assert "Never matched: PT-0003" in lines
+    assert [line for line in lines if line.startswith("Slow: ")] == ["Slow: b.pdf 3.0 s (1 page(s), 2 annotation(s))"]
+
+
+def test_prometheus_textfile_has_one_gauge_per_total(tmp_path):
+    run = RunMetrics(["PT-0001", "PT-0002"])
+    run.add_file("a.pdf", 0.5, _stats(3, {"PT-0001": 2}))
+    path = str(tmp_path / "commentpdf.prom")
+    write_prometheus_textfile(path, run.to_dict(), {"processed": 1, "failed": 2})
+
+    with open(path, encoding="utf-8") as f:
+        samples = dict(line.rsplit(" ", 1) for line in f.read().splitlines() if not line.startswith("#"))
+    assert samples['commentpdf_run_files{status="processed"}'] == "1"
+    assert samples['commentpdf_run_files{status="failed"}'] == "2"
+    assert samples['commentpdf_run_files{status="skipped"}'] == "0"
+    assert samples["commentpdf_run_pages"] == "3"
+    assert samples["commentpdf_run_annotations"] == "2"
+    assert samples["commentpdf_run_unmatched_tags"] == "1"
+    assert not os.path.exists(path + ".part")
+
+
+def test_process_files_writes_metrics_only_when_asked(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001", "PT-0009"], "comment": ["Gasket", "Unused"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "PT-0001 and PT-0001")
+    doc.save(pdf)
+    doc.close()
+
+    process_files([pdf], None, str(tmp_path / "quiet"), tag_df=df)
+    assert not os.path.exists(str(tmp_path / "quiet" / METRICS_NAME))
+
+    summary = process_files([pdf], None, str(tmp_path / "out"), tag_df=df, metrics=True)
+    with open(str(tmp_path / "out" / METRICS_NAME), encoding="utf-8") as f:
+        written = json.load(f)
+    assert written["hits_per_tag"] == {"PT-0001": 2}
+    assert written["unmatched_tags"] == ["PT-0009"]
+    assert written["summary"]["processed"] == 1
+    assert "metrics" not in written["summary"]
+    assert written["files"] == summary["metrics"]["files"] == 1
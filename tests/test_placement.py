@@ -0,0 +1,73 @@
+import random
+
+import fitz
+import pytest
+
+from commentpdf.core import place_annotation_boxes
+
+PAGE = fitz.Rect(0, 0, 600, 400)
+
+
+def _scalar_box(inst, width, height, distance, page_rect):
+    """The per-hit placement place_annotation_boxes replaced, kept as the reference."""
+    pref_x0 = inst.x1 + distance
+    pref_x1 = pref_x0 + width
+    if pref_x1 <= page_rect.x1 - 5:
+        x0 = pref_x0
+        x1 = pref_x1
+    else:
+        x1 = inst.x0 - distance
+        x0 = x1 - width
+        if x0 < page_rect.x0 + 5:
+            x0 = page_rect.x0 + 5
+            x1 = min(page_rect.x1 - 5, x0 + width)
+
+    inst_mid = (inst.y0 + inst.y1) / 2.0
+    y0 = inst_mid - (height / 2.0)
+    y1 = y0 + height
+    if y0 < page_rect.y0 + 5:
+        y0 = page_rect.y0 + 5
+        y1 = y0 + height
+    if y1 > page_rect.y1 - 5:
+        y1 = page_rect.y1 - 5
+        y0 = y1 - height
+        if y0 < page_rect.y0 + 5:
+            y0 = page_rect.y0 + 5
+    return (x0, y0, x1, y1)
+
+
+CASES = {
+    # (hit rect, width, height, distance)
+    "fits right": ((100, 100, 140, 110), 80, 14, 10),
+    "exactly at right margin": ((100, 100, 140, 110), 445, 14, 10),
+    "left fallback": ((500, 100, 540, 110), 80, 14, 10),
+    "left clamp": ((60, 100, 560, 110), 80, 14, 10),
+    "top clamp": ((100, 0, 140, 4), 80, 30, 10),
+    "bottom clamp": ((100, 392, 140, 398), 80, 30, 10),
+    "taller than page": ((100, 190, 140, 200), 80, 500, 10),
+    "wider than page": ((100, 100, 140, 110), 700, 14, 10),
+    "negative distance": ((100, 100, 140, 110), 80, 14, -20),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_boxes_match_the_scalar_placement(name):
+    rect, width, height, distance = CASES[name]
+    expected = _scalar_box(fitz.Rect(rect), width, height, distance, PAGE)
+    assert place_annotation_boxes([fitz.Rect(rect)], [width], [height], [distance], PAGE) == [expected]
+
+
+def test_a_page_of_random_hits_matches_the_scalar_placement():
+    rng = random.Random(35)
+    page = fitz.Rect(10, 20, 842, 595)
+    rects, widths, heights, distances = [], [], [], []
+    for _ in range(500):
+        x0, y0 = rng.uniform(0, 850), rng.uniform(0, 600)
+        rects.append(fitz.Rect(x0, y0, x0 + rng.uniform(1, 80), y0 + rng.uniform(1, 15)))
+        widths.append(rng.uniform(5, 900))
+        heights.append(rng.uniform(5, 700))
+        distances.append(rng.uniform(-20, 60))
+
+    expected = [_scalar_box(*args, page) for args in zip(rects, widths, heights, distances)]
+    assert place_annotation_boxes(rects, widths, heights, distances, page) == expected
+    assert place_annotation_boxes([], [], [], [], page) == []
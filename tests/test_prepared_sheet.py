@@ -0,0 +1,38 @@
+import fitz
+import pandas as pd
+
+from commentpdf.core import prepare_tag_plan, process_files
+
+
+def _make_pdf(path, text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+
+
+def test_process_files_accepts_prepared_tag_sheet(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001", "PT-0002"], "comment": ["Gasket", "Valve"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    _make_pdf(pdf, "PT-0001 and PT-0002")
+
+    plain = process_files([pdf], None, str(tmp_path / "plain"), tag_df=df)
+    prepared = process_files([pdf], None, str(tmp_path / "prepared"), tag_df=prepare_tag_plan(df), journal=True)
+    assert prepared["processed"] == 1
+    assert prepared["metrics"]["annotations"] == plain["metrics"]["annotations"] == 2
+
+    # the journal settings digest must also accept it, so a resumed run skips the file
+    resumed = process_files([pdf], None, str(tmp_path / "prepared"), tag_df=prepare_tag_plan(df), resume=True)
+    assert resumed["skipped"] == 1
+
+
+def test_profile_accepts_prepared_tag_sheet(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    _make_pdf(pdf, "PT-0001")
+
+    summary = process_files(
+        [pdf], None, str(tmp_path / "out"), profiles=[{"name": "team", "tag_df": prepare_tag_plan(df)}]
+    )
+    assert summary["processed"] == 1
+    assert summary["metrics"]["annotations"] == 1
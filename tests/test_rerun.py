@@ -0,0 +1,35 @@
+import os
+
+import fitz
+import pandas as pd
+
+from commentpdf.core import update_pdf_with_comments
+
+
+def _make_pdf(path):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), "PT-0001 and PT-0002")
+    page.insert_text((72, 300), "PT-0001")
+    doc.save(path)
+    doc.close()
+
+
+def test_rerun_on_marked_output_is_idempotent(tmp_path):
+    # comments that mention their own tag must not be matched again on the next run
+    df = pd.DataFrame({"tag": ["PT-0001", "PT-0002"], "comment": ["Replace PT-0001 gasket", "Check PT-0002"]})
+    source = str(tmp_path / "drawing.pdf")
+    _make_pdf(source)
+
+    counts, sizes = [], []
+    for run in range(3):
+        output = str(tmp_path / f"run{run}.pdf")
+        counts.append(update_pdf_with_comments(source, df, output))
+        sizes.append(os.path.getsize(output))
+        source = output
+
+    assert counts == [3, 3, 3]
+    # the trailer /ID is new on every save and its encoding may vary by a few bytes
+    assert abs(sizes[2] - sizes[1]) < 64
+    with fitz.open(source) as doc:
+        assert len(list(doc[0].annots())) == 3
@@ -0,0 +1,109 @@
+import http.client
+import json
+import os
+import signal
+import threading
+import time
+
+import fitz
+import pandas as pd
+import pytest
+
+from pdf_comment_server import AnnotationService, make_server
+
+
+def _pdf_bytes(text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def served(tmp_path):
+    workbook = str(tmp_path / "tags.xlsx")
+    # '(a+)+$' backtracks catastrophically on a run of a's when matched as a regex
+    pd.DataFrame({"tag": ["PT-0001", "(a+)+$"], "comment": ["Gasket", "Never"]}).to_excel(workbook, index=False)
+    service = AnnotationService(
+        {"default": workbook}, workers=1, max_concurrent=1, queue_timeout=5, request_timeout=2, max_upload_mb=0.05
+    )
+    service.start()
+    server = make_server(service, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield service, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def _post(port, body, query=""):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", "/annotate" + query, body=body, headers={"Content-Type": "application/pdf"})
+        response = conn.getresponse()
+        return response.status, response.read(), response
+    finally:
+        conn.close()
+
+
+def _annotate_ok(port):
+    status, body, response = _post(port, _pdf_bytes("PT-0001"))
+    assert status == 200
+    assert body.startswith(b"%PDF")
+    assert response.getheader("X-Annotation-Count") == "1"
+
+
+def test_annotate_and_upload_limit(served):
+    _, port = served
+    _annotate_ok(port)
+    status, body, _ = _post(port, b"%PDF" + b"0" * 100_000)
+    assert status == 413
+    assert "too large" in json.loads(body)["error"]
+
+
+def test_timed_out_request_frees_its_worker_and_slot(served):
+    _, port = served
+    status, _, _ = _post(port, _pdf_bytes("a" * 40 + "!"), "?regex=1")
+    assert status == 504
+    # with one worker and one slot, this only succeeds if both were given back
+    _annotate_ok(port)
+
+
+def _wait_dead(pids):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        alive = [pid for pid in pids if os.path.exists(f"/proc/{pid}") and "zombie" not in _state(pid)]
+        if not alive:
+            return
+        time.sleep(0.05)
+
+
+def _state(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return f.read().lower()
+    except OSError:
+        return "zombie"
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="needs SIGKILL")
+def test_service_recovers_after_its_workers_are_killed(served):
+    service, port = served
+    pids = service._pool.pids()
+    for pid in pids:
+        os.kill(pid, signal.SIGKILL)
+    _wait_dead(pids)
+    _annotate_ok(port)
+    _annotate_ok(port)
+
+    # a crash while a request is running answers that request with 502
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(status=_post(port, _pdf_bytes("a" * 40 + "!"), "?regex=1")[0]))
+    thread.start()
+    time.sleep(0.5)
+    for pid in service._pool.pids():
+        os.kill(pid, signal.SIGKILL)
+    thread.join()
+    assert result["status"] == 502
+    _annotate_ok(port)
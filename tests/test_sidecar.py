@@ -0,0 +1,72 @@
+import fitz
+import pandas as pd
+import pytest
+
+from commentpdf.core import update_pdf_with_comments
+from commentpdf.sidecar import apply_annotation_sidecar, write_annotation_sidecar
+
+
+def test_applying_a_sidecar_twice_keeps_its_annotations(tmp_path):
+    df = pd.DataFrame({"tag": ["PT-0001", "PT-0002"], "comment": ["Gasket", "Valve"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "PT-0001")
+    doc.new_page().insert_text((72, 72), "PT-0002")
+    doc.save(pdf)
+    doc.close()
+
+    for fmt in ("xfdf", "json"):
+        sidecar = str(tmp_path / f"drawing_marked.{fmt}")
+        assert write_annotation_sidecar(pdf, df, sidecar, fmt=fmt) == 2
+        first, second = str(tmp_path / f"first_{fmt}.pdf"), str(tmp_path / f"second_{fmt}.pdf")
+        assert apply_annotation_sidecar(pdf, sidecar, first) == 2
+        assert apply_annotation_sidecar(first, sidecar, second) == 2
+        with fitz.open(second) as doc:
+            assert [len(list(page.annots())) for page in doc] == [1, 1]
+            page = doc[0]
+            rect = next(page.annots()).rect
+            assert 0 <= rect.x0 < rect.x1 <= page.rect.width
+
+
+def test_sidecars_round_trip_to_the_annotations_of_a_direct_run(tmp_path):
+    df = pd.DataFrame(
+        {
+            "tag": ["PT-0001", "PT-0002", "PT-0003"],
+            "comment": ["Gasket", "Valve <DN50> & flange", "Pump"],
+            "font": ["Arial", "Times New Roman", "Courier"],
+        }
+    )
+    pdf = str(tmp_path / "drawing.pdf")
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "PT-0001   PT-0002")
+    doc.new_page(width=842, height=595).insert_text((500, 300), "PT-0003")
+    doc.save(pdf)
+    doc.close()
+    direct = str(tmp_path / "direct.pdf")
+    assert update_pdf_with_comments(pdf, df, direct) == 3
+
+    def annotations(path):
+        with fitz.open(path) as doc:
+            return [
+                (page.number, annot.info["content"], annot.info["id"], tuple(annot.rect),
+                 doc.xref_get_key(annot.xref, "DA")[1])
+                for page in doc for annot in page.annots()
+            ]
+
+    expected = annotations(direct)
+    assert [a[4].split()[-3] for a in expected] == ["/Helv", "/TiRo", "/Cour"]
+    for fmt in ("xfdf", "json"):
+        sidecar = str(tmp_path / f"drawing_marked.{fmt}")
+        assert write_annotation_sidecar(pdf, df, sidecar, fmt=fmt) == 3
+        applied = str(tmp_path / f"applied_{fmt}.pdf")
+        assert apply_annotation_sidecar(pdf, sidecar, applied) == 3
+
+        got = annotations(applied)
+        # same contents, fonts and /NM (annotation ID and fingerprint of rect, style and font)
+        assert [(a[0], a[1], a[2], a[4]) for a in got] == [(a[0], a[1], a[2], a[4]) for a in expected]
+        for (_, _, _, rect, _), (_, _, _, want, _) in zip(got, expected):
+            assert rect == pytest.approx(want, abs=1e-3)
+        # applying to the direct run's output recognises every annotation as unchanged
+        logged = []
+        apply_annotation_sidecar(direct, sidecar, str(tmp_path / f"again_{fmt}.pdf"), log_func=logged.append)
+        assert "  Existing annotations: kept 3, updated 0, deleted 0" in logged
@@ -0,0 +1,17 @@
+import fitz
+
+from commentpdf.bench import measure_import
+from commentpdf.core import SEARCH_FLAGS
+
+
+def test_gui_and_engine_import_without_pymupdf_or_pandas():
+    for module in ("commentpdf.core", "pdf_comment_from_excel"):
+        _, loaded = measure_import(module, repeat=1)
+        assert "fitz" not in loaded.split(",")
+        assert "pandas" not in loaded.split(",")
+
+
+def test_search_flags_match_pymupdf():
+    assert SEARCH_FLAGS == (
+        fitz.TEXT_DEHYPHENATE | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_MEDIABOX_CLIP
+    )
@@ -0,0 +1,96 @@
+import os
+import random
+
+import fitz
+import pandas as pd
+import pytest
+
+import commentpdf.tagindex
+from commentpdf.core import load_tag_sheet, match_page_rows
+from commentpdf.tagindex import compile_tag_index, open_tag_index
+
+TAGS = [
+    "PT-0001", "pt-0002", "FV 101", "P1", "X", "Pump-A", "pump-a2", "Ventil-Ä12", "STRASSE-7",
+    "HV-01.2", "10\"-PG-1001", "TIC/101", "A&B-3", "pt-00", "PT-0001A",
+]
+PAGES = [
+    "PT-0001 and pt-0002 near FV 101\nP1 feeds PUMP-A; pump-a2 off",
+    "Detail ventil-ä12, hv-01.2 and 10\"-pg-1001 (TIC/101)",
+    "a&b-3 PT-0001A PT-00015 xpt-0002 P12 x",
+    "no tags on this page",
+]
+
+
+@pytest.fixture(scope="module")
+def sheets(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("tagindex")
+    excel = str(folder / "tags.xlsx")
+    pd.DataFrame({"tag": TAGS, "comment": [f"Comment {n}" for n in range(len(TAGS))]}).to_excel(excel, index=False)
+    pdf = str(folder / "drawing.pdf")
+    doc = fitz.open()
+    for text in PAGES:
+        doc.new_page(width=842, height=595).insert_text((40, 60), text, fontsize=9)
+    doc.save(pdf)
+    doc.close()
+    index = open_tag_index(compile_tag_index(excel))
+    yield load_tag_sheet(excel), index, pdf
+    index.close()
+
+
+@pytest.mark.parametrize("case_sensitive", [False, True])
+@pytest.mark.parametrize("whole_word", [False, True])
+def test_prefilter_keeps_every_match(sheets, case_sensitive, whole_word):
+    df, index, pdf = sheets
+    found = 0
+    with fitz.open(pdf) as doc:
+        for page in doc:
+            expected = match_page_rows(page, df, case_sensitive, whole_word)
+            got = match_page_rows(page, index, case_sensitive, whole_word)
+            assert [(t, c, r) for _, t, c, r in got] == [(t, c, r) for _, t, c, r in expected]
+            found += len(expected)
+    assert found
+
+
+def test_regex_tags_check_every_row(tmp_path):
+    excel = str(tmp_path / "regex.xlsx")
+    pd.DataFrame({"tag": [r"PT-\d{4}", r"\bFV\s\d+", "p."], "comment": ["a", "b", "c"]}).to_excel(excel, index=False)
+    index = open_tag_index(compile_tag_index(excel))
+    try:
+        df = load_tag_sheet(excel)
+        with fitz.open() as doc:
+            page = doc.new_page()
+            page.insert_text((40, 60), PAGES[0], fontsize=9)
+            expected = match_page_rows(page, df, use_regex=True)
+            got = match_page_rows(page, index, use_regex=True)
+        assert len(expected) == 3
+        assert [(t, c, r) for _, t, c, r in got] == [(t, c, r) for _, t, c, r in expected]
+    finally:
+        index.close()
+
+
+def test_candidate_rows_cover_random_case_insensitive_hits(sheets):
+    _, index, _ = sheets
+    rng = random.Random(41)
+    for _ in range(300):
+        picked = rng.sample(range(len(TAGS)), 3)
+        words = ["".join(c.upper() if rng.random() < 0.5 else c.lower() for c in TAGS[i]) for i in picked]
+        text = " ".join(words + ["filler", "text"])
+        assert set(picked) <= set(int(i) for i in index.candidate_rows(text))
+
+
+def test_unchanged_workbooks_are_not_hashed_again(tmp_path, monkeypatch):
+    excel = str(tmp_path / "tags.xlsx")
+    pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]}).to_excel(excel, index=False)
+    path = compile_tag_index(excel)
+    hashed = []
+    real = commentpdf.tagindex.file_sha256
+    monkeypatch.setattr(commentpdf.tagindex, "file_sha256", lambda p: hashed.append(p) or real(p))
+
+    open_tag_index(path).close()
+    assert hashed == []
+    # touched but unchanged: hashed once, then remembered for the new modification time
+    st = os.stat(excel)
+    os.utime(excel, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    open_tag_index(path).close()
+    open_tag_index(path).close()
+    assert hashed == [excel]
@@ -0,0 +1,80 @@
+from concurrent.futures import Future
+
+import pandas as pd
+
+from pdf_comment_watch import FolderWatcher, _file_signature
+
+
+def test_failed_file_is_not_done_and_is_retried_once_changed(tmp_path):
+    pdf = tmp_path / "drawing.pdf"
+    pdf.write_bytes(b"not a pdf")
+    path = str(pdf)
+    logged = []
+    watcher = FolderWatcher([str(tmp_path)], str(tmp_path / "tags.xlsx"), settle_seconds=0, log_func=logged.append)
+
+    future = Future()
+    future.set_result((None, ["  Error opening PDF: broken"], 0.01))
+    watcher._in_flight[path] = (future, _file_signature(path), 0)
+    watcher._reap_finished()
+
+    assert path not in watcher._done
+    assert not any(line.startswith("Finished") for line in logged)
+    # unchanged: not retried
+    assert watcher._collect_ready([path], 0.0) == []
+    assert watcher._collect_ready([path], 1.0) == []
+    # changed: queued again once it settles
+    pdf.write_bytes(b"still not a pdf")
+    assert watcher._collect_ready([path], 2.0) == []
+    assert [p for p, _ in watcher._collect_ready([path], 3.0)] == [path]
+
+
+class _OldPool:
+    def __init__(self):
+        self.shutdown_args = None
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shutdown_args = (wait, cancel_futures)
+
+
+def test_reloading_the_tag_sheet_does_not_wait_for_queued_files(tmp_path):
+    running, queued = str(tmp_path / "running.pdf"), str(tmp_path / "queued.pdf")
+    for path in (running, queued):
+        with open(path, "wb") as f:
+            f.write(b"not a pdf")
+    watcher = FolderWatcher([str(tmp_path)], str(tmp_path / "tags.xlsx"), workers=1)
+    watcher._tag_df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    old = watcher._pool = _OldPool()
+    still_running = Future()
+    still_running.set_running_or_notify_cancel()
+    cancelled = Future()
+    cancelled.cancel()
+    watcher._in_flight = {running: (still_running, (1, 1), 0), queued: (cancelled, (1, 1), 0)}
+    try:
+        watcher._restart_pool()
+
+        assert old.shutdown_args == (False, True)
+        # the running file keeps its future; the cancelled one is re-submitted to the new pool
+        assert watcher._in_flight[running][0] is still_running
+        resubmitted = watcher._in_flight[queued][0]
+        assert resubmitted is not cancelled
+        assert resubmitted.result(timeout=60)[0] is None
+    finally:
+        watcher._pool.shutdown(wait=True)
+
+
+def test_history_of_removed_files_is_forgotten(tmp_path):
+    kept, removed = tmp_path / "kept.pdf", tmp_path / "removed.pdf"
+    kept.write_bytes(b"a")
+    watcher = FolderWatcher([str(tmp_path)], str(tmp_path / "tags.xlsx"))
+    watcher._done = {str(kept): (1, 1), str(removed): (1, 1)}
+    watcher._failed = {str(removed): (1, 1)}
+
+    watcher._forget_removed({str(kept)})
+    assert watcher._done == {str(kept): (1, 1)}
+    assert watcher._failed == {}
+
+
+def test_ready_files_are_ordered_by_size_without_opening_them(tmp_path):
+    watcher = FolderWatcher([str(tmp_path)], str(tmp_path / "tags.xlsx"), priority=["urgent*"])
+    ready = [("/gone/small.pdf", (10, 1)), ("/gone/large.pdf", (10**7, 1)), ("/gone/urgent.pdf", (10, 1))]
+    assert [p for p, _ in watcher._order_ready(ready)] == ["/gone/urgent.pdf", "/gone/large.pdf", "/gone/small.pdf"]
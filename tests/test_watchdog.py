@@ -0,0 +1,76 @@
+import fitz
+import pandas as pd
+
+from commentpdf.core import process_files
+from commentpdf.watchdog import FileLimits
+
+
+def test_memory_limit_ignores_memory_inherited_by_the_worker(tmp_path):
+    # the forked child starts with the parent's pages (far more than 50 MB under pytest with
+    # pandas loaded); only what it uses beyond that counts
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    pdf = str(tmp_path / "drawing.pdf")
+    doc = fitz.open()
+    # enough pages for the parent to check the running child's memory several times
+    for _ in range(200):
+        doc.new_page().insert_text((72, 72), "PT-0001")
+    doc.save(pdf)
+    doc.close()
+
+    summary = process_files([pdf], None, str(tmp_path / "out"), tag_df=df, limits=FileLimits(memory_mb=50))
+    assert summary["quarantined"] == 0
+    assert summary["processed"] == 1
+
+
+def _write_pdf(path, text, pages=1):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+
+
+def test_workers_are_reused_from_file_to_file(tmp_path):
+    from commentpdf.batch import init_batch_worker
+    from commentpdf.watchdog import SupervisedFile, WorkerPool
+
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": ["Gasket"]})
+    pool = WorkerPool(1, init_batch_worker, (df, {}, "pdf"))
+    pids = []
+    try:
+        for n in range(3):
+            pdf = str(tmp_path / f"d{n}.pdf")
+            _write_pdf(pdf, "PT-0001")
+            worker = pool.acquire()
+            pids.append(worker.pid)
+            job = SupervisedFile(worker, pdf, str(tmp_path / f"d{n}_marked.pdf"), FileLimits(seconds=60))
+            result = None
+            while result is None:
+                result = job.poll()
+            pool.release(worker)
+            assert result[0] == "done" and result[1][0] == 1
+    finally:
+        pool.close()
+    assert len(set(pids)) == 1
+
+
+def test_stuck_file_is_killed_and_its_partial_output_removed(tmp_path):
+    # catastrophic backtracking: the match never finishes within the page limit
+    df = pd.DataFrame({"tag": ["(a+)+$", "PT-0001"], "comment": ["Never", "Gasket"]})
+    stuck, fine = str(tmp_path / "a_stuck.pdf"), str(tmp_path / "b_fine.pdf")
+    _write_pdf(stuck, "a" * 40 + "!")
+    _write_pdf(fine, "PT-0001")
+    out = tmp_path / "out"
+    out.mkdir()
+    # as left behind by a worker killed while saving
+    partial = out / "a_stuck_marked.pdf.part"
+    partial.write_bytes(b"%PDF-1.7 truncated")
+
+    summary = process_files(
+        [stuck, fine], None, str(out), tag_df=df, use_regex=True, workers=1, priority=["a_stuck.pdf"],
+        limits=FileLimits(page_seconds=1),
+    )
+    assert summary["quarantined"] == 1
+    assert summary["processed"] == 1
+    assert not partial.exists()
+    assert (out / "b_fine_marked.pdf").exists()
@@ -0,0 +1,51 @@
+import fitz
+import pandas as pd
+
+from commentpdf.core import annotation_box_size, text_width_points, update_pdf_with_comments, wrap_comment
+
+LONG = "Replace gasket with spiral wound type per spec PS-2041 before the next shutdown"
+
+
+def test_wrapped_lines_fit_and_keep_every_word():
+    lines, widest = wrap_comment(LONG, "helv", 10, 120.0)
+    assert len(lines) > 1
+    assert " ".join(lines).split() == LONG.split()
+    assert widest <= 120.0
+    assert all(text_width_points(line, 10, "helv") <= 120.0 for line in lines)
+
+
+def test_explicit_newlines_are_kept_and_long_words_are_split():
+    assert wrap_comment("Gasket\nValve", "helv", 10, 500.0)[0] == ("Gasket", "Valve")
+    word = "X" * 60
+    lines, widest = wrap_comment(word, "helv", 10, 80.0)
+    assert len(lines) > 1
+    assert "".join(lines) == word
+    assert widest <= 80.0
+
+
+def test_box_wraps_only_when_it_would_be_wider():
+    width, height, lines = annotation_box_size(LONG, 10)
+    assert lines == (LONG,)
+    assert annotation_box_size(LONG, 10, wrap_width=width + 1) == (width, height, lines)
+
+    wrapped_w, wrapped_h, wrapped = annotation_box_size(LONG, 10, wrap_width=150.0)
+    assert len(wrapped) > 1
+    assert wrapped_w <= 150.0
+    assert wrapped_h > height
+
+
+def test_wrapped_annotations_stay_within_the_wrap_width(tmp_path):
+    pdf, out = str(tmp_path / "drawing.pdf"), str(tmp_path / "out.pdf")
+    doc = fitz.open()
+    doc.new_page(width=842, height=595).insert_text((72, 300), "PT-0001")
+    doc.save(pdf)
+    doc.close()
+    df = pd.DataFrame({"tag": ["PT-0001"], "comment": [LONG]})
+
+    assert update_pdf_with_comments(pdf, df, out, wrap_width=150.0) == 1
+    with fitz.open(out) as doc:
+        page = doc[0]
+        annot = next(page.annots())
+        assert annot.info["content"] == LONG
+        assert annot.rect.width <= 150.0 + 1e-3
+        assert annot.rect.height > 2 * 10